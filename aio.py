@@ -0,0 +1,828 @@
+#!/usr/bin/python3
+# Copyright (c) 2015. Harun Emektar
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# asyncio initiator, every connection of every session is driven by one
+# event loop instead of sender and receiver threads per connection and session
+
+import asyncio
+import collections
+import logging
+import socket
+import time
+import pdu
+import keys
+import transport
+from session import ScsiTask, TextTask, LoginError, SessionProtocol
+from connection import RecvBuffer, StatusSN
+from initiator import ParseTargets, TargetInfoParser, LoginResult, DiscoveryResult, MergeTargets
+
+class AsyncConnection(asyncio.BufferedProtocol):
+    # logger for asyncio initiator connection
+    logger = logging.getLogger("Async Init Con")
+    logger.setLevel(logging.DEBUG)
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.DEBUG)
+    logger.addHandler(ch)
+
+    # default port number
+    DEFAULT_PORT = 3260 # for iscsi
+
+    def __init__(self, session, cid, options = None):
+        '''
+        Connection of an AsyncSession, received pdus are framed in place
+        and handed to session.ProcessPDU from the event loop
+        @param options: transport.TransportOptions for socket tuning and connect timeout
+        '''
+        if options == None:
+            options = transport.TransportOptions()
+        self.__options = options
+        self.__session = session
+        self.__cid = cid
+        self.__expstatsn = -1
+        self.__auth = keys.AuthMethod("None")
+        self.__keys = [self.__auth]
+        self.__header_digest = False
+        self.__data_digest = False
+        self.__rbuf = RecvBuffer()
+        self.__out = [] # (pdu, release) written with next flush
+        self.__transport = None
+        self.__soc = None
+        self.__quickack = False
+        self.__closed = None
+
+    async def Open(self, portal):
+        '''
+        Connect to portal, "unix:/path", a tcp "host:port" with optional
+        "tcp:" prefix, a portal of another transport returning a socket, or
+        a connected socket
+        '''
+        loop = asyncio.get_running_loop()
+        self.__closed = loop.create_future()
+        options = self.__options
+        soc = None # socket opened here, closed if connection is given up
+        if not isinstance(portal, str):
+            coro = loop.create_connection(lambda: self, sock = portal)
+        else:
+            scheme, sep, address = portal.partition(":")
+            if sep == "" or scheme not in ("tcp", "unix", "pair", "pipe"):
+                scheme, address = "tcp", portal
+            if scheme == "tcp":
+                host, port = transport.SplitPortal(address, self.DEFAULT_PORT)
+                coro = self.__ConnectTcp(loop, host, port)
+            elif scheme == "unix":
+                coro = loop.create_unix_connection(lambda: self, address)
+            else:
+                soc = transport.Open(portal, self.DEFAULT_PORT, options)
+                if not isinstance(soc, socket.socket):
+                    soc.close()
+                    raise TypeError("%s transport doesn't give a socket for event loop" % scheme)
+                coro = loop.create_connection(lambda: self, sock = soc)
+        try:
+            await asyncio.wait_for(coro, options.connect_timeout)
+            self.__soc = self.__transport.get_extra_info("socket")
+            if transport.IsTcp(self.__soc):
+                options.Apply(self.__soc)
+                self.__quickack = options.quickack
+        except BaseException:
+            # timed out or cancelled, e.g. by timeout of a discovery
+            if self.__transport != None:
+                self.__transport.close()
+            elif soc != None:
+                soc.close()
+            raise
+
+    async def __ConnectTcp(self, loop, host, port):
+        # sockets are made here so buffer sizes are set before SYN, next
+        # resolved address is tried when previous one fails or doesn't
+        # answer in attempt_delay seconds, as transport.Connect does
+        options = self.__options
+        addrs = transport.Interleave(await loop.getaddrinfo(host, port, type = socket.SOCK_STREAM))
+
+        async def Attempt(family, type, proto, addr):
+            soc = socket.socket(family, type, proto)
+            try:
+                options.ApplyPreConnect(soc)
+                soc.setblocking(False)
+                await loop.sock_connect(soc, addr)
+            except BaseException:
+                soc.close()
+                raise
+            return soc
+
+        attempts = set()
+        winner = None
+        error = None
+        started = 0
+        try:
+            while winner == None and (started < len(addrs) or len(attempts) != 0):
+                if started < len(addrs):
+                    family, type, proto, name, addr = addrs[started]
+                    attempts.add(asyncio.ensure_future(Attempt(family, type, proto, addr)))
+                    started += 1
+                wait = options.attempt_delay if started < len(addrs) else None
+                done, attempts = await asyncio.wait(attempts, timeout = wait,
+                                                    return_when = asyncio.FIRST_COMPLETED)
+                for attempt in done:
+                    if attempt.exception() != None:
+                        error = attempt.exception()
+                    elif winner == None:
+                        winner = attempt.result()
+                    else:
+                        attempt.result().close() # slower one of same iteration
+        finally:
+            for attempt in attempts:
+                attempt.cancel()
+        if winner == None:
+            raise error
+        try:
+            await loop.create_connection(lambda: self, sock = winner)
+        except BaseException:
+            winner.close()
+            raise
+
+    def Close(self):
+        '''
+        Close transport, pdus not written yet are dropped
+        '''
+        if self.__transport != None:
+            self.__transport.close()
+
+    async def WaitClosed(self):
+        if self.__closed != None:
+            await asyncio.shield(self.__closed)
+
+    def connection_made(self, xport):
+        self.__transport = xport
+
+    def get_buffer(self, sizehint):
+        return self.__rbuf.GetBuffer()
+
+    def buffer_updated(self, nbytes):
+        self.__rbuf.Advance(nbytes)
+        if self.__quickack:
+            transport.QuickAck(self.__soc)
+        for data in self.__rbuf.Frames():
+            recv_pdu = pdu.PDU.Create(data, self.__header_digest, self.__data_digest)
+            if not recv_pdu.CheckHeaderDigest():
+                # pdu boundaries can't be trusted anymore
+                self.logger.error("header digest error, closing connection")
+                self.__transport.abort()
+                return
+            if not recv_pdu.CheckDataDigest():
+                self.logger.error("data digest error, pdu (0x%x) is discarded" % recv_pdu.Opcode)
+                continue
+            statsn = StatusSN(recv_pdu)
+            if statsn != None:
+                self.__expstatsn = (statsn + 1) & 0xFFFFFFFF
+            self.__session.ProcessPDU(self, recv_pdu)
+
+    def eof_received(self):
+        return False # close transport
+
+    def connection_lost(self, exc):
+        for out_pdu, release in self.__out:
+            if release:
+                out_pdu.Release()
+        self.__out = []
+        self.__transport = None
+        if not self.__closed.done():
+            self.__closed.set_result(None)
+        # outstanding commands of connection can't complete anymore
+        self.__session.ConnectionLost(self)
+
+    def __Flush(self):
+        # pdus queued in one loop iteration are written together, they are
+        # joined since some transports keep references to written buffers
+        # and released pdus go back to pool right away
+        out = self.__out
+        self.__out = []
+        bufs = []
+        for out_pdu, release in out:
+            if self.__expstatsn != -1:
+                out_pdu.ExpStatSN = self.__expstatsn
+            out_pdu.header_digest = self.__header_digest
+            out_pdu.data_digest = self.__data_digest
+            bufs += out_pdu.Buffers()
+        if self.__transport != None:
+            self.__transport.write(b"".join(bufs))
+        for out_pdu, release in out:
+            if release:
+                out_pdu.Release()
+
+    def SendPdu(self, pdu, release = False):
+        '''
+        Queue pdu to be written once current loop iteration is done
+        @param release: give pdu buffers back to pool once it's written
+        '''
+        if len(self.__out) == 0:
+            asyncio.get_running_loop().call_soon(self.__Flush)
+        self.__out.append((pdu, release))
+
+    @property
+    def auth_method(self):
+        return self.__auth
+
+    @property
+    def options(self):
+        return self.__options
+
+    @property
+    def cid(self):
+        return self.__cid
+
+    @property
+    def keys(self):
+        return self.__keys
+
+    @property
+    def header_digest(self):
+        return self.__header_digest
+
+    @header_digest.setter
+    def header_digest(self, h_digest):
+        self.__header_digest = h_digest
+        self.__rbuf.SetDigests(self.__header_digest, self.__data_digest)
+
+    @property
+    def data_digest(self):
+        return self.__data_digest
+
+    @data_digest.setter
+    def data_digest(self, d_digest):
+        self.__data_digest = d_digest
+        self.__rbuf.SetDigests(self.__header_digest, self.__data_digest)
+
+    @property
+    def expstatsn(self):
+        return self.__expstatsn
+
+    @expstatsn.setter
+    def expstatsn(self, expstatsn):
+        self.__expstatsn = expstatsn & 0xFFFFFFFF
+
+class AsyncSession():
+    # logger for asyncio initiator session
+    logger = logging.getLogger("Async Init Session")
+    logger.setLevel(logging.DEBUG)
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.DEBUG)
+    logger.addHandler(ch)
+
+    STATE_FREE = SessionProtocol.STATE_FREE
+    STATE_LOGGED_IN = SessionProtocol.STATE_LOGGED_IN
+    STATE_FAILED = SessionProtocol.STATE_FAILED
+
+    class Cmd(SessionProtocol.Cmd):
+        def __init__(self, task = None):
+            super().__init__(task, asyncio.get_running_loop().create_future())
+
+    MAX_TASKS = 1024 # default cap of outstanding commands
+
+    def __init__(self, init, tgt_name = None, options = None, max_tasks = MAX_TASKS,
+                 proposal = None):
+        '''
+        Session driven by the running event loop, it has no connection
+        until Connect is awaited
+        @param init: initiator, its name is used in login
+        @param tgt_name: target for a normal session, discovery session if None
+        @param options: transport.TransportOptions of connections
+        @param proposal: keys.SessionParams offered in login, keys.Proposal() if None
+        '''
+        self.init = init
+        self.__cid = 1
+        self.__conn = None # single connection of session
+        self.__pending = collections.deque() # (cmd, sender) waiting for command window
+        self.__options = options
+        self.__slot_freed = asyncio.Event()
+        # pdus are built and responses handled by protocol, in event loop
+        self.__protocol = SessionProtocol(init.name, tgt_name, proposal, max_tasks,
+                                          on_release = self.__Released, on_text = self.__TextContinues,
+                                          on_r2t = self.__R2T, on_ping = self.__Ping)
+
+    async def Connect(self, portal):
+        '''
+        Open leading connection of session
+        @param portal: see AsyncConnection.Open
+        '''
+        conn = AsyncConnection(self, self.__cid, self.__options)
+        await conn.Open(portal)
+        self.__conn = conn
+        self.__protocol.connections[self.__cid] = conn
+        self.__cid += 1
+        return conn
+
+    def Close(self):
+        if self.__conn != None:
+            self.__conn.Close()
+
+    @property
+    def state(self):
+        return self.__protocol.state
+
+    @property
+    def params(self):
+        '''
+        keys.SessionParams negotiated in login
+        '''
+        return self.__protocol.params
+
+    @property
+    def proposal(self):
+        return self.__protocol.proposal
+
+    @property
+    def tasks(self):
+        return self.__protocol.tasks
+
+    @property
+    def isid(self):
+        return self.__protocol.isid
+
+    def __Released(self, cmd):
+        # wake a caller waiting for a task slot
+        self.__slot_freed.set()
+
+    def __TextContinues(self, cmd):
+        if len(self.__pending) == 0 and self.__protocol.WindowOpen():
+            self.__Issue(cmd, self.__protocol.SendText)
+        else:
+            self.__pending.append((cmd, self.__protocol.SendText))
+
+    def __R2T(self, cmd, ttt, offset, length):
+        self.__protocol.SendDataOut(self.__conn, cmd, ttt, offset, length)
+
+    def __Ping(self, conn, nop_in):
+        # target waits for a NOP-Out echoing its TargetTransferTag
+        self.__protocol.SendNopOut(conn, None, nop_in.TargetTransferTag)
+
+    def ProcessPDU(self, conn, recv_pdu):
+        '''
+        Handle pdu received on conn, called from event loop
+        '''
+        if self.__protocol.ProcessPDU(recv_pdu, conn):
+            while len(self.__pending) != 0 and self.__protocol.WindowOpen():
+                self.__Issue(*self.__pending.popleft())
+
+    def ConnectionLost(self, conn):
+        '''
+        Fail commands of session once its connection is gone
+        '''
+        self.__protocol.connections.pop(conn.cid, None)
+        if conn is not self.__conn:
+            return
+        self.__conn = None
+        if self.__protocol.state != self.STATE_FREE or len(self.__protocol.tasks) != 0:
+            self.__protocol.ProcessEvent(SessionProtocol.EVENT_CONN_LOST)
+        self.__protocol.FailAll(ConnectionError("connection (%d) is lost" % conn.cid))
+        self.__pending.clear()
+
+    def __Issue(self, cmd, sender):
+        if cmd.future.done():
+            # cancelled while waiting for window, its slot is given back
+            self.__protocol.Finish(cmd, None)
+            return
+        sender(self.__conn, cmd)
+
+    async def __Submit(self, cmd, sender, windowed = True):
+        # wait for a task slot, TaskTable.Alloc would block the event loop
+        while True:
+            cmd.itt = self.__protocol.tasks.TryAlloc(cmd)
+            if cmd.itt != None:
+                break
+            self.__slot_freed.clear()
+            await self.__slot_freed.wait()
+        if self.__protocol.state == self.STATE_FAILED or self.__conn == None:
+            self.__protocol.Fail(cmd, ConnectionError("session (%s) has failed" % self.isid.raw_data))
+        elif not windowed:
+            sender(self.__conn, cmd)
+        elif len(self.__pending) == 0 and self.__protocol.WindowOpen():
+            self.__Issue(cmd, sender)
+        else:
+            self.__pending.append((cmd, sender))
+        # a cancelled cmd keeps its slot until its response arrives
+        return await cmd.future
+
+    async def Login(self):
+        '''
+        Perform login on first connection of session. Returns True or
+        raises LoginError, None if session isn't free to login.
+        '''
+        if self.__protocol.state == self.STATE_FREE:
+            negotiator = self.__protocol.Negotiator(True)
+            return await self.__Submit(self.Cmd(negotiator), self.__protocol.SendLogin, False)
+        elif self.__protocol.state == self.STATE_LOGGED_IN:
+            self.logger.warn("Session (%s) has already logged in" % self.isid.raw_data)
+        else:
+            self.logger.warn("Session (%s) failed" % self.isid.raw_data)
+        return None
+
+    async def SendText(self, text, on_data = None):
+        '''
+        Send text request, returns text response payload or None if session
+        hasn't logged in. Response continued over several pdus is requested
+        and reassembled.
+        @param on_data: called with each piece of response as it arrives,
+        response length is returned then
+        '''
+        if self.__protocol.state == self.STATE_LOGGED_IN:
+            return await self.__Submit(self.Cmd(TextTask(text, on_data)), self.__protocol.SendText)
+        self.logger.error("Session (%s) hasn't logged in yet" % self.isid.raw_data)
+        return None
+
+    async def Read(self, lba, blocks, buf, lun = 0, read16 = False):
+        '''
+        Issue READ(10), or READ(16) when asked or when lba or blocks don't fit
+        READ(10). Data-In is placed directly into buf. Returns the ScsiTask,
+        None if session isn't logged in. Reads awaited concurrently are sent
+        as CmdSN window allows.
+        @param buf: writable buffer of blocks * block length bytes
+        '''
+        if read16 or lba > 0xFFFFFFFF or blocks > 0xFFFF:
+            cdb = pdu.Read16Cdb(lba, blocks)
+        else:
+            cdb = pdu.Read10Cdb(lba, blocks)
+        if self.__protocol.state != self.STATE_LOGGED_IN:
+            self.logger.error("Session (%s) hasn't logged in yet" % self.isid.raw_data)
+            return None
+        return await self.__Submit(self.Cmd(ScsiTask(lun, cdb, buf)), self.__protocol.SendScsiCmd)
+
+    async def Write(self, lba, blocks, buf, lun = 0, write16 = False):
+        '''
+        Issue WRITE(10), or WRITE(16) when asked or when lba or blocks don't
+        fit WRITE(10). Returns the ScsiTask, buf mustn't be modified until then.
+        @param buf: buffer of blocks * block length bytes
+        '''
+        if write16 or lba > 0xFFFFFFFF or blocks > 0xFFFF:
+            cdb = pdu.Write16Cdb(lba, blocks)
+        else:
+            cdb = pdu.Write10Cdb(lba, blocks)
+        if self.__protocol.state != self.STATE_LOGGED_IN:
+            self.logger.error("Session (%s) hasn't logged in yet" % self.isid.raw_data)
+            return None
+        return await self.__Submit(self.Cmd(ScsiTask(lun, cdb, buf, True)), self.__protocol.SendScsiCmd)
+
+    async def Logout(self):
+        '''
+        Close session, returns logout response code or None if session
+        hasn't logged in. Connection is closed after a successful logout.
+        '''
+        if self.__protocol.state != self.STATE_LOGGED_IN:
+            self.logger.error("Session (%s) hasn't logged in yet" % self.isid.raw_data)
+            return None
+        response = await self.__Submit(self.Cmd(), self.__protocol.SendLogout)
+        if response == pdu.LogoutRespPDU.RESPONSE_SUCC:
+            self.Close()
+        return response
+
+class AsyncInitiator():
+    # logger for asyncio initiator
+    logger = logging.getLogger("Async Initiator")
+    logger.setLevel(logging.DEBUG)
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.DEBUG)
+    logger.addHandler(ch)
+
+    def __init__(self, name):
+        '''
+        Initiator whose sessions share the running event loop
+        @param name: initiator name either iqn or eui
+        '''
+        if not isinstance(name, str):
+            raise TypeError
+        self.__name = name
+        self.__sessions = []
+
+    @property
+    def name(self):
+        return self.__name
+
+    @property
+    def sessions(self):
+        return self.__sessions
+
+    async def Connect(self, portal, options = None, tgt_name = None, max_tasks = AsyncSession.MAX_TASKS,
+                      proposal = None):
+        '''
+        Returns a new session connected to portal, it isn't logged in yet
+        @param options: transport.TransportOptions, socket options and connect timeout
+        @param tgt_name: target for a normal session, discovery session if None
+        '''
+        session = AsyncSession(self, tgt_name, options, max_tasks, proposal)
+        await session.Connect(portal)
+        self.__sessions += [session]
+        return session
+
+    async def Login(self, portal, tgt_name = None, options = None):
+        '''
+        Returns a session logged in to target on portal
+        '''
+        session = await self.Connect(portal, options, tgt_name)
+        try:
+            await session.Login()
+        except:
+            self.Remove(session)
+            raise
+        return session
+
+    async def LoginAll(self, portals, tgt_name = None, count = None, concurrency = 256, options = None):
+        '''
+        Open and log in many sessions at once, at most concurrency of them
+        are connecting or logging in at a time. Returns list of
+        initiator.LoginResult in order sessions are asked for.
+        @param portals: a portal or list of them sessions are spread over in turn
+        @param count: number of sessions, one per portal if None
+        '''
+        if isinstance(portals, str):
+            portals = [portals]
+        if count == None:
+            count = len(portals)
+        semaphore = asyncio.Semaphore(concurrency)
+        async def Open(portal):
+            async with semaphore:
+                start = time.monotonic()
+                try:
+                    session = await self.Login(portal, tgt_name, options)
+                except (LoginError, OSError) as e:
+                    return LoginResult(portal, None, time.monotonic() - start, e)
+                return LoginResult(portal, session, time.monotonic() - start)
+        return await asyncio.gather(*[Open(portals[i % len(portals)]) for i in range(count)])
+
+    async def Discovery(self, portal, options = None):
+        '''
+        Returns list of initiator.TargetInfo of portal, a discovery session
+        is opened and closed for it
+        '''
+        session = await self.Login(portal, None, options)
+        try:
+            text = await session.SendText("SendTargets=All")
+            await session.Logout()
+        finally:
+            self.Remove(session)
+        return ParseTargets(text)
+
+    async def DiscoverAll(self, portals, concurrency = 256, timeout = 10, options = None):
+        '''
+        Discover many portals at once, at most concurrency of them are
+        discovered at a time and each is given up after timeout seconds,
+        its session is closed then.
+        Returns (targets, results): initiator.TargetInfo of all portals
+        merged by initiator.MergeTargets, and list of
+        initiator.DiscoveryResult in order of portals.
+        @param portals: list of portals, repeated ones are discovered once
+        '''
+        portals = list(dict.fromkeys(portals))
+        semaphore = asyncio.Semaphore(concurrency)
+        async def Fetch(portal):
+            async with semaphore:
+                start = time.monotonic()
+                try:
+                    targets = await asyncio.wait_for(self.Discovery(portal, options), timeout)
+                except asyncio.TimeoutError:
+                    e = TimeoutError("no answer in %g seconds" % timeout)
+                    return DiscoveryResult(portal, None, time.monotonic() - start, e)
+                except (LoginError, OSError) as e:
+                    return DiscoveryResult(portal, None, time.monotonic() - start, e)
+                return DiscoveryResult(portal, targets, time.monotonic() - start)
+        results = await asyncio.gather(*[Fetch(portal) for portal in portals])
+        return MergeTargets(r.targets for r in results if r.error == None), results
+
+    async def IterDiscovery(self, portal, options = None):
+        '''
+        Async generator of initiator.TargetInfo of portal, targets are given
+        while response is still arriving
+        '''
+        session = await self.Login(portal, None, options)
+        try:
+            chunks = asyncio.Queue()
+            text = asyncio.ensure_future(session.SendText("SendTargets=All", chunks.put_nowait))
+            text.add_done_callback(lambda f: chunks.put_nowait(None))
+            parser = TargetInfoParser()
+            chunk = await chunks.get()
+            while chunk != None:
+                for target in parser.Feed(chunk):
+                    yield target
+                chunk = await chunks.get()
+            await text
+            for target in parser.Close():
+                yield target
+            await session.Logout()
+        finally:
+            self.Remove(session)
+
+    def Remove(self, session):
+        '''
+        Forget session and close its connections
+        '''
+        session.Close()
+        if session in self.__sessions:
+            self.__sessions.remove(session)
+
+if __name__ == "__main__":
+    import unittest
+    from session import ScriptedTarget
+
+    class Init():
+        name = "iqn.2006-11.1"
+
+    TARGET = "iqn.2020-01.t:1"
+
+    async def Wait(condition, timeout = 5):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                raise TimeoutError
+            await asyncio.sleep(0.005)
+
+    class TestAsyncConnection(unittest.TestCase):
+        def testFraming(self):
+            # pdus are framed across reads and handed to session in order
+            class Session():
+                received = []
+                def ProcessPDU(self, conn, recv_pdu):
+                    self.received += [(recv_pdu.Opcode, recv_pdu.StatSN)]
+                def ConnectionLost(self, conn):
+                    pass
+            async def Run():
+                near, far = socket.socketpair()
+                sess = Session()
+                conn = AsyncConnection(sess, 1)
+                await conn.Open(near)
+                for statsn in (7, 8):
+                    hdr = pdu.LogoutRespPDU.CODEC.Pack(Opcode = pdu.BHS.OPCODE_LOGOUT_RES, StatSN = statsn)
+                    far.sendall(bytes(hdr)[:20])
+                    await asyncio.sleep(0.01)
+                    far.sendall(bytes(hdr)[20:])
+                await asyncio.sleep(0.01)
+                self.assertEqual(sess.received, [(pdu.BHS.OPCODE_LOGOUT_RES, 7),
+                                                 (pdu.BHS.OPCODE_LOGOUT_RES, 8)])
+                self.assertEqual(conn.expstatsn, 9)
+                # pdus queued in one iteration go out together, stamped with ExpStatSN
+                for i in range(3):
+                    conn.SendPdu(pdu.LogoutPDU().Encode(CmdSN = i), True)
+                await asyncio.sleep(0.01)
+                data = far.recv(1024)
+                self.assertEqual(len(data), 3 * pdu.BHS.LENGTH)
+                self.assertEqual(pdu.LogoutPDU(data[96:]).CmdSN, 2)
+                self.assertEqual(pdu.LogoutPDU(data[96:]).ExpStatSN, 9)
+                conn.Close()
+                far.close()
+            asyncio.run(Run())
+
+    class TestAsyncSession(unittest.TestCase):
+        def testPing(self):
+            # ping of target is answered with its TargetTransferTag
+            async def Run():
+                near, far = socket.socketpair()
+                session = AsyncSession(Init(), TARGET)
+                await session.Connect(near)
+                hdr = pdu.NopInPDU.CODEC.Pack(Opcode = pdu.BHS.OPCODE_NOP_IN, Final = True,
+                                              InitiatorTaskTag = 0xFFFFFFFF, TargetTransferTag = 0x1234,
+                                              StatSN = 5, ExpCmdSN = 1, MaxCmdSN = 1)
+                far.sendall(bytes(hdr))
+                await asyncio.sleep(0.01)
+                nop_out = pdu.NopOutPDU(far.recv(1024))
+                self.assertEqual(nop_out.Opcode, pdu.BHS.OPCODE_NOP_OUT)
+                self.assertTrue(nop_out.Immediate)
+                self.assertEqual(nop_out.InitiatorTaskTag, 0xFFFFFFFF)
+                self.assertEqual(nop_out.TargetTransferTag, 0x1234)
+                session.Close()
+                far.close()
+            asyncio.run(Run())
+
+    class AsyncTargetTest(unittest.IsolatedAsyncioTestCase):
+        PORTAL = "pair:aio"
+
+        async def asyncSetUp(self):
+            self.target = ScriptedTarget(self.PORTAL.partition(":")[2])
+            self.init = AsyncInitiator(Init.name)
+
+        async def asyncTearDown(self):
+            for session in list(self.init.sessions):
+                self.init.Remove(session)
+            self.target.Close()
+
+    class TestAsyncScripted(AsyncTargetTest):
+        async def testLogin(self):
+            session = await self.init.Login(self.PORTAL, TARGET)
+            self.assertEqual(session.state, AsyncSession.STATE_LOGGED_IN)
+            self.assertEqual(self.init.sessions, [session])
+            self.assertEqual(session.params.max_xmit_data_segment_length, ScriptedTarget.SEGMENT)
+            self.assertEqual(await session.Login(), None) # already logged in
+            with self.assertRaises(TypeError):
+                await self.init.Login("pipe:aio", TARGET) # pipe isn't a socket
+            self.assertEqual(self.init.sessions, [session])
+
+        async def testReadWrite(self):
+            session = await self.init.Login(self.PORTAL, TARGET) # InitialR2T=No, ImmediateData=Yes
+            buf = bytearray(32768)
+            self.assertTrue((await session.Read(10, 64, buf)).good)
+            self.assertEqual(buf, ScriptedTarget.Pattern(10, 32768))
+            data = bytes(range(256)) * 128
+            self.assertTrue((await session.Write(0, 64, data)).good)
+            self.assertEqual(self.target.written[0], data)
+            outs = self.target.Commands(pdu.BHS.OPCODE_DATA_OUT)
+            self.assertEqual({r.TargetTransferTag for c, r, d in outs}, {0xFFFFFFFF}) # unsolicited
+
+        async def testR2T(self):
+            # all data of write is solicited by R2T
+            proposal = keys.Proposal()
+            proposal.initial_r2t = True
+            proposal.immediate_data = False
+            session = await self.init.Connect(self.PORTAL, tgt_name = TARGET, proposal = proposal)
+            self.assertEqual(await session.Login(), True)
+            data = bytes(range(256)) * 128
+            self.assertTrue((await session.Write(0, 64, data)).good)
+            self.assertEqual(self.target.written[0], data)
+            self.assertEqual(len(self.target.Commands()[0][2]), 0)
+            outs = self.target.Commands(pdu.BHS.OPCODE_DATA_OUT)
+            self.assertEqual(sum(len(d) for c, r, d in outs), len(data))
+            self.assertNotIn(0xFFFFFFFF, {r.TargetTransferTag for c, r, d in outs})
+            self.assertEqual(outs[-1][1].Final, 1)
+
+        async def testSendText(self):
+            # response in parts is requested with TargetTransferTag and reassembled
+            self.target.text_chunk = 16
+            session = await self.init.Login(self.PORTAL)
+            chunks = []
+            self.assertEqual(await session.SendText("SendTargets=All"), self.target.text)
+            self.assertEqual(await session.SendText("SendTargets=All", chunks.append), len(self.target.text))
+            self.assertEqual(b"".join(chunks), self.target.text)
+            requests = self.target.Commands(pdu.BHS.OPCODE_TEXT_REQ)
+            self.assertEqual(len(requests), 2 * -(-len(self.target.text) // 16))
+            self.assertEqual(requests[1][1].TargetTransferTag, 1)
+
+        async def testLogout(self):
+            session = await self.init.Login(self.PORTAL, TARGET)
+            self.assertEqual(await session.Logout(), pdu.LogoutRespPDU.RESPONSE_SUCC)
+            self.assertEqual(session.state, AsyncSession.STATE_FREE)
+            await Wait(lambda: self.target.closed == 1)
+            self.assertEqual(await session.Read(0, 1, bytearray(512)), None)
+            self.assertEqual(await session.Logout(), None)
+
+        async def testWindow(self):
+            # window of 2 stalls 6 reads, announcing a window of 6 sends the rest
+            self.target.window = 2
+            session = await self.init.Login(self.PORTAL, TARGET)
+            self.target.Hold()
+            reads = [asyncio.ensure_future(session.Read(lba, 1, bytearray(512))) for lba in range(6)]
+            await Wait(lambda: len(self.target.Commands()) == 2)
+            await asyncio.sleep(0.05)
+            self.assertEqual(len(self.target.Commands()), 2)
+            self.target.Announce(6)
+            await Wait(lambda: len(self.target.Commands()) == 6)
+            self.target.Release()
+            for task in await asyncio.gather(*reads):
+                self.assertTrue(task.good)
+            cmdsns = [r.CmdSN for c, r, d in self.target.Commands()]
+            self.assertEqual(cmdsns, list(range(cmdsns[0], cmdsns[0] + 6)))
+
+    class TestAsyncInitiator(AsyncTargetTest):
+        async def testDiscovery(self):
+            targets = await self.init.Discovery(self.PORTAL)
+            self.assertEqual([(t.name, [(a.addr, a.tpgt) for a in t.addr_list]) for t in targets],
+                             [(TARGET, [("127.0.0.1:3260", 1)])])
+            self.assertEqual(self.init.sessions, [])
+            self.assertEqual(len(self.target.Commands(pdu.BHS.OPCODE_LOGOUT_REQ)), 1)
+            await Wait(lambda: self.target.closed == 1)
+
+        async def testLoginAll(self):
+            results = await self.init.LoginAll([self.PORTAL, "pair:nowhere"], TARGET, 3)
+            self.assertEqual([r.portal for r in results], [self.PORTAL, "pair:nowhere", self.PORTAL])
+            self.assertEqual([r.error for r in results[::2]], [None, None])
+            self.assertIsInstance(results[1].error, ConnectionRefusedError)
+            self.assertEqual(results[1].session, None)
+            self.assertEqual(self.init.sessions, [results[0].session, results[2].session])
+            self.assertEqual(len(self.target.conns), 2)
+
+        async def testDiscoverAll(self):
+            # unanswered portal is given up and its session closed, refused one is
+            # reported and repeated one is discovered once
+            mute = ScriptedTarget("aio-mute")
+            mute.silent = True
+            try:
+                targets, results = await self.init.DiscoverAll([self.PORTAL, "pair:aio-mute", "pair:nowhere",
+                                                                self.PORTAL], timeout = 0.5)
+                await Wait(lambda: mute.closed == 1)
+            finally:
+                mute.Close()
+            self.assertEqual([r.portal for r in results], [self.PORTAL, "pair:aio-mute", "pair:nowhere"])
+            self.assertEqual(results[0].error, None)
+            self.assertIsInstance(results[1].error, TimeoutError)
+            self.assertIsInstance(results[2].error, ConnectionRefusedError)
+            self.assertEqual([t.name for t in targets], [TARGET])
+            self.assertEqual(len(self.target.conns), 1)
+            self.assertEqual(self.init.sessions, [])
+
+    unittest.main()
@@ -0,0 +1,154 @@
+#!/usr/bin/python3
+# Copyright (c) 2015. Harun Emektar
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import time
+import socket
+import _thread
+import pdu
+from utils import ntoi
+
+def Rate(func, count, repeat = 3):
+    '''
+    Returns calls per second of func, the best of repeat runs
+    '''
+    best = None
+    for r in range(repeat):
+        start = time.perf_counter()
+        for i in range(count):
+            func()
+        elapsed = time.perf_counter() - start
+        if best == None or elapsed < best:
+            best = elapsed
+    return count / best
+
+def Report(name, rate, unit):
+    print("%-40s %12.0f %s" % (name, rate, unit))
+
+def BenchHeaders(count = 100000):
+    hdr = pdu.LoginRespPDU.CODEC.Pack(Opcode = pdu.BHS.OPCODE_LOGIN_RES, Transit = True,
+                                      CurrentStage = 1, NextStage = 3, DataSegmentLength = 0x35,
+                                      ISID = b"\x80\x04\x09\x00\x00\x01", TSIH = 7,
+                                      InitiatorTaskTag = 0x40001, StatSN = 1, ExpCmdSN = 2,
+                                      MaxCmdSN = 3)
+    hdr = bytes(hdr)
+
+    def ntoi_decode():
+        # field by field decode the way headers were parsed with utils.ntoi
+        return (ntoi(hdr[0]) & 0x3F, ntoi(hdr[0]) & 0x40, ntoi(hdr[1]) & 0x80,
+                ntoi(hdr[1]) & 0x40, (ntoi(hdr[1]) & 0x0C) >> 2, ntoi(hdr[1]) & 0x03,
+                ntoi(hdr[2]), ntoi(hdr[3]), ntoi(hdr[4]), ntoi(hdr[5:8]), hdr[8:14],
+                ntoi(hdr[14:16]), ntoi(hdr[16:20]), ntoi(hdr[24:28]), ntoi(hdr[28:32]),
+                ntoi(hdr[32:36]), ntoi(hdr[36:37]), ntoi(hdr[37:38]))
+
+    def property_decode():
+        p = pdu.LoginRespPDU(hdr)
+        return (p.Opcode, p.Immediate, p.Transit, p.Continue, p.CurrentStage, p.NextStage,
+                p.VersionMax, p.VersionActive, p.TotalAHSLength, p.DataSegmentLength,
+                p.ISID, p.TSIH, p.InitiatorTaskTag, p.StatSN, p.ExpCmdSN, p.MaxCmdSN,
+                p.StatusClass, p.StatusDetail)
+
+    codec = pdu.LoginRespPDU.CODEC
+    def codec_decode():
+        return codec.Unpack(hdr)
+
+    rec = codec.Unpack(hdr)
+    buf = bytearray(pdu.BHS.LENGTH)
+    def codec_encode():
+        return codec.PackInto(buf, rec)
+
+    Report("ntoi field decode (before)", Rate(ntoi_decode, count), "headers/s")
+    Report("property decode", Rate(property_decode, count), "headers/s")
+    Report("codec Unpack (after)", Rate(codec_decode, count), "headers/s")
+    Report("codec PackInto", Rate(codec_encode, count), "headers/s")
+
+def BenchPduBuild(count = 100000):
+    isid = pdu.ISID(raw = b"\x80\x04\x09\x00\x00\x01")
+
+    def setters():
+        l_pdu = pdu.LoginPDU()
+        l_pdu.Transit = True
+        l_pdu.CurrentStage = pdu.LoginPDU.LOGIN_OPERATIONAL_NEG
+        l_pdu.NextStage = pdu.LoginPDU.FULL_FEATURE_PHASE
+        l_pdu.ISID = isid
+        l_pdu.CID = 1
+        l_pdu.InitiatorTaskTag = 5
+        l_pdu.CmdSN = 7
+        l_pdu.ExpStatSN = 9
+        l_pdu.Release()
+
+    def encode():
+        l_pdu = pdu.LoginPDU()
+        l_pdu.Encode(Transit = True, CurrentStage = pdu.LoginPDU.LOGIN_OPERATIONAL_NEG,
+                     NextStage = pdu.LoginPDU.FULL_FEATURE_PHASE, ISID = isid.raw_data,
+                     CID = 1, InitiatorTaskTag = 5, CmdSN = 7, ExpStatSN = 9)
+        l_pdu.Release()
+
+    # header fields alone, without taking a pdu from pool and giving it back
+    l_pdu = pdu.LoginPDU()
+    def set_fields():
+        l_pdu.Transit = True
+        l_pdu.CurrentStage = pdu.LoginPDU.LOGIN_OPERATIONAL_NEG
+        l_pdu.NextStage = pdu.LoginPDU.FULL_FEATURE_PHASE
+        l_pdu.ISID = isid
+        l_pdu.CID = 1
+        l_pdu.InitiatorTaskTag = 5
+        l_pdu.CmdSN = 7
+        l_pdu.ExpStatSN = 9
+
+    def encode_fields():
+        l_pdu.Encode(Transit = True, CurrentStage = pdu.LoginPDU.LOGIN_OPERATIONAL_NEG,
+                     NextStage = pdu.LoginPDU.FULL_FEATURE_PHASE, ISID = isid.raw_data,
+                     CID = 1, InitiatorTaskTag = 5, CmdSN = 7, ExpStatSN = 9)
+
+    Report("login pdu with setters", Rate(setters, count), "pdus/s")
+    Report("login pdu with template + Encode", Rate(encode, count), "pdus/s")
+    Report("login header fields with setters", Rate(set_fields, count), "headers/s")
+    Report("login header fields with Encode", Rate(encode_fields, count), "headers/s")
+
+def BenchCrc32c(size = 1024 * 1024, count = 5):
+    data = bytes(range(256)) * (size // 256)
+    for name, crc32c in pdu.digest.BACKENDS.items():
+        rate = Rate(lambda: crc32c(data), count)
+        Report("crc32c %s" % name, rate * size / 1000000, "MB/s")
+
+def BenchCoalesce(count = 100000, batch = 64):
+    import session
+    from connection import SendBuffers
+    a, b = socket.socketpair()
+    def drain():
+        buf = bytearray(1 << 20)
+        while b.recv_into(buf) != 0:
+            pass
+    _thread.start_new_thread(drain, tuple())
+    nop = pdu.PDU(bytes(pdu.BHS.LENGTH))
+
+    def per_pdu():
+        SendBuffers(a, nop.Buffers())
+
+    def coalesced():
+        bufs = []
+        for i in range(batch):
+            bufs += nop.Buffers()
+        SendBuffers(a, bufs)
+
+    Report("one send per pdu", Rate(per_pdu, count), "pdus/s")
+    Report("coalesced, %d pdus per send" % batch, Rate(coalesced, count // batch) * batch, "pdus/s")
+    a.close()
+
+if __name__ == "__main__":
+    BenchHeaders()
+    BenchPduBuild()
+    BenchCrc32c()
+    BenchCoalesce()
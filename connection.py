@@ -17,12 +17,14 @@ import logging
 import socket
 import _thread
 import queue
+import threading
+import time
 import pdu
 import traceback
 from utils import dump
 import keys
 import events
-from session import InitSession
+import transport
 
 class Conn():
     STATE_FREE = 1
@@ -37,6 +39,136 @@ class Conn():
     def __init__(self):
         pass
 
+IOV_MAX = 1024 # buffers per sendmsg call
+
+def SendBuffers(soc, bufs):
+    '''
+    Send buffers with one sendmsg call per IOV_MAX buffers, without
+    concatenating them. Partial sends are resumed where they stopped.
+    @param soc: connected socket
+    @param bufs: list of bytes like objects
+    '''
+    if not hasattr(soc, "sendmsg"):
+        soc.sendall(b"".join(bufs))
+        return
+    bufs = [memoryview(b) for b in bufs if len(b) != 0]
+    i = 0
+    while i < len(bufs):
+        sent = soc.sendmsg(bufs[i:i + IOV_MAX])
+        while sent != 0:
+            n = bufs[i].nbytes
+            if sent >= n:
+                sent -= n
+                i += 1
+            else:
+                bufs[i] = bufs[i][sent:]
+                sent = 0
+
+# pdus whose StatSN advances the status sequence of connection
+STATUS_OPCODES = frozenset((pdu.BHS.OPCODE_SCSI_CMD_RES, pdu.BHS.OPCODE_TASK_MAN_RES,
+                            pdu.BHS.OPCODE_LOGIN_RES, pdu.BHS.OPCODE_TEXT_RES,
+                            pdu.BHS.OPCODE_LOGOUT_RES, pdu.BHS.OPCODE_ASYNC_MSG,
+                            pdu.BHS.OPCODE_REJECT))
+
+def StatusSN(recv_pdu):
+    '''
+    Returns StatSN of a received pdu carrying a status, None for pdus which
+    don't advance the status sequence
+    '''
+    opcode = recv_pdu.Opcode
+    if opcode in STATUS_OPCODES:
+        pass
+    elif opcode == pdu.BHS.OPCODE_DATA_IN:
+        if not recv_pdu.StatusPresent:
+            return None
+    elif opcode == pdu.BHS.OPCODE_NOP_IN:
+        if recv_pdu.InitiatorTaskTag == 0xFFFFFFFF:
+            return None
+    else:
+        return None
+    return pdu.U32.unpack_from(recv_pdu.data, 24)[0]
+
+class RecvBuffer():
+    '''
+    Frames PDUs received from a socket. Data is read with recv_into into a
+    preallocated buffer and complete PDUs are handed out as memoryview
+    slices of it, so several PDUs can be framed from one read without
+    copying. When the buffer runs out of room a new one is allocated and
+    only the incomplete tail is moved, views handed out before stay valid.
+    '''
+    DEFAULT_SIZE = 256 * 1024
+    MIN_READ = 4096
+    
+    def __init__(self, size = DEFAULT_SIZE):
+        self.__size = size
+        self.__buf = bytearray(size)
+        self.__view = memoryview(self.__buf)
+        self.__start = 0 # beginning of pdu being framed
+        self.__end = 0 # end of received data
+        self.__need = pdu.BHS.LENGTH # length of pdu being framed
+        self.__h_digest = 0 # length of digests on the wire
+        self.__d_digest = 0
+        
+    def SetDigests(self, header_digest, data_digest):
+        '''
+        Frame following pdus with header and/or data digests
+        '''
+        self.__h_digest = pdu.digest.LENGTH if header_digest else 0
+        self.__d_digest = pdu.digest.LENGTH if data_digest else 0
+        
+    def __Swap(self, length):
+        # move pending bytes to the beginning of a new buffer
+        pending = self.__end - self.__start
+        buf = bytearray(max(self.__size, length))
+        buf[:pending] = self.__view[self.__start:self.__end]
+        self.__buf = buf
+        self.__view = memoryview(buf)
+        self.__start = 0
+        self.__end = pending
+        
+    def GetBuffer(self):
+        '''
+        Returns writable view of free space to receive into, it has room for
+        the pdu being framed, asyncio.BufferedProtocol.get_buffer
+        '''
+        free = len(self.__buf) - self.__end
+        if free < self.MIN_READ or self.__start + self.__need > len(self.__buf):
+            self.__Swap(self.__need)
+        return self.__view[self.__end:]
+    
+    def Advance(self, n):
+        '''
+        Mark n bytes received into view of GetBuffer
+        '''
+        self.__end += n
+        
+    def Fill(self, soc):
+        '''
+        Read as many bytes as socket has, returns 0 when peer closed
+        @param soc: socket to read from
+        '''
+        n = soc.recv_into(self.GetBuffer())
+        self.Advance(n)
+        return n
+    
+    def Frames(self):
+        '''
+        Generates memoryview of each complete PDU in buffer
+        '''
+        while self.__end - self.__start >= pdu.BHS.LENGTH:
+            w = pdu.U32.unpack_from(self.__buf, self.__start + 4)[0]
+            dsl = w & 0xFFFFFF
+            length = pdu.BHS.LENGTH + (w >> 24) * 4 + self.__h_digest + ((dsl + 3) & ~3)
+            if dsl != 0:
+                length += self.__d_digest
+            if self.__end - self.__start < length:
+                self.__need = length
+                return
+            start = self.__start
+            self.__start += length
+            yield self.__view[start:self.__start]
+        self.__need = pdu.BHS.LENGTH
+        
 class InitConn(Conn):
     # logger for initiator connection
     logger = logging.getLogger("Init Con")
@@ -48,6 +180,10 @@ class InitConn(Conn):
     # default port number
     DEFAULT_PORT = 3260 # for iscsi
     
+    # sender coalescing defaults
+    COALESCE_BYTES = 256 * 1024 # max bytes written with one SendBuffers call
+    FLUSH_DELAY = 0 # seconds to wait for more pdus before writing a batch
+    
     EVENT_CLOSE_SESSION = 1 # logout reesp on another connection for "close session" T18 T13 T8 T7 T2
     EVENT_UNSUCC_LOGOUT_RESP = 2 # logout response with failure nonzero status T17
     EVENT_XPT_TOUT = 3 # transport timeout T17 T7
@@ -66,24 +202,31 @@ class InitConn(Conn):
     class Msg():
         ID_PDU = 0
         ID_EXIT = 1
-        def __init__(self, id, data = None):
+        def __init__(self, id, data = None, release = False):
             self.id = id
             self.data = data
+            self.release = release
     
-    def __init__(self, portal, event_listener, session, cid):
+    def __init__(self, portal, event_listener, session, cid, options = None):
         '''
         Initiator connection constructor
-        @param portal: ip or domain name of port
+        @param portal: ip or domain name of port, a portal of another transport
+        like "unix:/path" or a connected socket like object
         @param event_listener: events will be sent to that listener
+        @param options: transport.TransportOptions for socket tuning and connect timeout
         '''
         super().__init__()
         self.__state = self.STATE_FREE
+        self.__soc = None # until transport is opened
         
-        pindex = portal.find(":")
-        if pindex == -1:
-            portal += ":" + str(self.DEFAULT_PORT)
-            pindex = portal.find(":")
-        self.__soc = socket.create_connection((portal[:pindex], portal[pindex + 1:]))
+        if options == None:
+            options = transport.TransportOptions()
+        self.__options = options
+        self.__portal = portal
+        if isinstance(portal, str):
+            self.__soc = transport.Open(portal, self.DEFAULT_PORT, options)
+        else:
+            self.__soc = portal
         self.__cid = cid
         self.__expstatsn = -1
         self.__session = session
@@ -93,78 +236,150 @@ class InitConn(Conn):
         self.__cs = pdu.LoginPDU.SECURITY_NEG
         self.__ns = pdu.LoginPDU.LOGIN_OPERATIONAL_NEG
         
+        self.__header_digest = False
+        self.__data_digest = False
+        self.__rbuf = RecvBuffer()
+        self.__coalesce_bytes = self.COALESCE_BYTES
+        self.__flush_delay = self.FLUSH_DELAY
+        # load of connection, commands are dispatched by them
+        self.__lock = threading.Lock()
+        self.__outstanding = 0
+        self.__bytes_in_flight = 0
+        
         self.__listener = event_listener
         self.__senderq = queue.Queue(0)
         self.__sender_tid = _thread.start_new_thread(self.__SenderThread, tuple())
         self.__recv_tid = _thread.start_new_thread(self.__RecvThread, tuple())    
         
     def __del__(self):
-        # close socket
+        self.Close()
+        
+    def Close(self):
+        '''
+        Close transport and stop threads of connection, receiver thread
+        reports connection lost once it's woken up
+        '''
+        if self.__soc == None:
+            return # transport couldn't be opened
+        try:
+            # close alone doesn't wake up a thread blocked in recv
+            self.__soc.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass # not connected anymore
         self.__soc.close()
         self.__senderq.put_nowait(self.Msg(self.Msg.ID_EXIT))
-        
-        # kill threads
-        pass
             
+    def __UpdateStatSN(self, recv_pdu):
+        # ExpStatSN acknowledges statuses received, it's last StatSN + 1
+        statsn = StatusSN(recv_pdu)
+        if statsn != None:
+            self.__expstatsn = (statsn + 1) & 0xFFFFFFFF
+        
     def __ProcessPDU(self, recv_pdu):
+        self.__UpdateStatSN(recv_pdu)
         print("PDU (0x%x) received" % recv_pdu.Opcode)
+        if recv_pdu.Opcode == pdu.BHS.OPCODE_NOP_IN and recv_pdu.InitiatorTaskTag == 0xFFFFFFFF \
+           and recv_pdu.TargetTransferTag != 0xFFFFFFFF:
+            self.__listener.Signal(events.Event(events.Event.ID_PING, (self, recv_pdu)))
+            return
         self.__listener.Signal(events.Event(events.Event.ID_PDU_RECV, recv_pdu))
     
+    def __NextMsg(self, deadline):
+        # next queued message, waiting until deadline when flush_delay is set
+        try:
+            return self.__senderq.get_nowait()
+        except queue.Empty:
+            if deadline == None:
+                return None
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            try:
+                return self.__senderq.get(True, remaining)
+            except queue.Empty:
+                return None
+    
     def __SenderThread(self):
+        # pdus queued while previous batch was being sent are coalesced and
+        # written with a single SendBuffers call, up to coalesce_bytes
         try:
-            while True:
+            exit = False
+            while not exit:
                 msg = self.__senderq.get(True)
-                if msg.id == self.Msg.ID_PDU:
+                deadline = None
+                if self.__flush_delay > 0:
+                    deadline = time.monotonic() + self.__flush_delay
+                bufs = []
+                sent = []
+                size = 0
+                while msg != None:
+                    if msg.id != self.Msg.ID_PDU:
+                        exit = True
+                        break
                     out_pdu = msg.data
                     if self.__expstatsn != -1:
                         out_pdu.ExpStatSN = self.__expstatsn
-                        self.__expstatsn += 1
-                        self.__expstatsn &= 0xFFFFFFFF
-                    self.__soc.send(out_pdu.raw_data)
-                else:
-                    break
+                    out_pdu.header_digest = self.__header_digest
+                    out_pdu.data_digest = self.__data_digest
+                    pdu_bufs = out_pdu.Buffers()
+                    bufs += pdu_bufs
+                    sent += [msg]
+                    for b in pdu_bufs:
+                        size += len(b)
+                    if size >= self.__coalesce_bytes:
+                        break
+                    msg = self.__NextMsg(deadline)
+                if len(bufs) != 0:
+                    SendBuffers(self.__soc, bufs)
+                for msg in sent:
+                    if msg.release:
+                        msg.data.Release()
         except:
             traceback.print_exc()    
         print("connection sender thread exits") 
     
     def __RecvThread(self):
         try:
-            read_len = pdu.BHS.LENGTH
-            max_read_len = pdu.BHS.LENGTH
-            data = b""
-            bhs = None
+            rbuf = self.__rbuf
+            quickack = self.__options.quickack and transport.IsTcp(self.__soc)
             while True:
-                #print ("read_len %d, max_read_len %d, len(data) %d" % (read_len, max_read_len, len(data)))
-                data += self.__soc.recv(read_len)
-                if len(data) < max_read_len:
-                    # read more
-                    read_len = max_read_len - len(data)
-                    continue
-                if bhs == None:
-                    bhs = pdu.BHS(data)
-                    max_read_len = pdu.BHS.LENGTH + bhs.TotalAHSLength + bhs.DataSegmentLength
-                    if max_read_len % 4 != 0:
-                        max_read_len += 4 - max_read_len % 4
-                    read_len = max_read_len - read_len
-                    
-                if len(data) != max_read_len:
-                    continue
-                
-                recv_pdu = pdu.PDU(data)
-                self.__ProcessPDU(recv_pdu)
-                
-                bhs = None
-                read_len = pdu.BHS.LENGTH
-                max_read_len = pdu.BHS.LENGTH
-                data = b""
+                if rbuf.Fill(self.__soc) == 0:
+                    break # connection closed by target
+                if quickack:
+                    transport.QuickAck(self.__soc)
+                for data in rbuf.Frames():
+                    recv_pdu = pdu.PDU.Create(data, self.__header_digest, self.__data_digest)
+                    if not recv_pdu.CheckHeaderDigest():
+                        # pdu boundaries can't be trusted anymore
+                        self.logger.error("header digest error, closing connection")
+                        self.__soc.close()
+                        return
+                    if not recv_pdu.CheckDataDigest():
+                        self.logger.error("data digest error, pdu (0x%x) is discarded" % recv_pdu.Opcode)
+                        continue
+                    self.__ProcessPDU(recv_pdu)
         except:
             traceback.print_exc()
+        finally:
+            # outstanding commands of connection can't complete anymore
+            self.__listener.Signal(events.Event(events.Event.ID_CONN_LOST, self))
         print("connection receiver thread exits")
             
     @property
     def auth_method(self):
         return self.__auth
 
+    @property
+    def options(self):
+        return self.__options
+
+    @property
+    def portal(self):
+        '''
+        Address connection is opened to, socket like object if it's given
+        '''
+        return self.__portal
+
     @property
     def cid(self):
         return self.__cid
@@ -177,14 +392,68 @@ class InitConn(Conn):
     def keys(self):
         return self.__keys
     
+    @property
+    def header_digest(self):
+        return self.__header_digest
+    
+    @header_digest.setter
+    def header_digest(self, h_digest):
+        self.__header_digest = h_digest
+        self.__rbuf.SetDigests(self.__header_digest, self.__data_digest)
+    
+    @property
+    def data_digest(self):
+        return self.__data_digest
+    
+    @data_digest.setter
+    def data_digest(self, d_digest):
+        self.__data_digest = d_digest
+        self.__rbuf.SetDigests(self.__header_digest, self.__data_digest)
+    
+    @property
+    def coalesce_bytes(self):
+        return self.__coalesce_bytes
+    
+    @coalesce_bytes.setter
+    def coalesce_bytes(self, coalesce_bytes):
+        self.__coalesce_bytes = coalesce_bytes
+    
+    @property
+    def flush_delay(self):
+        return self.__flush_delay
+    
+    @flush_delay.setter
+    def flush_delay(self, flush_delay):
+        '''
+        @param flush_delay: seconds the sender waits for more pdus to batch,
+        trades latency for fewer syscalls, 0 writes as soon as queue is drained
+        '''
+        self.__flush_delay = flush_delay
+    
+    @property
+    def outstanding(self):
+        return self.__outstanding
+    
+    @property
+    def bytes_in_flight(self):
+        return self.__bytes_in_flight
+    
+    def Account(self, cmds, nbytes):
+        '''
+        Add to outstanding commands and bytes in flight, negative when
+        commands complete
+        '''
+        with self.__lock:
+            self.__outstanding += cmds
+            self.__bytes_in_flight += nbytes
+    
     @property
     def expstatsn(self):
         return self.__expstatsn
     
     @expstatsn.setter
     def expstatsn(self, expstatsn):
-        if self.__expstatsn == -1:
-            self.__expstatsn = expstatsn
+        self.__expstatsn = expstatsn & 0xFFFFFFFF
         
     def ProcessEvent(self, event):
         if not isinstance(event, int):
@@ -228,6 +497,8 @@ class InitConn(Conn):
             event == self.EVENT_XPT_DISCONN or event == self.EVENT_ASYNC_DROP_CONN or \
             event == self.EVENT_ASYNC_DROP_ALL:
                 self.__state = self.STATE_CLEANUP_WAIT
+            elif event == self.EVENT_SUCC_LOGOUT_RESP: # T13
+                self.__state = self.STATE_FREE
             elif event == self.EVENT_ASYNC_LOGOUT: # T14
                 pass
             else:
@@ -247,8 +518,12 @@ class InitConn(Conn):
         else:
             pass
         
-    def SendPdu(self, pdu):
-        self.__senderq.put_nowait(self.Msg(self.Msg.ID_PDU, pdu))
+    def SendPdu(self, pdu, release = False):
+        '''
+        Queue pdu to be sent
+        @param release: give pdu buffers back to pool once it's sent
+        '''
+        self.__senderq.put_nowait(self.Msg(self.Msg.ID_PDU, pdu, release))
         
 
 class TargetConn(Conn):
@@ -0,0 +1,224 @@
+#!/usr/bin/python3
+# Copyright (c) 2015. Harun Emektar
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import logging
+import threading
+import _thread
+import time
+import traceback
+import concurrent.futures
+
+class DiscoveryCache():
+    '''
+    SendTargets results of portals shared by their users. A result is
+    fresh for ttl seconds; for stale seconds more it's still returned
+    while a refresh runs in background. Older or missing results are
+    fetched before returning, callers asking for the same portal meanwhile
+    wait for that one fetch. Targets of all results are indexed by name
+    and by (address, tpgt).
+    @param fetch: called with a portal in a thread of its own, returns list
+    of initiator.TargetInfo or raises
+    @param ttl: seconds a result is fresh
+    @param stale: seconds a result is returned after it's stale
+    '''
+    # logger for discovery cache
+    logger = logging.getLogger("Discovery Cache")
+    logger.setLevel(logging.DEBUG)
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.DEBUG)
+    logger.addHandler(ch)
+
+    class Entry():
+        def __init__(self):
+            self.targets = None # last result
+            self.fetched = None # time of last result
+            self.future = None # fetch in progress
+
+    def __init__(self, fetch, ttl = 60, stale = 300):
+        self.__fetch = fetch
+        self.__ttl = ttl
+        self.__stale = stale
+        self.__lock = threading.Lock()
+        self.__entries = {} # portal:Entry
+        self.__by_name = {} # name:{portal:TargetInfo}
+        self.__by_addr = {} # (addr, tpgt):{(portal, name):TargetInfo}
+
+    def __Index(self, portal, old, new):
+        # replace targets of portal in indexes, caller holds lock
+        for targets, add in ((old, False), (new, True)):
+            for target in targets or []:
+                by_portal = self.__by_name.setdefault(target.name, {})
+                if add:
+                    by_portal[portal] = target
+                else:
+                    by_portal.pop(portal, None)
+                    if len(by_portal) == 0:
+                        del self.__by_name[target.name]
+                for addr in target.addr_list:
+                    akey = (addr.addr, addr.tpgt)
+                    by_target = self.__by_addr.setdefault(akey, {})
+                    if add:
+                        by_target[(portal, target.name)] = target
+                    else:
+                        by_target.pop((portal, target.name), None)
+                        if len(by_target) == 0:
+                            del self.__by_addr[akey]
+
+    def __FetchThread(self, portal, entry, future):
+        try:
+            targets = self.__fetch(portal)
+        except Exception as e:
+            with self.__lock:
+                entry.future = None
+            self.logger.warn("discovery of %s failed, %s" % (portal, e))
+            future.set_exception(e)
+            return
+        except:
+            traceback.print_exc()
+            return
+        with self.__lock:
+            if self.__entries.get(portal) is entry:
+                self.__Index(portal, entry.targets, targets)
+            entry.targets = targets
+            entry.fetched = time.monotonic()
+            entry.future = None
+        future.set_result(targets)
+
+    def __Refresh(self, portal, entry):
+        # returns future of fetch of portal, one runs at a time; caller holds lock
+        if entry.future == None:
+            entry.future = concurrent.futures.Future()
+            _thread.start_new_thread(self.__FetchThread, (portal, entry, entry.future))
+        return entry.future
+
+    def Get(self, portal, timeout = None):
+        '''
+        Returns list of initiator.TargetInfo of portal, exception of fetch is
+        raised if there is no result to return
+        '''
+        with self.__lock:
+            entry = self.__entries.get(portal)
+            if entry == None:
+                entry = self.__entries[portal] = self.Entry()
+            if entry.targets != None:
+                age = time.monotonic() - entry.fetched
+                if age < self.__ttl:
+                    return entry.targets
+                if age < self.__ttl + self.__stale:
+                    self.__Refresh(portal, entry) # stale while revalidate
+                    return entry.targets
+            future = self.__Refresh(portal, entry)
+        return future.result(timeout)
+
+    def Lookup(self, name):
+        '''
+        Returns list of initiator.TargetInfo named name, one per portal
+        reporting it
+        '''
+        with self.__lock:
+            return list(self.__by_name.get(name, {}).values())
+
+    def LookupAddress(self, addr, tpgt):
+        '''
+        Returns list of initiator.TargetInfo reachable on portal address of
+        portal group tpgt
+        @param addr: "ip:port" as given in TargetAddress
+        '''
+        with self.__lock:
+            return list(self.__by_addr.get((addr, tpgt), {}).values())
+
+    def Invalidate(self, portal = None):
+        '''
+        Forget result of portal, of all portals if None
+        '''
+        with self.__lock:
+            portals = list(self.__entries) if portal == None else [portal]
+            for portal in portals:
+                entry = self.__entries.pop(portal, None)
+                if entry != None:
+                    self.__Index(portal, entry.targets, None)
+
+if __name__ == "__main__":
+    import unittest
+    from initiator import ParseTargets
+
+    class TestDiscoveryCache(unittest.TestCase):
+        TEXT = (b"TargetName=iqn.2020-01.t:1\x00TargetAddress=10.0.0.1:3260,1\x00"
+                b"TargetAddress=10.0.1.1:3260,2\x00TargetName=iqn.2020-01.t:2\x00"
+                b"TargetAddress=10.0.0.1:3260,1\x00")
+
+        def setUp(self):
+            self.fetches = []
+            self.gate = threading.Event()
+            self.gate.set()
+
+        def Fetch(self, portal):
+            self.fetches += [portal]
+            self.gate.wait()
+            if portal == "bad":
+                raise ConnectionError("refused")
+            return ParseTargets(self.TEXT)
+
+        def testIndexes(self):
+            cache = DiscoveryCache(self.Fetch)
+            self.assertEqual(len(cache.Get("10.0.0.1")), 2)
+            self.assertEqual(len(cache.Get("10.0.1.1")), 2)
+            self.assertEqual(len(cache.Lookup("iqn.2020-01.t:1")), 2)
+            self.assertEqual(sorted(t.name for t in cache.LookupAddress("10.0.0.1:3260", 1)),
+                             ["iqn.2020-01.t:1", "iqn.2020-01.t:1", "iqn.2020-01.t:2", "iqn.2020-01.t:2"])
+            self.assertEqual(len(cache.LookupAddress("10.0.1.1:3260", 2)), 2)
+            cache.Invalidate("10.0.1.1")
+            self.assertEqual(len(cache.Lookup("iqn.2020-01.t:1")), 1)
+            cache.Invalidate()
+            self.assertEqual(cache.Lookup("iqn.2020-01.t:1"), [])
+            self.assertEqual(cache.LookupAddress("10.0.0.1:3260", 1), [])
+
+        def testSingleFetch(self):
+            cache = DiscoveryCache(self.Fetch)
+            self.gate.clear()
+            results = []
+            threads = [threading.Thread(target = lambda: results.append(cache.Get("10.0.0.1")))
+                       for i in range(8)]
+            for thread in threads:
+                thread.start()
+            time.sleep(0.05)
+            self.gate.set()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(len(self.fetches), 1)
+            self.assertEqual(len(results), 8)
+
+        def testStaleWhileRevalidate(self):
+            cache = DiscoveryCache(self.Fetch, ttl = 0.05, stale = 10)
+            first = cache.Get("10.0.0.1")
+            self.assertIs(cache.Get("10.0.0.1"), first)
+            time.sleep(0.06)
+            self.gate.clear()
+            self.assertIs(cache.Get("10.0.0.1"), first) # stale one, refresh is in background
+            self.assertIs(cache.Get("10.0.0.1"), first)
+            time.sleep(0.02)
+            self.assertEqual(len(self.fetches), 2)
+            self.gate.set()
+            time.sleep(0.05)
+            self.assertIsNot(cache.Get("10.0.0.1"), first)
+            self.assertEqual(len(self.fetches), 2)
+
+        def testError(self):
+            cache = DiscoveryCache(self.Fetch)
+            self.assertRaises(ConnectionError, cache.Get, "bad")
+            self.assertRaises(ConnectionError, cache.Get, "bad")
+            self.assertEqual(len(self.fetches), 2)
+
+    unittest.main()
@@ -14,6 +14,7 @@
 #
 
 import queue
+import concurrent.futures
 
 class Event():
     ID_EMPTY_QUEUE = 0
@@ -21,6 +22,8 @@ class Event():
     ID_LOGGED_IN = 2
     ID_TEXT_RESP = 3
     ID_LOGGED_OUT = 4
+    ID_CONN_LOST = 5
+    ID_PING = 6 # target pings a connection, reply is expected on it
     def __init__(self, id, data = None):
         self.__id = id
         self.__data = data
@@ -49,4 +52,16 @@ class EventListener():
     
     def Signal(self, event):
         self.__queue.put_nowait(event)
-    
\ No newline at end of file
+    
+
+def WaitAll(futures, timeout = None):
+    '''
+    Wait for futures of commands, returns (done, not_done) sets
+    '''
+    return concurrent.futures.wait(futures, timeout)
+
+def AsCompleted(futures, timeout = None):
+    '''
+    Iterate futures of commands as they complete
+    '''
+    return concurrent.futures.as_completed(futures, timeout)
@@ -13,10 +13,18 @@
 # limitations under the License.
 #
 
-from session import InitSession
+from session import InitSession, LoginError
+from pool import SessionPool
+from discovery import DiscoveryCache
 import logging
-import events
+import queue
+import threading
+import time
+import copy
+import concurrent.futures
 import keys
+import transport
+import pdu
 from utils import ntoi
 
 class TargetAddrInfo():
@@ -46,6 +54,175 @@ class TargetInfo():
     def addr_list(self):
         return self.__addr_list
 
+class LoginResult():
+    '''
+    Outcome of a session of a bulk login
+    @param session: logged in session, None if it failed
+    @param latency: seconds from connecting to end of login
+    @param error: exception login failed with
+    '''
+    def __init__(self, portal, session, latency, error = None):
+        self.__portal = portal
+        self.__session = session
+        self.__latency = latency
+        self.__error = error
+
+    @property
+    def portal(self):
+        return self.__portal
+
+    @property
+    def session(self):
+        return self.__session
+
+    @property
+    def latency(self):
+        return self.__latency
+
+    @property
+    def error(self):
+        return self.__error
+
+class DiscoveryResult():
+    '''
+    Outcome of discovery of a portal of a fan-out discovery
+    @param targets: list of TargetInfo reported by portal, None if it failed
+    @param latency: seconds discovery of portal took
+    @param error: exception discovery failed with
+    '''
+    def __init__(self, portal, targets, latency, error = None):
+        self.__portal = portal
+        self.__targets = targets
+        self.__latency = latency
+        self.__error = error
+
+    @property
+    def portal(self):
+        return self.__portal
+
+    @property
+    def targets(self):
+        return self.__targets
+
+    @property
+    def latency(self):
+        return self.__latency
+
+    @property
+    def error(self):
+        return self.__error
+
+class TargetInfoParser():
+    '''
+    Builds TargetInfo from pieces of SendTargets response, a target is
+    complete once the next one starts or response ends
+    '''
+    def __init__(self):
+        self.__parser = keys.KeyParser()
+        self.__target = None
+        
+    def __Add(self, parsed):
+        retval = []
+        for t in parsed:
+            if isinstance(t, keys.TargetName):
+                if self.__target != None:
+                    retval += [self.__target]
+                self.__target = TargetInfo(t.value, [])
+            elif isinstance(t, keys.TargetAddress) and self.__target != None:
+                self.__target.addr_list.append(TargetAddrInfo(t.address, t.tpgt))
+            else:
+                Initiator.logger.error("dicovery response isn't in correct format")
+        return retval
+    
+    def Feed(self, chunk):
+        '''
+        Returns list of TargetInfo completed by chunk
+        '''
+        return self.__Add(self.__parser.Feed(chunk))
+    
+    def Close(self):
+        '''
+        Returns list of TargetInfo left at end of response
+        '''
+        retval = self.__Add(self.__parser.Close())
+        if self.__target != None:
+            retval += [self.__target]
+            self.__target = None
+        return retval
+
+def IterTargets(chunks):
+    '''
+    Generates TargetInfo from pieces of SendTargets response as they complete
+    @param chunks: iterable of bytes like pieces of response
+    '''
+    parser = TargetInfoParser()
+    for chunk in chunks:
+        yield from parser.Feed(chunk)
+    yield from parser.Close()
+
+def ParseTargets(text):
+    '''
+    Returns list of TargetInfo from SendTargets response text
+    '''
+    return list(IterTargets([text]))
+
+def Discover(init, portal, options = None, timeout = None):
+    '''
+    Returns list of TargetInfo of portal, a discovery session is logged in
+    and out for it. Raises LoginError or OSError when it fails,
+    TimeoutError when it takes longer than timeout seconds.
+    @param init: Initiator, its name is used in login
+    '''
+    deadline = None
+    if timeout != None:
+        deadline = time.monotonic() + timeout
+        options = transport.TransportOptions() if options == None else copy.copy(options)
+        if options.connect_timeout == None or options.connect_timeout > timeout:
+            options.connect_timeout = timeout
+    def Wait(future):
+        try:
+            return future.result(None if deadline == None else max(deadline - time.monotonic(), 0))
+        except concurrent.futures.TimeoutError:
+            raise TimeoutError("no answer in %g seconds" % timeout)
+    session = InitSession(init, portal, None, options)
+    try:
+        future = session.Login()
+        if future == None:
+            raise ConnectionError("discovery session to %s can't log in" % portal)
+        Wait(future)
+        try:
+            text = Wait(session.SendText("SendTargets=All"))
+        finally:
+            future = session.Logout()
+            if future != None:
+                try:
+                    Wait(future)
+                except (ConnectionError, TimeoutError):
+                    pass
+    finally:
+        # threads and socket of session go with it, also when it's given up
+        session.Close()
+    return ParseTargets(text)
+
+def MergeTargets(target_lists):
+    '''
+    Returns list of TargetInfo with one per target name, addresses of a
+    target reported by several portals are combined without duplicates.
+    Targets and addresses keep the order they are first seen in.
+    @param target_lists: iterable of lists of TargetInfo
+    '''
+    merged = {} # name:(TargetInfo, set of (addr, tpgt))
+    for targets in target_lists:
+        for target in targets:
+            if target.name not in merged:
+                merged[target.name] = (TargetInfo(target.name, []), set())
+            info, seen = merged[target.name]
+            for addr in target.addr_list:
+                if (addr.addr, addr.tpgt) not in seen:
+                    seen.add((addr.addr, addr.tpgt))
+                    info.addr_list.append(addr)
+    return [info for info, seen in merged.values()]
+
 class Initiator():
     # logger for initiator
     logger = logging.getLogger("Initiator")
@@ -70,22 +247,123 @@ class Initiator():
             raise TypeError
         self.__name = name
         self.__sessions = []
-        self.__event_listener = events.EventListener()
+        self.__lock = threading.Lock() # sessions are added by bulk logins
         
     @property
     def name(self):
         return self.__name
     
-    @property
-    def evt_lisener(self):
-        return self.__event_listener
-            
-    def Connect(self, portal):
+    def Connect(self, portal, options = None, tgt_name = None, policy = None):
         '''
         Connect to a portal
         @param portal: ip or domain name of portal
+        @param options: transport.TransportOptions, socket options and connect timeout
+        @param tgt_name: target for a normal session, discovery session if None
+        @param policy: dispatch policy for connections added later, see policy module
+        '''
+        self.__sessions += [InitSession(self, portal, tgt_name, options, policy = policy)]
+        
+    def LoginAll(self, portals, tgt_name = None, count = None, concurrency = 64, options = None,
+                 policy = None, timeout = None):
+        '''
+        Open and log in many sessions at once, at most concurrency of them
+        are connecting or logging in at a time. Returns list of LoginResult
+        in order sessions are asked for, logged in ones are added to
+        sessions of initiator. Each session runs its own threads, see
+        aio.AsyncInitiator for thousands of sessions.
+        @param portals: a portal or list of them sessions are spread over in turn
+        @param count: number of sessions, one per portal if None
+        @param timeout: seconds a session is given to log in, it's closed and
+        fails with TimeoutError after it
+        '''
+        if isinstance(portals, str):
+            portals = [portals]
+        if count == None:
+            count = len(portals)
+        def Open(portal):
+            start = time.monotonic()
+            session = None
+            try:
+                session = InitSession(self, portal, tgt_name, options, policy = policy)
+                future = session.Login()
+                if future == None:
+                    raise ConnectionError("session to %s can't log in" % portal)
+                try:
+                    future.result(timeout)
+                except concurrent.futures.TimeoutError:
+                    raise TimeoutError("no answer in %g seconds" % timeout)
+            except (LoginError, OSError) as e:
+                # a failed session mustn't keep its threads and socket
+                if session != None:
+                    session.Close()
+                return LoginResult(portal, None, time.monotonic() - start, e)
+            with self.__lock:
+                self.__sessions += [session]
+            return LoginResult(portal, session, time.monotonic() - start)
+        with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+            return list(executor.map(Open, [portals[i % len(portals)] for i in range(count)]))
+        
+    def DiscoverAll(self, portals, concurrency = 64, timeout = 10, options = None, cache = None):
+        '''
+        Discover many portals at once, at most concurrency of them are
+        discovered at a time and each is given up after timeout seconds,
+        its session is closed then.
+        Returns (targets, results): TargetInfo of all portals merged by
+        MergeTargets, and list of DiscoveryResult in order of portals.
+        @param portals: list of portals, repeated ones are discovered once
+        @param cache: discovery.DiscoveryCache results are taken from, its
+        fetch isn't bounded by timeout, only waiting for it is
+        '''
+        portals = list(dict.fromkeys(portals))
+        def Fetch(portal):
+            start = time.monotonic()
+            try:
+                if cache != None:
+                    targets = cache.Get(portal, timeout)
+                else:
+                    targets = Discover(self, portal, options, timeout)
+            except (LoginError, OSError, concurrent.futures.TimeoutError) as e:
+                self.logger.warn("discovery of %s failed, %s" % (portal, e))
+                return DiscoveryResult(portal, None, time.monotonic() - start, e)
+            return DiscoveryResult(portal, targets, time.monotonic() - start)
+        with concurrent.futures.ThreadPoolExecutor(max(min(concurrency, len(portals)), 1)) as executor:
+            results = list(executor.map(Fetch, portals))
+        return MergeTargets(r.targets for r in results if r.error == None), results
+        
+    def CreatePool(self, max_total = 64, max_idle = 16, keepalive = 30, idle_timeout = None,
+                   options = None):
+        '''
+        Returns a pool.SessionPool handing out logged in sessions of
+        initiator for reuse, instead of a login per Connect
+        '''
+        return SessionPool(self, max_total, max_idle, keepalive, idle_timeout, options)
+        
+    def CreateDiscoveryCache(self, ttl = 60, stale = 300, options = None, timeout = 10):
+        '''
+        Returns a discovery.DiscoveryCache of SendTargets results of
+        portals, portals are discovered once per ttl by all of its users
+        @param timeout: seconds a fetch of portal is given, a refresh of a
+        portal not answering fails with TimeoutError after it
+        '''
+        return DiscoveryCache(lambda portal: Discover(self, portal, options, timeout), ttl, stale)
+        
+    def AddConnection(self, portal, options = None):
+        '''
+        Add a connection to first session after it has logged in, its
+        commands are spread over all of its connections
+        @param portal: ip or domain name of portal of the same target
         '''
-        self.__sessions += [InitSession(self, portal)]
+        if len(self.__sessions) == 0:
+            self.logger.warn("No session to add connection")
+            return self.RET_NO_CONN
+        future = self.__sessions[0].AddConnection(portal, options)
+        if future == None:
+            return self.RET_FAIL
+        try:
+            future.result()
+            return self.RET_SUCCESS
+        except (LoginError, ConnectionError):
+            return self.RET_LOGIN_FAIL
         
     def Login(self, portal = None, tgt_name = None):
         '''
@@ -97,58 +375,207 @@ class Initiator():
             if len(self.__sessions) == 0:
                 self.logger.warn("No connection to perform login")
             else:
-                self.__sessions[0].Login()
-                evnt = self.__event_listener.Wait()
-                if evnt.id == evnt.ID_LOGGED_IN:
+                future = self.__sessions[0].Login()
+                if future == None:
+                    return self.RET_LOGIN_FAIL
+                try:
+                    future.result()
                     return self.RET_SUCCESS
-                else:
+                except (LoginError, ConnectionError):
                     return self.RET_LOGIN_FAIL
         
     
-    def Discovery(self, portal = None):
+    def Discovery(self, portal = None, options = None):
         '''
         Make discovery on given portal
-        @param portal: ip or domain name of portal
+        @param portal: ip or domain name of portal, a discovery session is
+        opened and closed for it, first session is used if None
         '''
+        if portal != None:
+            try:
+                return Discover(self, portal, options)
+            except (LoginError, OSError):
+                return self.RET_LOGIN_FAIL
         if portal == None: # use first session
             if len(self.__sessions) == 0:
                 self.logger.warn("No connection to perform Discovery")
             else:
                 session = self.__sessions[0]
                 if session.state == InitSession.STATE_LOGGED_IN:
-                    session.SendText("SendTargets=All")
-                    event = self.__event_listener.Wait()
-                    # parse text response
-                    targets = keys.ParsePayload(event.data)
-                    if event.id == event.ID_TEXT_RESP:
-                        t = event.data
-                        targets = keys.ParsePayload(t)
-                        t_name = None
-                        retval = []
-                        for t in targets:
-                            if isinstance(t, keys.TargetName):
-                                t_name = t.value
-                                retval += [TargetInfo(t_name, [])]
-                            elif isinstance(t, keys.TargetAddress):
-                                retval[-1].addr_list.append(TargetAddrInfo(t.address, t.tpgt))
-                                t_name = None
-                            else:
-                                self.logger.error("dicovery response isn't in correct format")
-                        return retval
+                    future = session.SendText("SendTargets=All")
+                    try:
+                        text = future.result()
+                    except ConnectionError:
+                        text = None
+                    if text != None:
+                        return ParseTargets(text)
 
                     else:
                         return self.RET_LOGIN_FAIL
                     
+    def IterDiscovery(self):
+        '''
+        Make discovery on first session, TargetInfo are generated while
+        response is still arriving. ConnectionError is raised if session
+        fails before response is complete.
+        '''
+        if len(self.__sessions) == 0:
+            self.logger.warn("No connection to perform Discovery")
+            return
+        chunks = queue.Queue(0)
+        future = self.__sessions[0].SendText("SendTargets=All", chunks.put)
+        if future == None:
+            return
+        future.add_done_callback(lambda f: chunks.put(None))
+        def Chunks():
+            chunk = chunks.get()
+            while chunk != None:
+                yield chunk
+                chunk = chunks.get()
+        yield from IterTargets(Chunks())
+        future.result()
+                    
+    def SubmitRead(self, lba, blocks, buf, lun = 0, read16 = False):
+        '''
+        Queue a read on first session without waiting, returns future of
+        ScsiTask or None, submitting many keeps the CmdSN window full
+        '''
+        if len(self.__sessions) == 0:
+            self.logger.warn("No connection to read")
+            return None
+        return self.__sessions[0].Read(lba, blocks, buf, lun, read16)
+    
+    def Read(self, lba, blocks, buf, lun = 0, read16 = False):
+        '''
+        Read blocks into buf on first session
+        @param buf: writable buffer of blocks * block length bytes
+        '''
+        future = self.SubmitRead(lba, blocks, buf, lun, read16)
+        if future == None:
+            return self.RET_FAIL
+        try:
+            if future.result().good:
+                return self.RET_SUCCESS
+        except ConnectionError:
+            pass
+        return self.RET_FAIL
+                    
+    def SubmitWrite(self, lba, blocks, buf, lun = 0, write16 = False):
+        '''
+        Queue a write on first session without waiting, returns future of
+        ScsiTask or None, submitting many keeps the CmdSN window full
+        '''
+        if len(self.__sessions) == 0:
+            self.logger.warn("No connection to write")
+            return None
+        return self.__sessions[0].Write(lba, blocks, buf, lun, write16)
+    
+    def Write(self, lba, blocks, buf, lun = 0, write16 = False):
+        '''
+        Write blocks from buf on first session
+        @param buf: buffer of blocks * block length bytes
+        '''
+        future = self.SubmitWrite(lba, blocks, buf, lun, write16)
+        if future == None:
+            return self.RET_FAIL
+        try:
+            if future.result().good:
+                return self.RET_SUCCESS
+        except ConnectionError:
+            pass
+        return self.RET_FAIL
+                    
     def Logout(self):
         if len(self.__sessions) == 0:
             self.logger.warn("No Connection to logout")
-        else:
-            self.__sessions[0].Logout()
-            evnt = self.__event_listener.Wait()
-            if evnt.id == evnt.ID_LOGGED_OUT:
-                del self.__sessions[0]
-                self.__event_listener.Wait()
-                return self.RET_SUCCESS
-            else:
-                return self.RET_FAIL
-            
\ No newline at end of file
+            return self.RET_NO_CONN
+        future = self.__sessions[0].Logout()
+        if future == None:
+            return self.RET_FAIL
+        try:
+            response = future.result()
+        except ConnectionError:
+            return self.RET_FAIL
+        if response == pdu.LogoutRespPDU.RESPONSE_SUCC:
+            del self.__sessions[0]
+            return self.RET_SUCCESS
+        return self.RET_FAIL
+
+if __name__ == "__main__":
+    import unittest
+    from session import ScriptedTarget
+
+    TARGET = "iqn.2020-01.t:1"
+
+    def Wait(condition, timeout = 5):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                raise TimeoutError
+            time.sleep(0.005)
+
+    class TestDiscoverAll(unittest.TestCase):
+        TEXT = (b"TargetName=iqn.2020-01.t:1\x00TargetAddress=10.0.0.1:3260,1\x00"
+                b"TargetAddress=10.0.1.1:3260,2\x00TargetName=iqn.2020-01.t:2\x00"
+                b"TargetAddress=10.0.0.1:3260,1\x00")
+
+        def setUp(self):
+            self.target = ScriptedTarget("discover")
+            self.mute = ScriptedTarget("discover-mute")
+            self.mute.silent = True
+            self.init = Initiator("iqn.2006-11.1")
+
+        def tearDown(self):
+            self.target.Close()
+            self.mute.Close()
+
+        def testMerge(self):
+            other = ParseTargets(b"TargetName=iqn.2020-01.t:2\x00TargetAddress=10.0.1.1:3260,2\x00"
+                                 b"TargetAddress=10.0.0.1:3260,1\x00TargetName=iqn.2020-01.t:3\x00")
+            merged = MergeTargets([ParseTargets(self.TEXT), other, ParseTargets(self.TEXT)])
+            self.assertEqual([t.name for t in merged],
+                             ["iqn.2020-01.t:1", "iqn.2020-01.t:2", "iqn.2020-01.t:3"])
+            self.assertEqual([(a.addr, a.tpgt) for a in merged[1].addr_list],
+                             [("10.0.0.1:3260", 1), ("10.0.1.1:3260", 2)])
+            self.assertEqual(len(merged[0].addr_list), 2)
+            self.assertEqual(merged[2].addr_list, [])
+
+        def testDiscoverAll(self):
+            # repeated portal is discovered once, its targets are merged with
+            # ones of the other portals
+            self.target.text = self.TEXT
+            targets, results = self.init.DiscoverAll(["pair:discover", "pipe:discover", "pair:discover"])
+            self.assertEqual([r.portal for r in results], ["pair:discover", "pipe:discover"])
+            self.assertEqual([r.error for r in results], [None, None])
+            self.assertEqual([t.name for t in targets], ["iqn.2020-01.t:1", "iqn.2020-01.t:2"])
+            self.assertEqual(len(targets[0].addr_list), 2)
+            self.assertEqual(len(self.target.Commands(pdu.BHS.OPCODE_LOGOUT_REQ)), 2)
+            Wait(lambda: self.target.closed == 2)
+
+        def testTimeout(self):
+            # portal not answering is given up and its session is closed
+            start = time.monotonic()
+            targets, results = self.init.DiscoverAll(["pair:discover-mute", "pair:discover"], timeout = 0.5)
+            self.assertLess(time.monotonic() - start, 5)
+            self.assertIsInstance(results[0].error, TimeoutError)
+            self.assertEqual(results[0].targets, None)
+            self.assertEqual(results[1].error, None)
+            self.assertEqual([t.name for t in targets], [TARGET])
+            Wait(lambda: self.mute.closed == 1)
+            self.assertEqual(len(self.mute.Commands(pdu.BHS.OPCODE_LOGIN_REQ)), 1)
+
+        def testRefused(self):
+            # refused portal is reported, others are discovered
+            targets, results = self.init.DiscoverAll(["pair:nowhere", "pair:discover"], timeout = 5)
+            self.assertIsInstance(results[0].error, ConnectionRefusedError)
+            self.assertEqual(results[1].error, None)
+            self.assertEqual([t.name for t in targets], [TARGET])
+            Wait(lambda: self.target.closed == 1)
+
+        def testDiscover(self):
+            self.assertEqual([t.name for t in Discover(self.init, "pair:discover", timeout = 5)], [TARGET])
+            Wait(lambda: self.target.closed == 1)
+            self.assertRaises(TimeoutError, Discover, self.init, "pair:discover-mute", timeout = 0.2)
+            Wait(lambda: self.mute.closed == 1)
+
+    unittest.main()
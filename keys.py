@@ -122,31 +122,327 @@ class TargetAddress(KeyCmn):
         s = text.ValueList(self.tvalue).Value[1]
         return TPGT(s).value
         
+class SessionParams():
+    '''
+    Operational parameters a session works with, RFC 7143 defaults apply
+    to keys which aren't negotiated
+    '''
+    def __init__(self):
+        self.header_digest = False
+        self.data_digest = False
+        self.max_connections = 1
+        self.immediate_data = True
+        self.initial_r2t = True
+        self.first_burst_length = 65536
+        self.max_burst_length = 262144
+        self.max_outstanding_r2t = 1
+        self.default_time2wait = 2
+        self.default_time2retain = 20
+        self.data_pdu_in_order = True
+        self.data_sequence_in_order = True
+        self.error_recovery_level = 0
+        self.protocol_level = 1 # iSCSIProtocolLevel, RFC 7144
+        # list of values in order of preference, negotiated one after login
+        self.task_reporting = "RFC3720"
+        # MaxRecvDataSegmentLength declared by target, limits pdus we send
+        self.max_xmit_data_segment_length = MaxRecvDataSegmentLength.DEFAULT_VAL
+        self.max_recv_data_segment_length = MaxRecvDataSegmentLength.DEFAULT_VAL
+        
+def Proposal():
+    '''
+    Returns SessionParams an initiator offers by default: larger segments
+    and bursts than RFC 7143 defaults, unsolicited data and several
+    connections allowed
+    '''
+    proposal = SessionParams()
+    proposal.max_connections = 8
+    proposal.initial_r2t = False
+    proposal.first_burst_length = 262144
+    proposal.max_burst_length = 1048576
+    proposal.max_outstanding_r2t = 8
+    proposal.max_recv_data_segment_length = 262144
+    return proposal
+
+# result functions of negotiated keys, RFC 7143 6.2.2
+def Minimum(ours, theirs):
+    return min(ours, theirs)
+
+def Maximum(ours, theirs):
+    return max(ours, theirs)
+
+def And(ours, theirs):
+    return ours and theirs
+
+def Or(ours, theirs):
+    return ours or theirs
+
+def Choice(ours, theirs):
+    # first value of their list we have, their answer to our list is a
+    # list of one
+    for value in theirs:
+        if value in ours:
+            return value
+    raise ValueError("none of %s is acceptable" % theirs)
+
+class OperationalKey():
+    '''
+    Declaration of a login operational key, RFC 7143 13
+    @param name: key name
+    @param attr: SessionParams attribute keeping value of the key
+    @param kind: BOOLEAN, NUMERICAL, DIGEST or LIST
+    @param result: function of our and their value giving negotiated value,
+    None for declarative keys
+    @param low: min valid numerical value
+    @param high: max valid numerical value
+    @param peer_attr: attribute keeping value declared by target
+    @param connection: negotiated on every connection, not only leading one
+    @param discovery: applies to discovery sessions
+    '''
+    BOOLEAN = 0
+    NUMERICAL = 1
+    DIGEST = 2 # bool in SessionParams, CRC32C or None on the wire
+    LIST = 3 # comma separated values, chosen one once negotiated
+    
+    def __init__(self, name, attr, kind, result, low = 0, high = 0xFFFFFFFF,
+                 peer_attr = None, connection = False, discovery = False):
+        self.name = name
+        self.attr = attr
+        self.kind = kind
+        self.result = result
+        self.low = low
+        self.high = high
+        self.peer_attr = peer_attr
+        self.connection = connection
+        self.discovery = discovery
+        
+    def Encode(self, value):
+        '''
+        Returns text offering value
+        '''
+        if self.kind == self.BOOLEAN:
+            return "Yes" if value else "No"
+        if self.kind == self.DIGEST:
+            return "CRC32C,None" if value else "None,CRC32C"
+        return str(value)
+    
+    def Answer(self, value):
+        '''
+        Returns text answering an offer with negotiated value
+        '''
+        if self.kind == self.DIGEST:
+            return "CRC32C" if value else "None"
+        return self.Encode(value)
+        
+    def Decode(self, tvalue):
+        '''
+        Returns value of text, raises ValueError when it's invalid
+        '''
+        try:
+            if self.kind == self.BOOLEAN:
+                return text.BooleanValue(tvalue).Value
+            if self.kind in (self.DIGEST, self.LIST):
+                return text.ValueList(tvalue).Value
+            value = text.NumericalValue(tvalue).Value
+        except TypeError:
+            raise ValueError("invalid value (%s) for %s" % (tvalue, self.name))
+        if value < self.low or value > self.high:
+            raise ValueError("%s(%d) is out of range" % (self.name, value))
+        return value
+    
+    def Result(self, ours, tvalue):
+        '''
+        Returns negotiated value from our value and their text
+        '''
+        theirs = self.Decode(tvalue)
+        if self.kind == self.DIGEST:
+            return Choice(self.Decode(self.Encode(ours)), theirs) == "CRC32C"
+        if self.kind == self.LIST:
+            return Choice(self.Decode(ours), theirs)
+        return self.result(ours, theirs)
+    
+# keys negotiated in login operational stage
+OPERATIONAL_KEYS = (
+    OperationalKey("HeaderDigest", "header_digest", OperationalKey.DIGEST, Choice,
+                   connection = True, discovery = True),
+    OperationalKey("DataDigest", "data_digest", OperationalKey.DIGEST, Choice,
+                   connection = True, discovery = True),
+    OperationalKey("MaxConnections", "max_connections", OperationalKey.NUMERICAL, Minimum, 1, 65535),
+    OperationalKey("InitialR2T", "initial_r2t", OperationalKey.BOOLEAN, Or),
+    OperationalKey("ImmediateData", "immediate_data", OperationalKey.BOOLEAN, And),
+    OperationalKey("MaxRecvDataSegmentLength", "max_recv_data_segment_length",
+                   OperationalKey.NUMERICAL, None, MaxRecvDataSegmentLength.MIN_VAL,
+                   MaxRecvDataSegmentLength.MAX_VAL, "max_xmit_data_segment_length",
+                   connection = True, discovery = True),
+    OperationalKey("MaxBurstLength", "max_burst_length", OperationalKey.NUMERICAL, Minimum, 512, 0xFFFFFF),
+    OperationalKey("FirstBurstLength", "first_burst_length", OperationalKey.NUMERICAL, Minimum, 512, 0xFFFFFF),
+    OperationalKey("DefaultTime2Wait", "default_time2wait", OperationalKey.NUMERICAL, Maximum, 0, 3600),
+    OperationalKey("DefaultTime2Retain", "default_time2retain", OperationalKey.NUMERICAL, Minimum, 0, 3600),
+    OperationalKey("MaxOutstandingR2T", "max_outstanding_r2t", OperationalKey.NUMERICAL, Minimum, 1, 65535),
+    OperationalKey("DataPDUInOrder", "data_pdu_in_order", OperationalKey.BOOLEAN, Or),
+    OperationalKey("DataSequenceInOrder", "data_sequence_in_order", OperationalKey.BOOLEAN, Or),
+    OperationalKey("ErrorRecoveryLevel", "error_recovery_level", OperationalKey.NUMERICAL, Minimum, 0, 2),
+    OperationalKey("iSCSIProtocolLevel", "protocol_level", OperationalKey.NUMERICAL, Minimum, 0, 31),
+    OperationalKey("TaskReporting", "task_reporting", OperationalKey.LIST, Choice))
+
+# keys target sends which aren't negotiated
+INFORMATIONAL_KEYS = frozenset(("TargetPortalGroupTag", "TargetAlias", "TargetAddress",
+                                "TargetName", "InitiatorName", "InitiatorAlias",
+                                "SessionType", "AuthMethod"))
+
+# answers leaving a key at its default
+NOT_NEGOTIATED = frozenset(("Reject", "Irrelevant", "NotUnderstood"))
+
+class Negotiator():
+    '''
+    Negotiates operational keys of one login. Keys of proposal are offered,
+    results of target answers and answers to target offers are written
+    into params as they arrive.
+    @param proposal: SessionParams initiator asks for
+    @param params: SessionParams negotiated values are kept in
+    @param leading: login of leading connection, session wide keys are
+    negotiated only there
+    @param discovery: login of a discovery session
+    '''
+    def __init__(self, proposal, params, leading = True, discovery = False):
+        self.__proposal = proposal
+        self.__params = params
+        self.__keys = {}
+        for key in OPERATIONAL_KEYS:
+            if (leading or key.connection) and (key.discovery or not discovery):
+                self.__keys[key.name] = key
+        self.__leading = leading
+        self.__offered = False
+        self.__done = set() # names of keys offered or answered
+        
+    @property
+    def params(self):
+        return self.__params
+    
+    @property
+    def leading(self):
+        return self.__leading
+    
+    @property
+    def offered(self):
+        return self.__offered
+    
+    def Offer(self):
+        '''
+        Returns keys for first pdu of operational stage
+        '''
+        retval = []
+        for key in self.__keys.values():
+            retval += [KeyCmn(key.name, key.Encode(getattr(self.__proposal, key.attr)))]
+        self.Offered()
+        return retval
+    
+    def Offered(self):
+        '''
+        Take keys of proposal as offered by a payload encoded before, like
+        the cached one of a reinstatement login
+        '''
+        for key in self.__keys.values():
+            if key.result == None:
+                setattr(self.__params, key.attr, getattr(self.__proposal, key.attr)) # declared
+            self.__done.add(key.name)
+        self.__offered = True
+    
+    def Update(self, parsed):
+        '''
+        Take keys of a login response, returns list of keys answering
+        offers of target
+        @param parsed: keys from ParsePayload
+        '''
+        answers = []
+        for k in parsed:
+            key = self.__keys.get(k.key)
+            if key == None:
+                if k.key not in INFORMATIONAL_KEYS:
+                    answers += [KeyCmn(k.key, "NotUnderstood")]
+                continue
+            if k.tvalue in NOT_NEGOTIATED:
+                continue
+            try:
+                if key.result == None:
+                    setattr(self.__params, key.peer_attr, key.Decode(k.tvalue))
+                    continue
+                value = key.Result(getattr(self.__proposal, key.attr), k.tvalue)
+            except ValueError as e:
+                print("%s, key is rejected" % e)
+                if key.name not in self.__done:
+                    answers += [KeyCmn(key.name, "Reject")]
+                    self.__done.add(key.name)
+                continue
+            setattr(self.__params, key.attr, value)
+            if key.name not in self.__done:
+                # target offered, our answer is the result
+                answers += [KeyCmn(key.name, key.Answer(value))]
+                self.__done.add(key.name)
+        params = self.__params
+        params.first_burst_length = min(params.first_burst_length, params.max_burst_length)
+        return answers
+
 def ParsePayload(pload):
     '''
-    Returns KeyClass->KeyObject dictionary
-    @param pload: binary payload
+    Returns list of key objects, keys without a class of their own are
+    KeyCmn
+    @param pload: binary payload, any bytes like object
     '''
     name_key_tb = {"TargetPortalGroupTag":TPGT, "AuthMethod":AuthMethod, 
                    "InitiatorName":InitName, "SessionType":SessionType,
                    "MaxRecvDataSegmentLength":MaxRecvDataSegmentLength,
                    "TargetName":TargetName, "TargetAddress":TargetAddress}
-    ustr = pload.decode("utf8")
+    ustr = str(pload, "utf8")
     kv_pairs = ustr.split("\x00")
     retval = []
     for kv_pair in kv_pairs:
         if len(kv_pair) != 0:
-            tmp = kv_pair.split("=")
-            key = tmp[0]
-            value = tmp[1:]
-            if len(key) != 0 and len(value) == 1:
-                value = value[0]
-                key_class = name_key_tb[key]
-                retval += [key_class(value)]
-            else:
-                print("multiple (=) char in key value pair")
+            key, sep, value = kv_pair.partition("=")
+            if len(key) == 0 or len(sep) == 0:
+                print("invalid key value pair (%s)" % kv_pair)
+                continue
+            key_class = name_key_tb.get(key)
+            if key_class != None:
+                try:
+                    retval += [key_class(value)]
+                    continue
+                except (TypeError, ValueError):
+                    pass # e.g. Reject or out of range, kept as text
+            try:
+                retval += [KeyCmn(key, value)]
+            except TypeError:
+                print("invalid key name (%s)" % key)
     return retval
 
+class KeyParser():
+    '''
+    Parses key=value pairs of a data segment received in pieces, e.g. over
+    text response pdus. A pair split between pieces is kept until its
+    terminating null arrives.
+    '''
+    def __init__(self):
+        self.__partial = b""
+        
+    def Feed(self, data):
+        '''
+        Returns list of keys completed by data
+        @param data: next piece of payload, any bytes like object
+        '''
+        data = self.__partial + bytes(data)
+        end = data.rfind(b"\x00") + 1
+        self.__partial = data[end:]
+        if end == 0:
+            return []
+        return ParsePayload(data[:end])
+    
+    def Close(self):
+        '''
+        Returns list of keys of the pair left without null terminator
+        '''
+        data = self.__partial
+        self.__partial = b""
+        return ParsePayload(data)
+    
 def GenPayload(keys):
     '''
     '''
@@ -154,4 +450,70 @@ def GenPayload(keys):
     for key in keys:
         retval += key.text
     return retval
-    
\ No newline at end of file
+    
+if __name__ == "__main__":
+    import unittest
+
+    class TestNegotiator(unittest.TestCase):
+        def testUpdate(self):
+            negotiator = Negotiator(Proposal(), SessionParams(), True, False)
+            offered = GenPayload(negotiator.Offer())
+            self.assertIn("MaxConnections=8\x00", offered)
+            answers = negotiator.Update(ParsePayload(b"MaxBurstLength=131072\x00FirstBurstLength=262144\x00"
+                                                     b"ImmediateData=No\x00MaxRecvDataSegmentLength=65536\x00"
+                                                     b"X-com.foo=bar\x00MaxConnections=100000\x00"))
+            params = negotiator.params
+            self.assertEqual(params.max_burst_length, 131072)
+            self.assertEqual(params.first_burst_length, 131072)
+            self.assertFalse(params.immediate_data)
+            self.assertEqual(params.max_xmit_data_segment_length, 65536)
+            # invalid response to an offer keeps default, it isn't answered
+            self.assertEqual(params.max_connections, 1)
+            self.assertEqual(GenPayload(answers), "X-com.foo=NotUnderstood\x00")
+
+        def testAnswer(self):
+            negotiator = Negotiator(Proposal(), SessionParams(), True, False)
+            answers = negotiator.Update(ParsePayload(b"HeaderDigest=CRC32C,None\x00InitialR2T=No\x00"))
+            # first choice of offer we support
+            self.assertEqual(GenPayload(answers), "HeaderDigest=CRC32C\x00InitialR2T=No\x00")
+            self.assertTrue(negotiator.params.header_digest)
+            self.assertFalse(negotiator.params.initial_r2t)
+
+        def testProtocolLevel(self):
+            # RFC 3720 targets don't know the key, RFC 7144 ones answer their level
+            negotiator = Negotiator(Proposal(), SessionParams(), True, False)
+            self.assertIn("iSCSIProtocolLevel=1\x00", GenPayload(negotiator.Offer()))
+            negotiator.Update(ParsePayload(b"iSCSIProtocolLevel=NotUnderstood\x00"))
+            self.assertEqual(negotiator.params.protocol_level, 1)
+            negotiator.Update(ParsePayload(b"iSCSIProtocolLevel=0\x00"))
+            self.assertEqual(negotiator.params.protocol_level, 0)
+            negotiator = Negotiator(Proposal(), SessionParams(), True, False)
+            answers = negotiator.Update(ParsePayload(b"iSCSIProtocolLevel=2\x00"))
+            self.assertEqual(GenPayload(answers), "iSCSIProtocolLevel=1\x00")
+            negotiator = Negotiator(Proposal(), SessionParams(), True, False)
+            answers = negotiator.Update(ParsePayload(b"iSCSIProtocolLevel=32\x00"))
+            self.assertEqual(GenPayload(answers), "iSCSIProtocolLevel=Reject\x00")
+            self.assertEqual(negotiator.params.protocol_level, 1)
+
+        def testTaskReporting(self):
+            proposal = Proposal()
+            proposal.task_reporting = "ResponseFence,RFC3720"
+            negotiator = Negotiator(proposal, SessionParams(), True, False)
+            self.assertIn("TaskReporting=ResponseFence,RFC3720\x00", GenPayload(negotiator.Offer()))
+            negotiator.Update(ParsePayload(b"TaskReporting=RFC3720\x00"))
+            self.assertEqual(negotiator.params.task_reporting, "RFC3720")
+            # offer of target is answered with first of its values we take
+            negotiator = Negotiator(proposal, SessionParams(), True, False)
+            answers = negotiator.Update(ParsePayload(b"TaskReporting=FastAbort,ResponseFence\x00"))
+            self.assertEqual(GenPayload(answers), "TaskReporting=ResponseFence\x00")
+            self.assertEqual(negotiator.params.task_reporting, "ResponseFence")
+            negotiator = Negotiator(Proposal(), SessionParams(), True, False)
+            answers = negotiator.Update(ParsePayload(b"TaskReporting=FastAbort\x00"))
+            self.assertEqual(GenPayload(answers), "TaskReporting=Reject\x00")
+            self.assertEqual(negotiator.params.task_reporting, "RFC3720")
+            # neither is negotiated in discovery sessions
+            offered = GenPayload(Negotiator(Proposal(), SessionParams(), True, True).Offer())
+            self.assertNotIn("TaskReporting", offered)
+            self.assertNotIn("iSCSIProtocolLevel", offered)
+
+    unittest.main()
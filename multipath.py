@@ -0,0 +1,406 @@
+#!/usr/bin/python3
+# Copyright (c) 2015. Harun Emektar
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import logging
+import threading
+import time
+import concurrent.futures
+from session import InitSession, LoginError
+from policy import RoundRobin, LeastOutstanding, ServiceTime
+
+class Path():
+    '''
+    Session to a target through one portal group, extra portals of the
+    group are connections of the same session
+    @param tpgt: target portal group tag
+    @param portals: addresses of portal group, first one leads the session
+    '''
+    # weight of the newest sample in latency average
+    ALPHA = 0.2
+    LOGOUT_TIMEOUT = 10 # seconds a session dropped by path waits for logout response
+
+    def __init__(self, tpgt, portals):
+        self.__tpgt = tpgt
+        self.__portals = portals
+        self.__session = None
+        self.__lock = threading.Lock()
+        self.__outstanding = 0
+        self.__bytes_in_flight = 0
+        self.__latency = None
+        self.__failed = True # until it's opened
+
+    @property
+    def tpgt(self):
+        return self.__tpgt
+
+    @property
+    def portals(self):
+        return self.__portals
+
+    @property
+    def session(self):
+        return self.__session
+
+    @property
+    def outstanding(self):
+        return self.__outstanding
+
+    @property
+    def bytes_in_flight(self):
+        return self.__bytes_in_flight
+
+    @property
+    def latency(self):
+        '''
+        Average service time of recent commands in seconds, None before first
+        '''
+        return self.__latency
+
+    @property
+    def usable(self):
+        return not self.__failed and self.__session.state == InitSession.STATE_LOGGED_IN
+
+    def Open(self, init, tgt_name, options = None):
+        '''
+        Login to target on portals of path, raises LoginError or
+        ConnectionError when leading portal can't be logged in. Session it
+        had before is logged out and closed.
+        '''
+        session = InitSession(init, self.__portals[0], tgt_name, options)
+        try:
+            future = session.Login()
+            if future == None:
+                raise ConnectionError("session to %s can't log in" % self.__portals[0])
+            future.result()
+        except:
+            # a failed session mustn't keep its threads and socket
+            session.Close()
+            raise
+        for portal in self.__portals[1:]:
+            try:
+                future = session.AddConnection(portal, options)
+                if future == None:
+                    raise ConnectionError("session can't add connection")
+                future.result()
+            except (LoginError, OSError) as e:
+                MultipathDevice.logger.warn("portal %s of path isn't added, %s" % (portal, e))
+        with self.__lock:
+            previous = self.__session
+            self.__session = session
+            self.__latency = None
+            self.__failed = False
+        if previous != None:
+            self.__Drop(previous)
+
+    def __Drop(self, session):
+        # log out session path doesn't use anymore, it's closed even if
+        # target doesn't answer
+        try:
+            if session.state == InitSession.STATE_LOGGED_IN:
+                future = session.Logout()
+                if future != None:
+                    future.result(self.LOGOUT_TIMEOUT)
+        except (ConnectionError, concurrent.futures.TimeoutError):
+            pass
+        finally:
+            session.Close()
+
+    def Fail(self):
+        with self.__lock:
+            self.__failed = True
+
+    def Start(self, nbytes):
+        with self.__lock:
+            self.__outstanding += 1
+            self.__bytes_in_flight += nbytes
+
+    def Complete(self, nbytes, elapsed = None):
+        '''
+        Take command off path, elapsed seconds update latency average
+        '''
+        with self.__lock:
+            self.__outstanding -= 1
+            self.__bytes_in_flight -= nbytes
+            if elapsed != None:
+                if self.__latency == None:
+                    self.__latency = elapsed
+                else:
+                    self.__latency += self.ALPHA * (elapsed - self.__latency)
+
+class MultipathDevice():
+    '''
+    One logical device of a target reached through all of its portal
+    groups, a session is opened per portal group. Commands go on the path
+    chosen by selector and are retried on another path when theirs fails.
+    @param init: initiator.Initiator, its name is used in login
+    @param target: initiator.TargetInfo from discovery
+    @param selector: policy choosing path of a command, a name in SELECTORS
+    or a policy object, service-time if None
+    @param options: transport.TransportOptions of connections
+    '''
+    # logger for multipath devices
+    logger = logging.getLogger("Multipath")
+    logger.setLevel(logging.DEBUG)
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.DEBUG)
+    logger.addHandler(ch)
+
+    # path selectors
+    SELECTORS = {"round-robin":RoundRobin, "queue-length":LeastOutstanding,
+                 "service-time":ServiceTime}
+
+    def __init__(self, init, target, selector = None, options = None):
+        if selector == None:
+            selector = "service-time"
+        if isinstance(selector, str):
+            selector = self.SELECTORS[selector]()
+        self.__init = init
+        self.__name = target.name
+        self.__selector = selector
+        self.__options = options
+        groups = {} # tpgt:portals
+        for addr in target.addr_list:
+            groups.setdefault(addr.tpgt, []).append(addr.addr)
+        self.__paths = [Path(tpgt, portals) for tpgt, portals in groups.items()]
+        # commands of a failed path are issued again by a worker of their
+        # own, not by pdu processor of failed session completing them
+        self.__retries = concurrent.futures.ThreadPoolExecutor(1)
+
+    @property
+    def name(self):
+        return self.__name
+
+    @property
+    def paths(self):
+        return self.__paths
+
+    @property
+    def selector(self):
+        return self.__selector
+
+    @selector.setter
+    def selector(self, selector):
+        self.__selector = selector
+
+    def Open(self):
+        '''
+        Login on every path, returns number of usable paths, raises
+        ConnectionError if there is none
+        '''
+        for path in self.__paths:
+            try:
+                path.Open(self.__init, self.__name, self.__options)
+            except (LoginError, OSError) as e:
+                self.logger.warn("path of tpgt(%d) to %s isn't opened, %s" % (path.tpgt, self.__name, e))
+        usable = len(self.Usable())
+        if usable == 0:
+            raise ConnectionError("no path to %s" % self.__name)
+        return usable
+
+    def Restore(self):
+        '''
+        Try to login again on failed paths, returns number of usable paths
+        '''
+        for path in self.__paths:
+            if not path.usable:
+                try:
+                    path.Open(self.__init, self.__name, self.__options)
+                    self.logger.info("path of tpgt(%d) to %s is restored" % (path.tpgt, self.__name))
+                except (LoginError, OSError):
+                    pass
+        return len(self.Usable())
+
+    def Usable(self):
+        '''
+        Returns paths commands can be sent on
+        '''
+        return [path for path in self.__paths if path.usable]
+
+    def Close(self):
+        '''
+        Logout sessions of usable paths, then close sessions of all paths
+        '''
+        futures = [path.session.Logout() for path in self.Usable()]
+        for path in self.__paths:
+            path.Fail()
+        for future in futures:
+            if future != None:
+                try:
+                    future.result(Path.LOGOUT_TIMEOUT)
+                except (ConnectionError, concurrent.futures.TimeoutError):
+                    pass
+        for path in self.__paths:
+            if path.session != None:
+                path.session.Close()
+        self.__retries.shutdown(wait = False)
+
+    def __Submit(self, issue, nbytes, future, tried):
+        # issue on selected path, on failure the next one is tried
+        while not future.done():
+            paths = [path for path in self.Usable() if path not in tried]
+            if len(paths) == 0:
+                future.set_exception(ConnectionError("no usable path to %s" % self.__name))
+                return
+            path = self.__selector.Select(paths, None)
+            tried += [path]
+            path.Start(nbytes)
+            start = time.monotonic()
+            path_future = issue(path.session)
+            if path_future == None:
+                # session failed after it's selected
+                path.Complete(nbytes)
+                path.Fail()
+                continue
+            def Done(path_future, path = path, start = start):
+                try:
+                    task = path_future.result()
+                except ConnectionError:
+                    path.Complete(nbytes)
+                    path.Fail()
+                    self.logger.warn("path of tpgt(%d) to %s failed, command is retried" % (path.tpgt, self.__name))
+                    # waiting for a task slot of another path here would
+                    # stall teardown of failed session too
+                    try:
+                        self.__retries.submit(self.__Submit, issue, nbytes, future, tried)
+                    except RuntimeError:
+                        if not future.done():
+                            future.set_exception(ConnectionError("multipath device of %s is closed" % self.__name))
+                    return
+                except Exception as e:
+                    path.Complete(nbytes)
+                    future.set_exception(e)
+                    return
+                path.Complete(nbytes, time.monotonic() - start)
+                if not future.done():
+                    future.set_result(task)
+            path_future.add_done_callback(Done)
+            return
+
+    def Read(self, lba, blocks, buf, lun = 0, read16 = False):
+        '''
+        Read blocks into buf on a selected path, returns future of ScsiTask.
+        It fails with ConnectionError only when no path is left.
+        @param buf: writable buffer of blocks * block length bytes
+        '''
+        future = concurrent.futures.Future()
+        self.__Submit(lambda session: session.Read(lba, blocks, buf, lun, read16),
+                      memoryview(buf).nbytes, future, [])
+        return future
+
+    def Write(self, lba, blocks, buf, lun = 0, write16 = False):
+        '''
+        Write blocks from buf on a selected path, returns future of ScsiTask
+        @param buf: buffer of blocks * block length bytes
+        '''
+        future = concurrent.futures.Future()
+        self.__Submit(lambda session: session.Write(lba, blocks, buf, lun, write16),
+                      memoryview(buf).nbytes, future, [])
+        return future
+
+if __name__ == "__main__":
+    import unittest
+    from session import ScriptedTarget
+    from initiator import TargetInfo, TargetAddrInfo
+
+    class Init():
+        name = "iqn.2006-11.1"
+
+    TARGET = "iqn.2020-01.t:1"
+
+    def Wait(condition, timeout = 5):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                raise TimeoutError
+            time.sleep(0.005)
+
+    class TestMultipath(unittest.TestCase):
+        def setUp(self):
+            # a portal group per target end, tpgt 1 and 2
+            self.targets = [ScriptedTarget("mp1"), ScriptedTarget("mp2")]
+            info = TargetInfo(TARGET, [TargetAddrInfo("pair:mp1", 1), TargetAddrInfo("pair:mp2", 2)])
+            self.device = MultipathDevice(Init(), info, "round-robin")
+            self.assertEqual(self.device.Open(), 2)
+            self.NoReinstatement()
+
+        def tearDown(self):
+            self.device.Close()
+            for target in self.targets:
+                target.Close()
+
+        def NoReinstatement(self):
+            # a lost connection fails its session and commands right away
+            for path in self.device.paths:
+                path.session.reinstate_attempts = 0
+
+        def testBookkeeping(self):
+            self.targets[0].Hold()
+            bufs = [bytearray(512) for i in range(4)]
+            futures = [self.device.Read(lba, 1, bufs[lba]) for lba in range(4)]
+            first, second = self.device.paths
+            Wait(lambda: len(self.targets[0].Commands()) == 2)
+            self.assertEqual((first.outstanding, first.bytes_in_flight), (2, 1024))
+            for future in futures[1::2]:
+                self.assertTrue(future.result(5).good)
+            self.assertEqual(second.outstanding, 0)
+            self.assertNotEqual(second.latency, None)
+            self.targets[0].Release()
+            for lba, future in enumerate(futures):
+                self.assertTrue(future.result(5).good)
+                self.assertEqual(bytes(bufs[lba]), ScriptedTarget.Pattern(lba, 512))
+            self.assertEqual((first.outstanding, first.bytes_in_flight), (0, 0))
+            self.assertNotEqual(first.latency, None)
+
+        def testUsable(self):
+            first, second = self.device.paths
+            first.Fail()
+            self.assertEqual(self.device.Usable(), [second])
+            futures = [self.device.Read(lba, 1, bytearray(512)) for lba in range(4)]
+            for future in futures:
+                self.assertTrue(future.result(5).good)
+            self.assertEqual(len(self.targets[0].Commands()), 0)
+            self.assertEqual(len(self.targets[1].Commands()), 4)
+
+        def testFailover(self):
+            # commands held on a path that's killed complete on the other
+            self.targets[0].Hold()
+            bufs = [bytearray(1024) for i in range(8)]
+            futures = [self.device.Read(lba, 2, bufs[lba]) for lba in range(4)]
+            futures += [self.device.Write(lba, 2, ScriptedTarget.Pattern(lba, 1024)) for lba in range(4, 8)]
+            Wait(lambda: len(self.targets[0].Commands()) == 4)
+            self.targets[0].Kill(0)
+            for future in futures:
+                self.assertTrue(future.result(5).good)
+            for lba in range(4):
+                self.assertEqual(bytes(bufs[lba]), ScriptedTarget.Pattern(lba, 1024))
+            for lba in range(4, 8):
+                self.assertEqual(self.targets[1].written[lba], ScriptedTarget.Pattern(lba, 1024))
+            self.assertEqual(len(self.targets[1].Commands()), 8)
+            first, second = self.device.paths
+            self.assertEqual(self.device.Usable(), [second])
+            self.assertEqual((first.outstanding, first.bytes_in_flight), (0, 0))
+            # failed path is logged in again
+            failed = first.session
+            self.assertEqual(self.device.Restore(), 2)
+            self.assertIsNot(first.session, failed)
+            self.assertEqual(self.device.Read(0, 1, bytearray(512)).result(5).good, True)
+
+        def testNoPath(self):
+            for path in self.device.paths:
+                path.Fail()
+            future = self.device.Read(0, 1, bytearray(512))
+            self.assertRaises(ConnectionError, future.result, 5)
+
+    unittest.main()
@@ -19,17 +19,23 @@ if __name__ != "__main__":
     from .login_pdu import *
     from .text_pdu import *
     from .logout_pdu import *
+    from .scsi_pdu import *
+    from .nop_pdu import *
+    from . import digest
 else:
     from headers import *
     from pdu_common import *
     from login_pdu import *
     from text_pdu import *
     from logout_pdu import *
+    from scsi_pdu import *
+    from nop_pdu import *
+    import digest
 # unit tests
 if __name__ == "__main__":
     import unittest
     class TestBHS (unittest.TestCase):
-        valid_BHS_data = '\x23\x87\x00\x00\x00\x00\x00\x00\x80\x58\x4c\x57\x24\x25\x00\x09\x00\x00\x00\x47\x00\x00\x00\x00\x00\x00\x00\x13\x00\x00\x00\x01\x00\x00\x00\x10\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+        valid_BHS_data = b'\x23\x87\x00\x00\x00\x00\x00\x00\x80\x58\x4c\x57\x24\x25\x00\x09\x00\x00\x00\x47\x00\x00\x00\x00\x00\x00\x00\x13\x00\x00\x00\x01\x00\x00\x00\x10\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
         valid_BHS_data_opcode = 0x23
         valid_BHS_data_Immed = False
         valid_BHS_data_final = True
@@ -39,9 +45,10 @@ if __name__ == "__main__":
         
         def testInvalidParams(self):
             self.assertRaises(TypeError, BHS, 4)
-            self.assertRaises(ValueError, BHS, "")
-            self.assertRaises(ValueError, BHS, "a")
-            self.assertRaises(ValueError, BHS, "".join(["a" for i in range(BHS.LENGTH - 1)]))
+            self.assertRaises(TypeError, BHS, "")
+            self.assertRaises(ValueError, BHS, b"")
+            self.assertRaises(ValueError, BHS, b"a")
+            self.assertRaises(ValueError, BHS, b"a" * (BHS.LENGTH - 1))
             
         def testValidParam(self):
             self.assertTrue(isinstance(BHS(self.valid_BHS_data), BHS))
@@ -52,12 +59,12 @@ if __name__ == "__main__":
             self.assertEqual(test_BHS.TotalAHSLength, self.valid_BHS_data_AHS_len)
             self.assertEqual(test_BHS.DataSegmentLength, self.valid_BHS_data_len)
             self.assertEqual(test_BHS.InitiatorTaskTag, self.valid_BHS_data_init_task_tag)
-            self.assertEqual(test_BHS[0], '\x23')
-            self.assertEqual(test_BHS[8:12], '\x80\x58\x4c\x57')            
-            self.assertEqual(test_BHS[-1], '\x00')
+            self.assertEqual(test_BHS[0], 0x23)
+            self.assertEqual(test_BHS[8:12], b'\x80\x58\x4c\x57')
+            self.assertEqual(test_BHS[-1], 0x00)
             
     class TestLoginPDU(unittest.TestCase):
-        valid_LoginPDU_data = "\x43\x00\x00\x00\x00\x00\x00\x6e\x80\x04\x09\x00\x00\x00\x00\x00\x00\x04\x00\x01\x04\x09\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x49\x6e\x69\x74\x69\x61\x74\x6f\x72\x4e\x61\x6d\x65\x3d\x69\x71\x6e\x2e\x32\x30\x30\x36\x2d\x31\x31\x2e\x32\x00\x54\x61\x72\x67\x65\x74\x4e\x61\x6d\x65\x3d\x69\x71\x6e\x2e\x32\x30\x30\x36\x2d\x31\x31\x2e\x31\x2e\x70\x79\x74\x68\x6f\x6e\x2e\x69\x73\x63\x73\x69\x2e\x74\x61\x72\x67\x65\x74\x2d\x31\x00\x53\x65\x73\x73\x69\x6f\x6e\x54\x79\x70\x65\x3d\x4e\x6f\x72\x6d\x61\x6c\x00\x41\x75\x74\x68\x4d\x65\x74\x68\x6f\x64\x3d\x43\x48\x41\x50\x00\x00\x00"
+        valid_LoginPDU_data = b"\x43\x00\x00\x00\x00\x00\x00\x6e\x80\x04\x09\x00\x00\x00\x00\x00\x00\x04\x00\x01\x04\x09\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x49\x6e\x69\x74\x69\x61\x74\x6f\x72\x4e\x61\x6d\x65\x3d\x69\x71\x6e\x2e\x32\x30\x30\x36\x2d\x31\x31\x2e\x32\x00\x54\x61\x72\x67\x65\x74\x4e\x61\x6d\x65\x3d\x69\x71\x6e\x2e\x32\x30\x30\x36\x2d\x31\x31\x2e\x31\x2e\x70\x79\x74\x68\x6f\x6e\x2e\x69\x73\x63\x73\x69\x2e\x74\x61\x72\x67\x65\x74\x2d\x31\x00\x53\x65\x73\x73\x69\x6f\x6e\x54\x79\x70\x65\x3d\x4e\x6f\x72\x6d\x61\x6c\x00\x41\x75\x74\x68\x4d\x65\x74\x68\x6f\x64\x3d\x43\x48\x41\x50\x00\x00\x00"
         valid_LoginPDU_data_opcode = 0x03
         valid_LoginPDU_data_immed = True
         valid_LoginPDU_data_transit = False
@@ -68,7 +75,7 @@ if __name__ == "__main__":
         valid_LoginPDU_data_version_min = 0
         valid_LoginPDU_data_total_ahs_len = 0
         valid_LoginPDU_data_data_len = 0x6e
-        valid_LoginPDU_data_isid =  ISID(raw = "\x80\x04\x09\x00\x00\x00")
+        valid_LoginPDU_data_isid =  ISID(raw = b"\x80\x04\x09\x00\x00\x00")
         valid_LoginPDU_data_tsih = 0
         valid_LoginPDU_data_init_task_tag = 0x40001
         valid_LoginPDU_data_cid = 0x409
@@ -97,6 +104,14 @@ if __name__ == "__main__":
             self.assertEqual(test_LoginPDU.ExpStatSN, self.valid_LoginPDU_data_expstatsn)
             self.assertEqual(test_LoginPDU.PayloadOffset, self.valid_LoginPDU_data_payload_index)
             
+        def testISID(self):
+            isid = ISID(raw = None, seq = (ISID.T_RANDOM, 0x15, 0x1234, 0x56, 0x789A))
+            self.assertEqual(isid.raw_data, b"\x95\x12\x34\x56\x78\x9A")
+            self.assertEqual((isid.T, isid.A, isid.B, isid.C, isid.D), (ISID.T_RANDOM, 0x15, 0x1234, 0x56, 0x789A))
+            isid.D += 1
+            self.assertEqual(isid.D, 0x789B)
+            self.assertEqual(isid.B, 0x1234)
+            
         def testAssignment(self):
             test_LoginPDU = LoginPDU()
 #            for b in test_LoginPDU:
@@ -160,7 +175,7 @@ if __name__ == "__main__":
             
             
     class TestLoginRespPDU(unittest.TestCase):
-        valid_LoginRespPDU_data = "\x23\x00\x00\x00\x00\x00\x00\x35\x80\x04\x09\x00\x00\x00\x00\x00\x00\x04\x00\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x54\x61\x72\x67\x65\x74\x50\x6f\x72\x74\x61\x6c\x47\x72\x6f\x75\x70\x54\x61\x67\x3d\x31\x00\x54\x61\x72\x67\x65\x74\x41\x6c\x69\x61\x73\x3d\x0a\x00\x41\x75\x74\x68\x4d\x65\x74\x68\x6f\x64\x3d\x43\x48\x41\x50\x00\x00\x00\x00"
+        valid_LoginRespPDU_data = b"\x23\x00\x00\x00\x00\x00\x00\x35\x80\x04\x09\x00\x00\x00\x00\x00\x00\x04\x00\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x54\x61\x72\x67\x65\x74\x50\x6f\x72\x74\x61\x6c\x47\x72\x6f\x75\x70\x54\x61\x67\x3d\x31\x00\x54\x61\x72\x67\x65\x74\x41\x6c\x69\x61\x73\x3d\x0a\x00\x41\x75\x74\x68\x4d\x65\x74\x68\x6f\x64\x3d\x43\x48\x41\x50\x00\x00\x00\x00"
         valid_LoginRespPDU_data_opcode = 0x23
         valid_LoginRespPDU_data_immed = False
         valid_LoginRespPDU_data_transit = False
@@ -171,7 +186,7 @@ if __name__ == "__main__":
         valid_LoginRespPDU_data_version_act = 0
         valid_LoginRespPDU_data_total_ahs_len = 0
         valid_LoginRespPDU_data_data_len = 0x35
-        valid_LoginRespPDU_data_isid =  ISID(raw = "\x80\x04\x09\x00\x00\x00")
+        valid_LoginRespPDU_data_isid =  ISID(raw = b"\x80\x04\x09\x00\x00\x00")
         valid_LoginRespPDU_data_tsih = 0
         valid_LoginRespPDU_data_init_task_tag = 0x40001
         valid_LoginRespPDU_data_statsn = 0
@@ -204,4 +219,220 @@ if __name__ == "__main__":
             self.assertEqual(test_LoginRespPDU.StatusDetail, self.valid_LoginRespPDU_data_stat_detail)
             self.assertEqual(test_LoginRespPDU.PayloadOffset, self.valid_LoginRespPDU_data_payload_index)
 
-    unittest.main()
\ No newline at end of file
+    class TestPDUBuffers(unittest.TestCase):
+        def testBuffers(self):
+            t_pdu = TextPDU()
+            t_pdu.AppendData("SendTargets=All\x00")
+            t_pdu.AppendData(b"\x01")
+            self.assertEqual(t_pdu.DataSegmentLength, 17)
+            bufs = t_pdu.Buffers()
+            self.assertEqual(len(bufs), 4)
+            self.assertEqual(bufs[-1], b"\x00\x00\x00")
+            raw = t_pdu.raw_data
+            self.assertEqual(len(raw), BHS.LENGTH + 20)
+            self.assertEqual(t_pdu.raw_data, raw) # no padding appended twice
+            self.assertEqual(TextPDU(raw).DataSegmentLength, 17)
+
+    class TestBufferPool(unittest.TestCase):
+        def cycle(self, count):
+            for i in range(count):
+                t_pdu = TextPDU()
+                t_pdu.InitiatorTaskTag = i
+                t_pdu.AllocData(100)[:16] = b"SendTargets=All\x00"
+                t_pdu.Buffers()
+                t_pdu.Release()
+                
+        def testSlots(self):
+            for pdu_class in (PDU, LoginPDU, LoginRespPDU, TextPDU, TextRespPDU, LogoutPDU, LogoutRespPDU):
+                self.assertFalse(hasattr(pdu_class(bytearray(BHS.LENGTH)), "__dict__"))
+            
+        def testReuse(self):
+            t_pdu = TextPDU()
+            t_pdu.InitiatorTaskTag = 0x1234
+            hdr = t_pdu.data
+            t_pdu.Release()
+            t_pdu = TextPDU()
+            self.assertIs(t_pdu.data, hdr)
+            self.assertEqual(t_pdu.InitiatorTaskTag, 0)
+            
+        def testSteadyState(self):
+            import tracemalloc
+            self.cycle(100) # warm up pool
+            tracemalloc.start()
+            try:
+                self.cycle(100)
+                start = tracemalloc.get_traced_memory()[0]
+                self.cycle(10000)
+                growth = tracemalloc.get_traced_memory()[0] - start
+            finally:
+                tracemalloc.stop()
+            self.assertLess(growth, 1024)
+
+    class TestDigest(unittest.TestCase):
+        def testCrc32c(self):
+            for crc32c in digest.BACKENDS.values():
+                self.assertEqual(crc32c(bytes(32)), 0x8A9136AA)
+                self.assertEqual(crc32c(b"\xff" * 32), 0x62A8AB43)
+                self.assertEqual(crc32c(b"123456789"), 0xE3069283)
+                self.assertEqual(crc32c(b"56789", crc32c(b"1234")), 0xE3069283)
+            self.assertEqual(digest.Digest([b"1234", b"56789"]), b"\x83\x92\x06\xe3")
+            
+        def testPDUDigests(self):
+            t_pdu = TextPDU(None, True, True)
+            t_pdu.AppendData("SendTargets=All\x00")
+            t_pdu.AppendData(b"\x01")
+            raw = bytearray(t_pdu.raw_data)
+            self.assertEqual(len(raw), BHS.LENGTH + 4 + 20 + 4)
+            r_pdu = PDU(raw, True, True)
+            self.assertEqual(r_pdu.PayloadOffset, BHS.LENGTH + 4)
+            self.assertTrue(r_pdu.CheckHeaderDigest())
+            self.assertTrue(r_pdu.CheckDataDigest())
+            raw[-5] ^= 1
+            self.assertFalse(r_pdu.CheckDataDigest())
+            raw[0] ^= 1
+            self.assertFalse(r_pdu.CheckHeaderDigest())
+
+    class TestHeaderCodec(unittest.TestCase):
+        def testUnpack(self):
+            data = TestLoginRespPDU.valid_LoginRespPDU_data
+            hdr = LoginRespPDU(data).Unpack()
+            self.assertEqual(type(hdr), LoginRespPDU.CODEC.record)
+            self.assertEqual(hdr.Opcode, BHS.OPCODE_LOGIN_RES)
+            self.assertEqual(hdr.DataSegmentLength, 0x35)
+            self.assertEqual(hdr.ISID, b"\x80\x04\x09\x00\x00\x00")
+            self.assertEqual(hdr.InitiatorTaskTag, 0x40001)
+            self.assertEqual(hdr.MaxCmdSN, 1)
+            self.assertEqual(BHS(data).Unpack(), hdr)
+            self.assertEqual(HeaderCodec.ForOpcode(0x2A), BHS_CODEC)
+            
+        def testEncode(self):
+            l_pdu = LoginPDU()
+            self.assertEqual(l_pdu.Opcode, BHS.OPCODE_LOGIN_REQ)
+            self.assertTrue(l_pdu.Immediate)
+            l_pdu.Encode(Transit = True, CurrentStage = LoginPDU.LOGIN_OPERATIONAL_NEG,
+                         NextStage = LoginPDU.FULL_FEATURE_PHASE, ISID = b"\x80\x04\x09\x00\x00\x01",
+                         CID = 3, CmdSN = 0xFF12345678)
+            self.assertTrue(l_pdu.Transit)
+            self.assertTrue(l_pdu.Immediate)
+            self.assertEqual(l_pdu.CurrentStage, LoginPDU.LOGIN_OPERATIONAL_NEG)
+            self.assertEqual(l_pdu.NextStage, LoginPDU.FULL_FEATURE_PHASE)
+            self.assertEqual(l_pdu.ISID, b"\x80\x04\x09\x00\x00\x01")
+            self.assertEqual(l_pdu.CID, 3)
+            self.assertEqual(l_pdu.CmdSN, 0x12345678)
+            l_pdu.Encode(Transit = False, CurrentStage = LoginPDU.SECURITY_NEG)
+            self.assertFalse(l_pdu.Transit)
+            self.assertEqual(l_pdu.CurrentStage, LoginPDU.SECURITY_NEG)
+            self.assertEqual(l_pdu.NextStage, LoginPDU.FULL_FEATURE_PHASE)
+            self.assertRaises(ValueError, l_pdu.Encode, StatSN = 1)
+            self.assertEqual(TextPDU().TargetTransferTag, 0xFFFFFFFF)
+            self.assertEqual(LogoutPDU().ReasonCode, LogoutPDU.REASON_CLOSE_SESSION)
+            
+        def testCreate(self):
+            data = TestLoginRespPDU.valid_LoginRespPDU_data
+            self.assertEqual(type(PDU.Create(data)), LoginRespPDU)
+            self.assertEqual(type(PDU.Create(TestLoginPDU.valid_LoginPDU_data)), LoginPDU)
+            self.assertEqual(type(PDU.Create(b"\x3e" + bytes(BHS.LENGTH - 1))), PDU)
+            
+        def testPack(self):
+            data = TestLoginPDU.valid_LoginPDU_data
+            hdr = LoginPDU.CODEC.Unpack(data)
+            self.assertEqual(LoginPDU.CODEC.Pack(hdr), data[:BHS.LENGTH])
+            buf = LoginPDU.CODEC.Pack(Opcode = BHS.OPCODE_LOGIN_REQ, Immediate = True, Transit = True,
+                                      NextStage = LoginPDU.FULL_FEATURE_PHASE, CID = 0xFF1234,
+                                      CmdSN = 7, DataSegmentLength = 0x10FFFFFF)
+            l_pdu = LoginPDU(buf)
+            self.assertEqual(l_pdu.Opcode, BHS.OPCODE_LOGIN_REQ)
+            self.assertTrue(l_pdu.Immediate)
+            self.assertTrue(l_pdu.Transit)
+            self.assertEqual(l_pdu.NextStage, LoginPDU.FULL_FEATURE_PHASE)
+            self.assertEqual(l_pdu.CID, 0x1234)
+            self.assertEqual(l_pdu.CmdSN, 7)
+            self.assertEqual(l_pdu.DataSegmentLength, 0xFFFFFF)
+
+    class TestScsiPDU(unittest.TestCase):
+        def testCdb(self):
+            cdb = Read10Cdb(0x01020304, 0x0506)
+            self.assertEqual(len(cdb), CDB_LENGTH)
+            self.assertEqual(cdb[:10], b"\x28\x00\x01\x02\x03\x04\x00\x05\x06\x00")
+            cdb = Read16Cdb(0x0102030405060708, 0x090A0B0C)
+            self.assertEqual(cdb, b"\x88\x00\x01\x02\x03\x04\x05\x06\x07\x08\x09\x0A\x0B\x0C\x00\x00")
+            
+        def testLun(self):
+            self.assertEqual(EncodeLun(1).to_bytes(8, "big"), b"\x00\x01" + bytes(6))
+            self.assertEqual(EncodeLun(300).to_bytes(8, "big"), b"\x41\x2c" + bytes(6))
+            self.assertRaises(ValueError, EncodeLun, 16384)
+            
+        def testScsiCmd(self):
+            c_pdu = ScsiCmdPDU()
+            c_pdu.Encode(Read = True, LUN = EncodeLun(2), ExpectedDataTransferLength = 4096,
+                         CDB = Read10Cdb(8, 8))
+            self.assertEqual(c_pdu.Opcode, BHS.OPCODE_SCSI_CMD_REQ)
+            self.assertTrue(c_pdu.Final)
+            self.assertTrue(c_pdu.Read)
+            self.assertFalse(c_pdu.Write)
+            self.assertEqual(c_pdu.Attr, ScsiCmdPDU.ATTR_SIMPLE)
+            self.assertEqual(c_pdu.ExpectedDataTransferLength, 4096)
+            self.assertEqual(c_pdu.CDB, Read10Cdb(8, 8))
+            c_pdu.Release()
+            
+        def testDataIn(self):
+            hdr = DataInPDU.CODEC.Pack(Opcode = BHS.OPCODE_DATA_IN, Final = True, StatusPresent = True,
+                                       Underflow = True, InitiatorTaskTag = 9, DataSN = 3,
+                                       BufferOffset = 0x3000, ResidualCount = 512, StatSN = 11,
+                                       DataSegmentLength = 5)
+            d_pdu = PDU.Create(bytes(hdr) + b"abcde\x00\x00\x00")
+            self.assertEqual(type(d_pdu), DataInPDU)
+            self.assertTrue(d_pdu.StatusPresent)
+            self.assertTrue(d_pdu.Underflow)
+            self.assertFalse(d_pdu.Overflow)
+            self.assertEqual(d_pdu.DataSN, 3)
+            self.assertEqual(d_pdu.BufferOffset, 0x3000)
+            self.assertEqual(d_pdu.ResidualCount, 512)
+            self.assertEqual(d_pdu.StatSN, 11)
+            self.assertEqual(d_pdu.payload, b"abcde")
+            
+        def testScsiResp(self):
+            hdr = ScsiRespPDU.CODEC.Pack(Opcode = BHS.OPCODE_SCSI_CMD_RES, Final = True,
+                                         Status = ScsiRespPDU.STATUS_CHECK_CONDITION, DataSegmentLength = 6)
+            r_pdu = PDU.Create(bytes(hdr) + b"\x00\x04\x70\x00\x05\x00\x00\x00")
+            self.assertEqual(type(r_pdu), ScsiRespPDU)
+            self.assertEqual(r_pdu.Response, ScsiRespPDU.RESPONSE_COMPLETED)
+            self.assertEqual(r_pdu.Status, ScsiRespPDU.STATUS_CHECK_CONDITION)
+            self.assertEqual(r_pdu.SenseData, b"\x70\x00\x05\x00")
+
+        def testR2TDataOut(self):
+            hdr = R2TPDU.CODEC.Pack(Opcode = BHS.OPCODE_R2T, Final = True, InitiatorTaskTag = 9,
+                                    TargetTransferTag = 0x77, R2TSN = 2, BufferOffset = 0x10000,
+                                    DesiredDataTransferLength = 0x8000)
+            r2t = PDU.Create(hdr)
+            self.assertEqual(type(r2t), R2TPDU)
+            self.assertEqual(r2t.TargetTransferTag, 0x77)
+            self.assertEqual(r2t.R2TSN, 2)
+            self.assertEqual(r2t.BufferOffset, 0x10000)
+            self.assertEqual(r2t.DesiredDataTransferLength, 0x8000)
+            d_pdu = DataOutPDU()
+            self.assertEqual(d_pdu.TargetTransferTag, 0xFFFFFFFF)
+            d_pdu.Encode(Final = True, TargetTransferTag = r2t.TargetTransferTag, DataSN = 1,
+                         BufferOffset = r2t.BufferOffset)
+            d_pdu.AppendData(memoryview(b"abcdef")[1:4])
+            d_pdu.ExpStatSN = 5
+            self.assertTrue(d_pdu.Final)
+            self.assertEqual(d_pdu.DataSN, 1)
+            self.assertEqual(d_pdu.ExpStatSN, 5)
+            self.assertEqual(bytes(d_pdu.raw_data[BHS.LENGTH:]), b"bcd\x00")
+            d_pdu.Release()
+
+        def testNop(self):
+            n_pdu = NopOutPDU()
+            self.assertTrue(n_pdu.Final)
+            self.assertEqual(n_pdu.TargetTransferTag, 0xFFFFFFFF)
+            n_pdu.Encode(Immediate = True, InitiatorTaskTag = 7, CmdSN = 9)
+            self.assertEqual(n_pdu.CmdSN, 9)
+            n_pdu.Release()
+            nop_in = PDU.Create(bytearray(NopInPDU.CODEC.Pack(Opcode = BHS.OPCODE_NOP_IN, Final = True,
+                                InitiatorTaskTag = 7, TargetTransferTag = 0xFFFFFFFF, StatSN = 3,
+                                ExpCmdSN = 9, MaxCmdSN = 40)))
+            self.assertIsInstance(nop_in, NopInPDU)
+            self.assertEqual((nop_in.InitiatorTaskTag, nop_in.StatSN, nop_in.MaxCmdSN), (7, 3, 40))
+
+    unittest.main()
@@ -0,0 +1,87 @@
+#!/usr/bin/python3
+# Copyright (c) 2015. Harun Emektar
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import struct
+
+# CRC32C (Castagnoli) used for HeaderDigest and DataDigest, RFC 7143 13.1
+POLY = 0x82F63B78 # reflected
+LENGTH = 4
+
+# digest is sent least significant byte first
+U32LE = struct.Struct("<I")
+
+def MakeTables():
+    t0 = []
+    for i in range(256):
+        crc = i
+        for k in range(8):
+            crc = (crc >> 1) ^ POLY if crc & 1 else crc >> 1
+        t0 += [crc]
+    tables = [t0]
+    for n in range(1, 8):
+        prev = tables[-1]
+        tables += [[(prev[i] >> 8) ^ t0[prev[i] & 0xFF] for i in range(256)]]
+    return tables
+
+TABLES = MakeTables()
+
+def Crc32cPython(data, crc = 0):
+    '''
+    Table driven slicing-by-8 CRC32C in pure python
+    @param data: bytes like object
+    @param crc: crc of previous segments, to compute crc incrementally
+    '''
+    t0, t1, t2, t3, t4, t5, t6, t7 = TABLES
+    mv = memoryview(data).cast("B")
+    crc ^= 0xFFFFFFFF
+    n8 = len(mv) & ~7
+    for lo, hi in struct.iter_unpack("<II", mv[:n8]):
+        lo ^= crc
+        crc = (t7[lo & 0xFF] ^ t6[(lo >> 8) & 0xFF] ^ t5[(lo >> 16) & 0xFF] ^ t4[lo >> 24] ^
+               t3[hi & 0xFF] ^ t2[(hi >> 8) & 0xFF] ^ t1[(hi >> 16) & 0xFF] ^ t0[hi >> 24])
+    for b in mv[n8:]:
+        crc = t0[(crc ^ b) & 0xFF] ^ (crc >> 8)
+    return crc ^ 0xFFFFFFFF
+
+# C accelerated backends are used when they are installed
+BACKENDS = {"python":Crc32cPython}
+try:
+    import crc32c as _crc32c
+    BACKENDS["crc32c"] = lambda data, crc = 0: _crc32c.crc32c(data, crc)
+except ImportError:
+    pass
+try:
+    import google_crc32c as _google_crc32c
+    BACKENDS["google_crc32c"] = lambda data, crc = 0: _google_crc32c.extend(crc, data)
+except ImportError:
+    pass
+
+if "crc32c" in BACKENDS:
+    BACKEND = "crc32c"
+elif "google_crc32c" in BACKENDS:
+    BACKEND = "google_crc32c"
+else:
+    BACKEND = "python"
+Crc32c = BACKENDS[BACKEND]
+
+def Digest(bufs):
+    '''
+    Returns 4 byte digest of buffers as if they were concatenated
+    @param bufs: list of bytes like objects, scatter-gather segments
+    '''
+    crc = 0
+    for b in bufs:
+        crc = Crc32c(b, crc)
+    return U32LE.pack(crc)
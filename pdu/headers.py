@@ -14,7 +14,16 @@
 #
 
 from utils import ntoi,iton
+from collections import namedtuple
+from operator import itemgetter
 import logging
+import struct
+
+# precompiled big endian accessors for header fields
+U8 = struct.Struct(">B")
+U16 = struct.Struct(">H")
+U32 = struct.Struct(">I")
+U64 = struct.Struct(">Q")
 
 #BHS
 #Byte/      0       |       1       |       2       |       3       |
@@ -36,6 +45,8 @@ import logging
 #   +---------------+---------------+---------------+---------------+
 #48
 class BHS():
+    __slots__ = ("__data",)
+    
     # logger for Login pdu
     logger = logging.getLogger("BHS")
     logger.setLevel(logging.DEBUG)
@@ -74,7 +85,7 @@ class BHS():
                  OPCODE_TEXT_RES, OPCODE_DATA_IN, OPCODE_LOGOUT_RES, OPCODE_R2T,
                  OPCODE_ASYNC_MSG, OPCODE_REJECT)
     def __init__(self,  data):
-        if not isinstance(data, (str, bytes, bytearray)):
+        if not isinstance(data, (bytes, bytearray, memoryview)):
             raise TypeError
         if len(data) < self.LENGTH:
             raise ValueError
@@ -110,9 +121,20 @@ class BHS():
         else:
             raise TypeError
     
+    @property
+    def data(self):
+        # underlying buffer, header starts at offset 0
+        return self.__data
+    
+    def Unpack(self):
+        '''
+        Decode whole header with the codec registered for its opcode
+        '''
+        return HeaderCodec.ForOpcode(self.Opcode).Unpack(self.__data)
+    
     @property
     def Opcode(self):
-        return ntoi(self.__data[0]) & self.__OPCODE_MASK
+        return self.__data[0] & self.__OPCODE_MASK
     
     @Opcode.setter
     def Opcode(self, ocode):
@@ -122,7 +144,7 @@ class BHS():
     
     @property
     def Immediate(self):
-        if ntoi(self.__data[0]) & self.__IMMEDIATE_MASK :
+        if self.__data[0] & self.__IMMEDIATE_MASK :
             return True
         else:
             return False
@@ -136,7 +158,7 @@ class BHS():
     
     @property
     def Final(self):
-        if ord(self.__data[1]) & self.__FINAL_MASK :
+        if self.__data[1] & self.__FINAL_MASK :
             return True
         else :
             return False
@@ -150,37 +172,226 @@ class BHS():
         
     @property
     def TotalAHSLength(self):
-        return ntoi(self.__data[4]) # in units of 4 byte words
+        return self.__data[4] # in units of 4 byte words
     
     @TotalAHSLength.setter
     def TotalAHSLength(self, tashl):
         if tashl > 0xFF or tashl < 0:
             self.logger.warn("TotalAHSLength(%d) is invalid" % tashl)
-        self.__data[4] = tashl
+        self.__data[4] = tashl & 0xFF
     
     @property
     def DataSegmentLength(self):
-        return ntoi(self.__data[5:8])
+        return U32.unpack_from(self.__data, 4)[0] & 0xFFFFFF
     
     @DataSegmentLength.setter
     def DataSegmentLength(self, dsl):
         if dsl > 0xFFFFFF or dsl < 0:
             self.logger.warn("DataSegmentLength(%d) is bigger than 3 bytes" % dsl)
-        self.__data[5:8] = iton(dsl, 3)
+        self.__data[5:8] = (dsl & 0xFFFFFF).to_bytes(3, "big")
         
     @property
     def LUN(self):
-        pass
+        return U64.unpack_from(self.__data, 8)[0]
+    
+    @LUN.setter
+    def LUN(self, lun):
+        U64.pack_into(self.__data, 8, lun & 0xFFFFFFFFFFFFFFFF)
     
     @property
     def InitiatorTaskTag(self):
-        return ntoi(self.__data[16:20])
+        return U32.unpack_from(self.__data, 16)[0]
     
     @InitiatorTaskTag.setter
     def InitiatorTaskTag(self, itt):
         if itt > 0xFFFFFFFF or itt < 0:
             self.logger.warn("InitiatorTaskTag(%d) is bigger than 4 bytes" % itt)
-        self.__data[16:20] = iton(itt, 4)
+        U32.pack_into(self.__data, 16, itt & 0xFFFFFFFF)
+
+class HeaderCodec():
+    '''
+    Precompiled layout of a BHS. The whole header is unpacked into a record
+    (namedtuple) with one struct call and packed back the same way.
+    @param name: name of the record type
+    @param layout: (field, struct format) pairs covering BHS.LENGTH bytes,
+    field None is padding, fields starting with "_" only carry bit fields
+    @param bits: (field, carrier, shift, mask) tuples
+    @param opcodes: opcodes the codec is registered for
+    '''
+    __codecs = {} # opcode:codec
+    __masks = {"B":0xFF, "H":0xFFFF, "I":0xFFFFFFFF, "Q":0xFFFFFFFFFFFFFFFF}
+    
+    def __init__(self, name, layout, bits = (), opcodes = ()):
+        fmt = ">"
+        raw = []
+        offsets = [] # offset of each raw value in header
+        for field, f in layout:
+            if field != None:
+                raw += [(field, f)]
+                offsets += [struct.calcsize(fmt)]
+            fmt += f
+        self.__struct = struct.Struct(fmt)
+        if self.__struct.size != BHS.LENGTH:
+            raise ValueError
+        raw_names = [r[0] for r in raw]
+        self.__defaults = [bytes(int(f[:-1])) if f.endswith("s") else 0 for n, f in raw]
+        self.__direct = tuple((i, raw_names[i], self.__masks.get(raw[i][1]))
+                              for i in range(len(raw)) if not raw_names[i].startswith("_"))
+        self.__bits = tuple((name, raw_names.index(carrier), shift, mask)
+                            for name, carrier, shift, mask in bits)
+        self.fields = tuple([d[1] for d in self.__direct] + [b[0] for b in self.__bits])
+        self.record = namedtuple(name, self.fields)
+        self.__writers = {} # field names:writer
+        # field:(offset, struct format, shift, mask) of its raw value,
+        # shift is None when field is the whole value
+        self.__index = {}
+        for i, name, mask in self.__direct:
+            self.__index[name] = (offsets[i], raw[i][1], None, mask)
+        for name, c, shift, mask in self.__bits:
+            self.__index[name] = (offsets[c], raw[c][1], shift, mask)
+        for opcode in opcodes:
+            self.__codecs[opcode] = self
+    
+    @property
+    def size(self):
+        return self.__struct.size
+    
+    @classmethod
+    def ForOpcode(cls, opcode):
+        '''
+        Returns codec registered for opcode, generic BHS codec if there is none
+        '''
+        return cls.__codecs.get(opcode, BHS_CODEC)
+    
+    def Unpack(self, data):
+        '''
+        Decode header at the beginning of data into a record
+        '''
+        vals = self.__struct.unpack_from(data, 0)
+        out = [vals[i] for i, name, mask in self.__direct]
+        out += [(vals[c] >> shift) & mask for name, c, shift, mask in self.__bits]
+        return self.record._make(out)
+    
+    def PackInto(self, buf, record = None, **fields):
+        '''
+        Encode whole header into buf, fields not given are zero
+        @param record: record returned from Unpack, fields are used instead
+        '''
+        if record != None:
+            fields = record._asdict()
+        raw = self.__defaults[:]
+        for i, name, mask in self.__direct:
+            if name in fields:
+                v = fields[name]
+                raw[i] = v & mask if mask != None else bytes(v)
+        for name, c, shift, mask in self.__bits:
+            if name in fields:
+                raw[c] |= (int(fields[name]) & mask) << shift
+        self.__struct.pack_into(buf, 0, *raw)
+        return buf
+    
+    def __Compile(self, names):
+        # adjacent whole fields are packed by one struct, bit fields sharing
+        # a raw value are merged into it with one read-modify-write
+        whole = sorted((self.__index[name][0], name) for name in names if self.__index[name][2] == None)
+        spans = [] # [offset, struct format, field names, masks] of adjacent fields
+        for offset, name in whole:
+            f, mask = self.__index[name][1], self.__index[name][3]
+            if len(spans) != 0 and spans[-1][0] + struct.calcsize(">" + spans[-1][1]) == offset:
+                spans[-1][1] += f
+                spans[-1][2] += [name]
+                spans[-1][3] += [mask]
+            else:
+                spans += [[offset, f, [name], [mask]]]
+        # (pack_into, offset, value getter, (name, mask) of fields), a getter
+        # of more than one field returns a tuple to be unpacked
+        singles = tuple((struct.Struct(">" + f).pack_into, offset, itemgetter(*run), tuple(zip(run, masks)))
+                        for offset, f, run, masks in spans if len(run) == 1)
+        runs = tuple((struct.Struct(">" + f).pack_into, offset, itemgetter(*run), tuple(zip(run, masks)))
+                     for offset, f, run, masks in spans if len(run) > 1)
+        carriers = {} # offset:(struct format, [(name, shift, mask)])
+        for name in names:
+            offset, f, shift, mask = self.__index[name]
+            if shift != None:
+                carriers.setdefault(offset, (f, []))[1].append((name, shift, mask))
+        bytes_bits = [] # (offset, kept bits, bits) of single byte raw values
+        words_bits = [] # (pack_into, unpack_from, offset, kept bits, bits) of wider ones
+        for offset, (f, bits) in carriers.items():
+            keep = self.__masks[f]
+            for name, shift, mask in bits:
+                keep &= ~(mask << shift)
+            if f == "B":
+                bytes_bits += [(offset, keep, tuple(bits))]
+            else:
+                s = struct.Struct(">" + f)
+                words_bits += [(s.pack_into, s.unpack_from, offset, keep, tuple(bits))]
+        bytes_bits = tuple(bytes_bits)
+        words_bits = tuple(words_bits)
+        
+        def Masked(fields, masked):
+            # values out of range of their field are cut as setters do
+            return [bytes(fields[name]) if mask == None else fields[name] & mask for name, mask in masked]
+        
+        def Write(buf, fields):
+            for pack_into, offset, get, masked in singles:
+                try:
+                    pack_into(buf, offset, get(fields))
+                except (struct.error, TypeError):
+                    pack_into(buf, offset, *Masked(fields, masked))
+            for pack_into, offset, get, masked in runs:
+                try:
+                    pack_into(buf, offset, *get(fields))
+                except (struct.error, TypeError):
+                    pack_into(buf, offset, *Masked(fields, masked))
+            for offset, keep, bits in bytes_bits:
+                v = buf[offset] & keep
+                for name, shift, mask in bits:
+                    v |= (fields[name] & mask) << shift
+                buf[offset] = v
+            for pack_into, unpack_from, offset, keep, bits in words_bits:
+                v = unpack_from(buf, offset)[0] & keep
+                for name, shift, mask in bits:
+                    v |= (fields[name] & mask) << shift
+                pack_into(buf, offset, v)
+        return Write
+    
+    def Writer(self, names):
+        '''
+        Returns function(buf, fields) writing the named fields, one is
+        compiled for each combination of names
+        @param names: tuple of field names
+        '''
+        writer = self.__writers.get(names)
+        if writer != None:
+            return writer
+        for name in names:
+            if name not in self.__index:
+                raise ValueError("%s has no field %s" % (self.record.__name__, name))
+        writer = self.__writers[names] = self.__Compile(names)
+        return writer
+    
+    def Update(self, buf, **fields):
+        '''
+        Write given fields into header in buf, other fields keep their
+        values
+        '''
+        self.Writer(tuple(fields))(buf, fields)
+        return buf
+    
+    def Pack(self, record = None, **fields):
+        '''
+        Encode header into a new buffer
+        '''
+        return self.PackInto(bytearray(BHS.LENGTH), record, **fields)
+
+# bit fields every opcode shares
+BHS_BITS = (("Opcode", "_b0", 0, 0x3F), ("Immediate", "_b0", 6, 1),
+            ("TotalAHSLength", "_w1", 24, 0xFF), ("DataSegmentLength", "_w1", 0, 0xFFFFFF))
+
+BHS_CODEC = HeaderCodec("Header",
+                        (("_b0", "B"), ("_b1", "B"), (None, "2x"), ("_w1", "I"),
+                         ("LUN", "Q"), ("InitiatorTaskTag", "I"), (None, "28x")),
+                        BHS_BITS + (("Final", "_b1", 7, 1),))
 
 #AHS
 #Byte/      0       |       1       |       2       |       3       |
@@ -48,7 +48,12 @@ else:
 #48/ DataSegment - Login Parameters in Text request Format          /
 # +/                                                                /
 #  +---------------+---------------+---------------+---------------+        
+LOGIN_BITS = BHS_BITS + (("Transit", "_b1", 7, 1), ("Continue", "_b1", 6, 1),
+                         ("CurrentStage", "_b1", 2, 0x03), ("NextStage", "_b1", 0, 0x03))
+
 class LoginCmnPDU(PDU):
+    __slots__ = ()
+    
     # logger for Login pdu
     logger = logging.getLogger("Login PDU")
     logger.setLevel(logging.DEBUG)
@@ -69,79 +74,79 @@ class LoginCmnPDU(PDU):
         
     @property
     def Transit(self):
-        if ntoi(self.bhs[1]) & self.TRANSIT_MASK:
+        if self.data[1] & self.TRANSIT_MASK:
             return True
         else:
             return False
     @Transit.setter
     def Transit(self, t):
         if t:
-            self.bhs[1] |= self.TRANSIT_MASK
+            self.data[1] |= self.TRANSIT_MASK
         else:
-            self.bhs[1] &= ~self.TRANSIT_MASK
+            self.data[1] &= ~self.TRANSIT_MASK
     
     @property
     def Continue(self):
-        if ntoi(self.bhs[1]) & self.CONTINUE_MASK:
+        if self.data[1] & self.CONTINUE_MASK:
             return True
         else:
             return False
     @Continue.setter
     def Continue(self, c):
         if c:
-            self.bhs[1] |= self.CONTINUE_MASK
+            self.data[1] |= self.CONTINUE_MASK
         else:
-            self.bhs[1] &= ~self.CONTINUE_MASK
+            self.data[1] &= ~self.CONTINUE_MASK
     
     @property
     def CurrentStage(self):
-        return (ntoi(self.bhs[1]) & self.CURRENT_STAGE_MASK) >> 2
+        return (self.data[1] & self.CURRENT_STAGE_MASK) >> 2
     
     @CurrentStage.setter
     def CurrentStage(self, cs):
         if cs not in self.__stages:
             raise ValueError
-        self.bhs[1] |= cs << 2
+        self.data[1] = (self.data[1] & ~self.CURRENT_STAGE_MASK) | (cs << 2)
     
     @property
     def NextStage(self):
-        return ntoi(self.bhs[1]) & self.NEXT_STAGE_MASK
+        return self.data[1] & self.NEXT_STAGE_MASK
     
     @NextStage.setter
     def NextStage(self, ns):
         if ns not in self.__stages:
             raise ValueError
-        self.bhs[1] |= ns
+        self.data[1] = (self.data[1] & ~self.NEXT_STAGE_MASK) | ns
     
     @property
     def VersionMax(self):
-        return ntoi(self.bhs[2])
+        return self.data[2]
     
     @VersionMax.setter
     def VersionMax(self,vmax):
         if vmax > 0xFF or vmax < 0:
             self.logger.warn("VersionMax(%d) i bigger than 1 byte" % vmax)
-        self.bhs[2] = vmax
+        self.data[2] = vmax
     
     @property
     def ISID(self):
-        return ISID(raw = self.bhs[8:14])
+        return ISID(raw = self.data[8:14])
     
     @ISID.setter
     def ISID(self, isid):
         if not isinstance(isid, ISID):
             raise TypeError
-        self.bhs[8:14] = isid.raw_data
+        self.data[8:14] = isid.raw_data
     
     @property
     def TSIH(self):
-        return ntoi(self.bhs[14:16])
+        return U16.unpack_from(self.data, 14)[0]
     
     @TSIH.setter
     def TSIH(self, tsih):
         if tsih > 0xFFFF or tsih < 0:
             self.logger.warn("TSIH(%d) is bigger than 2 bytes" % tsih)
-        self.bhs[14:16] = iton(tsih, 2)
+        U16.pack_into(self.data, 14, tsih & 0xFFFF)
         
 #Byte/     0       |       1        |      2       |        3      |
 #    /             |                |              |               |
@@ -166,6 +171,8 @@ class LoginCmnPDU(PDU):
 #11b A,B,C&D Reserved
 
 class ISID():
+    __slots__ = ("__raw",)
+    
     LENGTH = 6
     T_OUI = 0
     T_EN = 1
@@ -184,7 +191,7 @@ class ISID():
             self.C = seq[3]
             self.D = seq[4]
         else:
-            if not isinstance(raw, (str, bytes, bytearray)):
+            if not isinstance(raw, (str, bytes, bytearray, memoryview)):
                 raise TypeError
             if len(raw) != self.LENGTH:
                 raise ValueError
@@ -194,9 +201,9 @@ class ISID():
         self.__raw.__getitem__(key)
         
     def __eq__(self, other):
-        if not isinstance(other, (str, bytes, bytearray, ISID)):
+        if not isinstance(other, (str, bytes, bytearray, memoryview, ISID)):
             raise TypeError
-        if isinstance(other, (str, bytes, bytearray)) and len(other) != self.LENGTH:
+        if isinstance(other, (str, bytes, bytearray, memoryview)) and len(other) != self.LENGTH:
             raise ValueError
         if other == self.__raw:
             return True
@@ -243,7 +250,7 @@ class ISID():
     def D(self):
         return ntoi(self.__raw[4:6])
     
-    @B.setter
+    @D.setter
     def D(self, d):
         self.__raw[4:6] = iton(d, 2)
 
@@ -253,54 +260,54 @@ class ISID():
 
 
 class LoginPDU(LoginCmnPDU):
-    def __init__(self, data = None, header_digest = None, data_digest= None):
-        super().__init__(data, header_digest, data_digest)
-        if data == None:
-            self.Opcode = BHS.OPCODE_LOGIN_REQ
-            self.Immediate = True
-        
+    __slots__ = ()
+    
+    CODEC = HeaderCodec("LoginHeader",
+                        (("_b0", "B"), ("_b1", "B"), ("VersionMax", "B"), ("VersionMin", "B"),
+                         ("_w1", "I"), ("ISID", "6s"), ("TSIH", "H"), ("InitiatorTaskTag", "I"),
+                         ("CID", "H"), (None, "2x"), ("CmdSN", "I"), ("ExpStatSN", "I"), (None, "16x")),
+                        LOGIN_BITS, (BHS.OPCODE_LOGIN_REQ,))
+    TEMPLATE = bytes(CODEC.Pack(Opcode = BHS.OPCODE_LOGIN_REQ, Immediate = True))
+    
     @property
     def VersionMin(self):
-        return ntoi(self.bhs[3])
+        return self.data[3]
     
     @VersionMin.setter
     def VersionMin(self, vmin):
         if vmin > 0xFF or vmin < 0:
             self.logger.warn("VersionMin(%d) is bigger than 1 byte" % vmin)
-        self.bhs[3] = vmin
+        self.data[3] = vmin
             
     @property
     def CID(self):
-        return ntoi(self.bhs[20:22])
+        return U16.unpack_from(self.data, 20)[0]
     
     @CID.setter
     def CID(self, cid):
         if cid > 0xFFFF or cid < 0:
             self.logger.warn("CID(%d) is bigger than 2 bytes" % cid)
-        n_cid = iton(cid, 2)
-        self.bhs[20:22] = n_cid
+        U16.pack_into(self.data, 20, cid & 0xFFFF)
     
     @property
     def CmdSN(self):
-        return ntoi(self.bhs[24:28])
+        return U32.unpack_from(self.data, 24)[0]
     
     @CmdSN.setter
     def CmdSN(self, cmdsn):
         if cmdsn > 0xFFFFFFFF or cmdsn < 0:
             self.logger.warn("cmdsn(%d) is bigger than 4 bytes" % cmdsn)
-        n_cmdsn = iton(cmdsn, 4)
-        self.bhs[24:28] = n_cmdsn
+        U32.pack_into(self.data, 24, cmdsn & 0xFFFFFFFF)
     
     @property
     def ExpStatSN(self):
-        return ntoi(self.bhs[28:32])
+        return U32.unpack_from(self.data, 28)[0]
     
     @ExpStatSN.setter
     def ExpStatSN(self, expstatsn):
         if expstatsn > 0xFFFFFFFF or expstatsn < 0:
             self.logger.warn("expstatsn(%d) is bigger than 4 bytes" % expstatsn)
-        n_expstatsn = iton(expstatsn, 4)
-        self.bhs[28:32] = n_expstatsn
+        U32.pack_into(self.data, 28, expstatsn & 0xFFFFFFFF)
         
     
 #Byte/      0      |       1       |       2       |       3       |
@@ -334,6 +341,15 @@ class LoginPDU(LoginCmnPDU):
 # +/                                                               /
 #  +---------------+---------------+---------------+---------------+
 class LoginRespPDU(LoginCmnPDU):
+    __slots__ = ()
+    
+    CODEC = HeaderCodec("LoginRespHeader",
+                        (("_b0", "B"), ("_b1", "B"), ("VersionMax", "B"), ("VersionActive", "B"),
+                         ("_w1", "I"), ("ISID", "6s"), ("TSIH", "H"), ("InitiatorTaskTag", "I"),
+                         (None, "4x"), ("StatSN", "I"), ("ExpCmdSN", "I"), ("MaxCmdSN", "I"),
+                         ("StatusClass", "B"), ("StatusDetail", "B"), (None, "10x")),
+                        LOGIN_BITS, (BHS.OPCODE_LOGIN_RES,))
+    
     STATUS_CLASS_SUCCESS = 0
     
     STATUS_CLASS_REDIR = 1
@@ -361,24 +377,27 @@ class LoginRespPDU(LoginCmnPDU):
     
     @property
     def VersionActive(self):
-        return ord(self.bhs[3])
+        return self.data[3]
         
     @property
     def StatSN(self):
-        return ntoi(self.bhs[24:28])
+        return U32.unpack_from(self.data, 24)[0]
     
     @property
     def ExpCmdSN(self):
-        return ntoi(self.bhs[28:32])
+        return U32.unpack_from(self.data, 28)[0]
     
     @property
     def MaxCmdSN(self):
-        return ntoi(self.bhs[32:36])
+        return U32.unpack_from(self.data, 32)[0]
     
     @property
     def StatusClass(self):
-        return ord(self.bhs[36:37])
+        return self.data[36]
     
     @property
     def StatusDetail(self):
-        return ord(self.bhs[37:38])
+        return self.data[37]
+
+PDU.Register(BHS.OPCODE_LOGIN_REQ, LoginPDU)
+PDU.Register(BHS.OPCODE_LOGIN_RES, LoginRespPDU)
@@ -13,7 +13,7 @@
 # limitations under the License.
 #
 
-if __name__ == "text_pdu":
+if __name__ == "logout_pdu":
     from pdu_common import *
 else:
     from .pdu_common import *
@@ -44,6 +44,8 @@ else:
 #48| Header-Digest (Optional)                                      |
 #  +---------------+---------------+---------------+---------------+
 class LogoutPDU(PDU):
+    __slots__ = ()
+    
     # logger for Login pdu
     logger = logging.getLogger("Logout PDU")
     logger.setLevel(logging.DEBUG)
@@ -56,55 +58,54 @@ class LogoutPDU(PDU):
     REASON_CONN_RECOVERY = 2
     
     __reasons = (REASON_CLOSE_CONN, REASON_CLOSE_SESSION, REASON_CONN_RECOVERY)
-
-    def __init__(self, data = None, header_digest = None, data_digest= None):
-        super().__init__(data, header_digest, data_digest)
-        if data == None:
-            self.Opcode = BHS.OPCODE_LOGOUT_REQ
-            self[1] = 0x80
+    
+    CODEC = HeaderCodec("LogoutHeader",
+                        (("_b0", "B"), ("_b1", "B"), (None, "2x"), ("_w1", "I"), (None, "8x"),
+                         ("InitiatorTaskTag", "I"), ("CID", "H"), (None, "2x"),
+                         ("CmdSN", "I"), ("ExpStatSN", "I"), (None, "16x")),
+                        BHS_BITS + (("Final", "_b1", 7, 1), ("ReasonCode", "_b1", 0, 0x7F)),
+                        (BHS.OPCODE_LOGOUT_REQ,))
+    TEMPLATE = bytes(CODEC.Pack(Opcode = BHS.OPCODE_LOGOUT_REQ, Final = True))
 
     @property
     def ReasonCode(self):
-        return ntoi(self.bhs[1]) & 0x7F
+        return self.data[1] & 0x7F
     
     @ReasonCode.setter
     def ReasonCode(self, rcode):
         if rcode not in self.__reasons:
             raise ValueError
-        self.bhs[1] |= rcode
+        self.data[1] = (self.data[1] & 0x80) | rcode
     
     @property
     def CID(self):
-        return ntoi(self.bhs[20:22])
+        return U16.unpack_from(self.data, 20)[0]
     
     @CID.setter
     def CID(self, cid):
         if cid > 0xFFFF or cid < 0:
             self.logger.warn("CID(%d) is bigger than 2 bytes" % cid)
-        n_cid = iton(cid, 2)
-        self.bhs[20:22] = n_cid
+        U16.pack_into(self.data, 20, cid & 0xFFFF)
     
     @property 
     def CmdSN(self):
-        return ntoi(self.bhs[24:28])
+        return U32.unpack_from(self.data, 24)[0]
     
     @CmdSN.setter
     def CmdSN(self, cmdsn):
         if cmdsn > 0xFFFFFFFF or cmdsn < 0:
             self.logger.warn("cmdsn(%d) is bigger than 4 bytes" % cmdsn)
-        n_cmdsn = iton(cmdsn, 4)
-        self.bhs[24:28] = n_cmdsn
+        U32.pack_into(self.data, 24, cmdsn & 0xFFFFFFFF)
     
     @property 
     def ExpStatSN(self):
-        return ntoi(self.bhs[28:32])
+        return U32.unpack_from(self.data, 28)[0]
     
     @ExpStatSN.setter
     def ExpStatSN(self, expstatsn):
         if expstatsn > 0xFFFFFFFF or expstatsn < 0:
             self.logger.warn("expstatsn(%d) is bigger than 4 bytes" % expstatsn)
-        n_expstatsn = iton(expstatsn, 4)
-        self.bhs[28:32] = n_expstatsn
+        U32.pack_into(self.data, 28, expstatsn & 0xFFFFFFFF)
 
 #Byte/      0      |       1       |       2       |       3       |
 #    /             |               |               |               |
@@ -137,32 +138,45 @@ class LogoutPDU(PDU):
 #  +---------------+---------------+---------------+---------------+
 
 class LogoutRespPDU(PDU):
+    __slots__ = ()
+    
     RESPONSE_SUCC = 0
     RESPONSE_CID_NOT_FOUND = 1
     RESPONSE_RECOVERY_NOT_SUPPORTED = 2
     RESPONSE_FAIL = 3
     
     __responses = (RESPONSE_SUCC, RESPONSE_CID_NOT_FOUND, RESPONSE_RECOVERY_NOT_SUPPORTED, RESPONSE_FAIL)
+    
+    CODEC = HeaderCodec("LogoutRespHeader",
+                        (("_b0", "B"), ("_b1", "B"), ("Response", "B"), (None, "x"), ("_w1", "I"),
+                         (None, "8x"), ("InitiatorTaskTag", "I"), (None, "4x"), ("StatSN", "I"),
+                         ("ExpCmdSN", "I"), ("MaxCmdSN", "I"), (None, "4x"),
+                         ("Time2Wait", "H"), ("Time2Retain", "H"), (None, "4x")),
+                        BHS_BITS + (("Final", "_b1", 7, 1),),
+                        (BHS.OPCODE_LOGOUT_RES,))
     @property 
     def Response(self):
-        return ntoi(self.bhs[2])
+        return self.data[2]
     
     @property
     def StatSN(self):
-        return ntoi(self.bhs[24:28])
+        return U32.unpack_from(self.data, 24)[0]
     
     @property
     def ExpCmdSN(self):
-        return ntoi(self.bhs[28:32])
+        return U32.unpack_from(self.data, 28)[0]
     
     @property
     def MaxCmdSN(self):
-        return ntoi(self.bhs[32:36])
+        return U32.unpack_from(self.data, 32)[0]
     
     @property 
     def Time2Wait(self):
-        return ntoi(self.bhs[40:42])
+        return U16.unpack_from(self.data, 40)[0]
     
     @property 
     def Time2Retain(self):
-        return ntoi(self.bhs[42:44])
+        return U16.unpack_from(self.data, 42)[0]
+
+PDU.Register(BHS.OPCODE_LOGOUT_REQ, LogoutPDU)
+PDU.Register(BHS.OPCODE_LOGOUT_RES, LogoutRespPDU)
@@ -0,0 +1,134 @@
+#!/usr/bin/python3
+# Copyright (c) 2015. Harun Emektar
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+if __name__ == "nop_pdu":
+    from pdu_common import *
+else:
+    from .pdu_common import *
+
+#Byte/     0       |       1       |       2       |       3       |
+#    /             |               |               |               |
+#  |0 1 2 3 4 5 6 7|0 1 2 3 4 5 6 7|0 1 2 3 4 5 6 7|0 1 2 3 4 5 6 7|
+#  +---------------+---------------+---------------+---------------+
+# 0|.|I| 0x00      |1| Reserved                                    |
+#  +---------------+---------------+---------------+---------------+
+# 4|TotalAHSLength | DataSegmentLength                             |
+#  +---------------+---------------+---------------+---------------+
+# 8| LUN or Reserved                                               |
+#  +                                                               +
+#12|                                                               |
+#  +---------------+---------------+---------------+---------------+
+#16| Initiator Task Tag or 0xffffffff                              |
+#  +---------------+---------------+---------------+---------------+
+#20| Target Transfer Tag or 0xffffffff                             |
+#  +---------------+---------------+---------------+---------------+
+#24| CmdSN                                                         |
+#  +---------------+---------------+---------------+---------------+
+#28| ExpStatSN                                                     |
+#  +---------------+---------------+---------------+---------------+
+#32/ Reserved                                                      /
+# +/                                                               /
+#  +---------------+---------------+---------------+---------------+
+#48| Header-Digest (Optional)                                      |
+#  +---------------+---------------+---------------+---------------+
+#  / DataSegment - Ping Data (optional)                            /
+#  +---------------+---------------+---------------+---------------+
+class NopOutPDU(PDU):
+    __slots__ = ()
+
+    CODEC = HeaderCodec("NopOutHeader",
+                        (("_b0", "B"), ("_b1", "B"), (None, "2x"), ("_w1", "I"), ("LUN", "Q"),
+                         ("InitiatorTaskTag", "I"), ("TargetTransferTag", "I"), ("CmdSN", "I"),
+                         ("ExpStatSN", "I"), (None, "16x")),
+                        BHS_BITS + (("Final", "_b1", 7, 1),), (BHS.OPCODE_NOP_OUT,))
+    TEMPLATE = bytes(CODEC.Pack(Opcode = BHS.OPCODE_NOP_OUT, Final = True,
+                                TargetTransferTag = 0xFFFFFFFF))
+
+    @property
+    def TargetTransferTag(self):
+        return U32.unpack_from(self.data, 20)[0]
+
+    @property
+    def CmdSN(self):
+        return U32.unpack_from(self.data, 24)[0]
+
+    @CmdSN.setter
+    def CmdSN(self, cmdsn):
+        U32.pack_into(self.data, 24, cmdsn & 0xFFFFFFFF)
+
+    @property
+    def ExpStatSN(self):
+        return U32.unpack_from(self.data, 28)[0]
+
+    @ExpStatSN.setter
+    def ExpStatSN(self, expstatsn):
+        U32.pack_into(self.data, 28, expstatsn & 0xFFFFFFFF)
+
+#Byte/     0       |       1       |       2       |       3       |
+#    /             |               |               |               |
+#  |0 1 2 3 4 5 6 7|0 1 2 3 4 5 6 7|0 1 2 3 4 5 6 7|0 1 2 3 4 5 6 7|
+#  +---------------+---------------+---------------+---------------+
+# 0|.|.| 0x20      |1| Reserved                                    |
+#  +---------------+---------------+---------------+---------------+
+# 4|TotalAHSLength | DataSegmentLength                             |
+#  +---------------+---------------+---------------+---------------+
+# 8| LUN or Reserved                                               |
+#  +                                                               +
+#12|                                                               |
+#  +---------------+---------------+---------------+---------------+
+#16| Initiator Task Tag or 0xffffffff                              |
+#  +---------------+---------------+---------------+---------------+
+#20| Target Transfer Tag or 0xffffffff                             |
+#  +---------------+---------------+---------------+---------------+
+#24| StatSN                                                        |
+#  +---------------+---------------+---------------+---------------+
+#28| ExpCmdSN                                                      |
+#  +---------------+---------------+---------------+---------------+
+#32| MaxCmdSN                                                      |
+#  +---------------+---------------+---------------+---------------+
+#36/ Reserved                                                      /
+# +/                                                               /
+#  +---------------+---------------+---------------+---------------+
+#48| Header-Digest (Optional)                                      |
+#  +---------------+---------------+---------------+---------------+
+#  / DataSegment - Return Ping Data                                /
+#  +---------------+---------------+---------------+---------------+
+class NopInPDU(PDU):
+    __slots__ = ()
+
+    CODEC = HeaderCodec("NopInHeader",
+                        (("_b0", "B"), ("_b1", "B"), (None, "2x"), ("_w1", "I"), ("LUN", "Q"),
+                         ("InitiatorTaskTag", "I"), ("TargetTransferTag", "I"), ("StatSN", "I"),
+                         ("ExpCmdSN", "I"), ("MaxCmdSN", "I"), (None, "12x")),
+                        BHS_BITS + (("Final", "_b1", 7, 1),), (BHS.OPCODE_NOP_IN,))
+
+    @property
+    def TargetTransferTag(self):
+        return U32.unpack_from(self.data, 20)[0]
+
+    @property
+    def StatSN(self):
+        return U32.unpack_from(self.data, 24)[0]
+
+    @property
+    def ExpCmdSN(self):
+        return U32.unpack_from(self.data, 28)[0]
+
+    @property
+    def MaxCmdSN(self):
+        return U32.unpack_from(self.data, 32)[0]
+
+PDU.Register(BHS.OPCODE_NOP_OUT, NopOutPDU)
+PDU.Register(BHS.OPCODE_NOP_IN, NopInPDU)
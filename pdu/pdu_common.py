@@ -15,8 +15,10 @@
 
 if __name__ == "pdu_common":
     from  headers import *
+    import digest
 else:
     from .headers import *
+    from . import digest
 #Byte/     0       |        1      |       2       |       3       |
 #    /             |               |               |               |
 #  |0 1 2 3 4 5 6 7|0 1 2 3 4 5 6 7|0 1 2 3 4 5 6 7|0 1 2 3 4 5 6 7|
@@ -47,17 +49,82 @@ else:
 # +/                                                               /
 #  +---------------+---------------+---------------+---------------+
 
-class PDU(object):
-    def __init__(self,  data, header_digest = False, data_digest = False):
+# padding for data segment length modulo 4
+PADDING = (b"", b"\x00\x00\x00", b"\x00\x00", b"\x00")
+
+class BufferPool():
+    '''
+    Bounded free lists of header and data segment buffers. PDUs built for
+    sending borrow their buffers here and give them back with Release once
+    they are sent or their task is completed, so a steady stream of pdus
+    doesn't allocate new buffers.
+    @param max_headers: max number of free header buffers kept
+    @param max_data: max number of free data segment buffers kept
+    @param data_size: size of data segment buffers, MaxRecvDataSegmentLength
+    '''
+    def __init__(self, max_headers = 1024, max_data = 64, data_size = 8192):
+        self.__max_headers = max_headers
+        self.__max_data = max_data
+        self.__data_size = data_size
+        self.__headers = []
+        self.__data = []
+        
+    @property
+    def data_size(self):
+        return self.__data_size
+    
+    def Resize(self, data_size):
+        '''
+        Change size of data segment buffers, e.g. after MaxRecvDataSegmentLength
+        is negotiated. Free buffers of the old size are dropped.
+        '''
+        if data_size != self.__data_size:
+            self.__data_size = data_size
+            self.__data = []
+    
+    def GetHeader(self):
+        try:
+            return self.__headers.pop()
+        except IndexError:
+            return bytearray(BHS.LENGTH)
+    
+    def PutHeader(self, buf):
+        # no need to zero, pdus copy their template over it
+        if len(self.__headers) < self.__max_headers:
+            self.__headers.append(buf)
+    
+    def GetData(self):
+        try:
+            return self.__data.pop()
+        except IndexError:
+            return bytearray(self.__data_size)
+    
+    def PutData(self, buf):
+        if len(buf) == self.__data_size and len(self.__data) < self.__max_data:
+            self.__data.append(buf)
+
+class PDU(BHS):
+    __slots__ = ("__data", "__h_digest", "__d_digest", "__payload", "__pooled")
+    
+    CODEC = BHS_CODEC
+    TEMPLATE = bytes(BHS.LENGTH) # header new pdus start with
+    
+    pool = BufferPool()
+    
+    __classes = {} # opcode:pdu class
+    
+    def __init__(self,  data = None, header_digest = False, data_digest = False):
         if data == None:
-            data = bytearray(BHS.LENGTH)
+            data = self.pool.GetHeader()
+            data[0:BHS.LENGTH] = self.TEMPLATE
+            self.__pooled = [data] # buffers to give back to pool
+        else:
+            self.__pooled = None
+        super().__init__(data)
         self.__data = data
-        self.__h_digest = header_digest
-        self.__d_digest = data_digest
-        # construct BHS
-        self.bhs = BHS(data)
-        # construct AHS list according to BHS
-        self.__payload = []
+        self.__h_digest = bool(header_digest)
+        self.__d_digest = bool(data_digest)
+        self.__payload = None
         
     def __getitem__(self, key):
         return self.__data.__getitem__(key)
@@ -66,81 +133,138 @@ class PDU(object):
         self.__data.__setitem__(key, value)
         
     @property
-    def PayloadOffset(self):
-        return BHS.LENGTH + self.bhs.TotalAHSLength # dont forget header digest
-    
-    @property
-    def Immediate(self):
-        return self.bhs.Immediate
-    
-    @Immediate.setter
-    def Immediate(self, i):
-        self.bhs.Immediate = i
-    
-    @property
-    def Opcode(self):
-        return self.bhs.Opcode
-    
-    @Opcode.setter
-    def Opcode(self, ocode):
-        self.bhs.Opcode = ocode
-    
-    @property
-    def Final(self):
-        return self.bhs.Final
+    def bhs(self):
+        # header fields are accessed on the pdu itself
+        return self
+        
+    @classmethod
+    def Register(cls, opcode, pdu_class):
+        '''
+        Register class to be constructed by Create for pdus with opcode
+        '''
+        cls.__classes[opcode] = pdu_class
+        
+    @classmethod
+    def Create(cls, data, header_digest = False, data_digest = False):
+        '''
+        Construct pdu of the class registered for the opcode in data,
+        data is used as it is without copying
+        '''
+        pdu_class = cls.__classes.get(data[0] & 0x3F, PDU)
+        return pdu_class(data, header_digest, data_digest)
+        
+    def Unpack(self):
+        '''
+        Decode whole header into a record of the codec of this pdu type
+        '''
+        return self.CODEC.Unpack(self.__data)
     
-    @Final.setter
-    def Final(self, f):
-        self.bhs.Final = f
+    def Encode(self, **fields):
+        '''
+        Set header fields in one pass, e.g. Encode(CmdSN = 1, ExpStatSN = 2)
+        '''
+        self.CODEC.Writer(tuple(fields))(self.__data, fields)
+        return self
     
     @property
-    def TotalAHSLength(self):
-        return self.bhs.TotalAHSLength
-    
-    @TotalAHSLength.setter
-    def TotalAHSLength(self, tahsl):
-        self.bhs.TotalAHSLength = tahsl
+    def PayloadOffset(self):
+        if self.__h_digest:
+            return BHS.LENGTH + self.TotalAHSLength * 4 + digest.LENGTH
+        return BHS.LENGTH + self.TotalAHSLength * 4
     
     @property
-    def DataSegmentLength(self):
-        return self.bhs.DataSegmentLength
+    def header_digest(self):
+        return self.__h_digest
     
-    @DataSegmentLength.setter
-    def DataSegmentLength(self, dsl):
-        self.bhs.DataSegmentLength = dsl
+    @header_digest.setter
+    def header_digest(self, h_digest):
+        self.__h_digest = bool(h_digest)
     
     @property
-    def LUN(self):
-        return self.bhs.LUN
-    @LUN.setter
-    def LUN(self, lun):
-        self.bhs.LUN = lun
+    def data_digest(self):
+        return self.__d_digest
     
-    @property
-    def InitiatorTaskTag(self):
-        return self.bhs.InitiatorTaskTag
-    
-    @InitiatorTaskTag.setter
-    def InitiatorTaskTag(self, itt):
-        self.bhs.InitiatorTaskTag = itt
+    @data_digest.setter
+    def data_digest(self, d_digest):
+        self.__d_digest = bool(d_digest)
         
     def AppendData(self, data):
-        self.__payload += [data]
+        if isinstance(data, str):
+            data = data.encode("utf8")
+        if self.__payload == None:
+            self.__payload = [data]
+        else:
+            self.__payload += [data]
         self.DataSegmentLength += len(data)
         
+    def AllocData(self, length):
+        '''
+        Append a data segment chunk backed by a pool buffer, returns writable
+        memoryview of it to be filled in place
+        @param length: up to pool.data_size bytes
+        '''
+        if self.__pooled == None or length > self.pool.data_size:
+            view = memoryview(bytearray(length))
+        else:
+            buf = self.pool.GetData()
+            self.__pooled += [buf]
+            view = memoryview(buf)[:length]
+        self.AppendData(view)
+        return view
+    
+    def Release(self):
+        '''
+        Give pool buffers back, pdu must not be used afterwards
+        '''
+        if self.__pooled != None:
+            self.__payload = None
+            self.pool.PutHeader(self.__pooled[0])
+            for buf in self.__pooled[1:]:
+                self.pool.PutData(buf)
+            self.__pooled = None
+        
+    def Buffers(self):
+        '''
+        Returns list of buffers making up the pdu on the wire: header,
+        header digest, data segment chunks, padding and data digest. Nothing
+        is copied or modified, so the list can be handed to socket.sendmsg
+        and rebuilt for a resend. A received pdu is returned as it is.
+        '''
+        hlen = BHS.LENGTH + self.TotalAHSLength * 4
+        if len(self.__data) > hlen or (self.__payload == None and not self.__h_digest):
+            return [self.__data]
+        retval = [self.__data]
+        if self.__h_digest:
+            retval += [digest.Digest(retval)]
+        if self.__payload != None:
+            data = self.__payload + [PADDING[self.DataSegmentLength % 4]]
+            retval += data
+            if self.__d_digest:
+                retval += [digest.Digest(data)]
+        return retval
+    
+    def CheckHeaderDigest(self):
+        '''
+        Verify header digest of a received pdu
+        '''
+        if not self.__h_digest:
+            return True
+        hlen = BHS.LENGTH + self.TotalAHSLength * 4
+        return digest.Digest([self.__data[:hlen]]) == self.__data[hlen:hlen + digest.LENGTH]
+    
+    def CheckDataDigest(self):
+        '''
+        Verify data digest of a received pdu, digest covers padding too
+        '''
+        dsl = self.DataSegmentLength
+        if not self.__d_digest or dsl == 0:
+            return True
+        start = self.PayloadOffset
+        end = start + ((dsl + 3) & ~3)
+        return digest.Digest([self.__data[start:end]]) == self.__data[end:end + digest.LENGTH]
+        
     @property
     def raw_data(self):
-        #update DataSegmentLength
-        data_len = 0
-        for d in self.__payload:
-            data_len += len(d)
-        if data_len % 4 != 0:
-            self.__payload += [bytearray(4 - data_len % 4)]
-        #self.DataSegmentLength = data_len
-        retval = self.__data
-        for p in self.__payload:
-            if isinstance(p, str):
-                retval += p.encode("utf8")
-            else:
-                retval += p
-        return retval
+        if self.__payload == None:
+            return self.__data
+        return b"".join(self.Buffers())
@@ -0,0 +1,499 @@
+#!/usr/bin/python3
+# Copyright (c) 2015. Harun Emektar
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+if __name__ == "scsi_pdu":
+    from pdu_common import *
+else:
+    from .pdu_common import *
+
+# SCSI operation codes
+SCSI_READ_10 = 0x28
+SCSI_READ_16 = 0x88
+SCSI_WRITE_10 = 0x2A
+SCSI_WRITE_16 = 0x8A
+
+CDB_LENGTH = 16
+
+def EncodeLun(lun):
+    '''
+    Returns 8 byte SAM LUN field as integer, peripheral device addressing
+    for luns below 256 and flat space addressing up to 16383
+    '''
+    if lun < 256:
+        return lun << 48
+    if lun < 16384:
+        return (0x4000 | lun) << 48
+    raise ValueError("lun(%d) can't be encoded" % lun)
+
+def Read10Cdb(lba, blocks):
+    return struct.pack(">BBIBHB6x", SCSI_READ_10, 0, lba, 0, blocks, 0)
+
+def Read16Cdb(lba, blocks):
+    return struct.pack(">BBQIBB", SCSI_READ_16, 0, lba, blocks, 0, 0)
+
+def Write10Cdb(lba, blocks):
+    return struct.pack(">BBIBHB6x", SCSI_WRITE_10, 0, lba, 0, blocks, 0)
+
+def Write16Cdb(lba, blocks):
+    return struct.pack(">BBQIBB", SCSI_WRITE_16, 0, lba, blocks, 0, 0)
+
+#Byte/     0       |       1       |       2       |       3       |
+#    /             |               |               |               |
+#  |0 1 2 3 4 5 6 7|0 1 2 3 4 5 6 7|0 1 2 3 4 5 6 7|0 1 2 3 4 5 6 7|
+#  +---------------+---------------+---------------+---------------+
+# 0|.|I| 0x01      |F|R|W|. .|ATTR | Reserved                      |
+#  +---------------+---------------+---------------+---------------+
+# 4|TotalAHSLength | DataSegmentLength                             |
+#  +---------------+---------------+---------------+---------------+
+# 8| Logical Unit Number (LUN)                                     |
+#  +                                                               +
+#12|                                                               |
+#  +---------------+---------------+---------------+---------------+
+#16| Initiator Task Tag                                            |
+#  +---------------+---------------+---------------+---------------+
+#20| Expected Data Transfer Length                                 |
+#  +---------------+---------------+---------------+---------------+
+#24| CmdSN                                                         |
+#  +---------------+---------------+---------------+---------------+
+#28| ExpStatSN                                                     |
+#  +---------------+---------------+---------------+---------------+
+#32/ SCSI Command Descriptor Block (CDB)                           /
+# +/                                                               /
+#  +---------------+---------------+---------------+---------------+
+#48/ AHS (Optional)                                                /
+#  +---------------+---------------+---------------+---------------+
+#  / DataSegment - Command Data (Optional)                         /
+#  +---------------+---------------+---------------+---------------+
+SCSI_CMD_BITS = BHS_BITS + (("Final", "_b1", 7, 1), ("Read", "_b1", 6, 1),
+                            ("Write", "_b1", 5, 1), ("Attr", "_b1", 0, 7))
+
+class ScsiCmdPDU(PDU):
+    __slots__ = ()
+
+    # logger for scsi command pdu
+    logger = logging.getLogger("SCSI Cmd PDU")
+    logger.setLevel(logging.DEBUG)
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.DEBUG)
+    logger.addHandler(ch)
+
+    ATTR_UNTAGGED = 0
+    ATTR_SIMPLE = 1
+    ATTR_ORDERED = 2
+    ATTR_HEAD_OF_QUEUE = 3
+    ATTR_ACA = 4
+
+    CODEC = HeaderCodec("ScsiCmdHeader",
+                        (("_b0", "B"), ("_b1", "B"), (None, "2x"), ("_w1", "I"), ("LUN", "Q"),
+                         ("InitiatorTaskTag", "I"), ("ExpectedDataTransferLength", "I"),
+                         ("CmdSN", "I"), ("ExpStatSN", "I"), ("CDB", "16s")),
+                        SCSI_CMD_BITS, (BHS.OPCODE_SCSI_CMD_REQ,))
+    TEMPLATE = bytes(CODEC.Pack(Opcode = BHS.OPCODE_SCSI_CMD_REQ, Final = True,
+                                Attr = ATTR_SIMPLE))
+
+    @property
+    def Read(self):
+        return bool(self.data[1] & 0x40)
+
+    @property
+    def Write(self):
+        return bool(self.data[1] & 0x20)
+
+    @property
+    def Attr(self):
+        return self.data[1] & 0x07
+
+    @property
+    def ExpectedDataTransferLength(self):
+        return U32.unpack_from(self.data, 20)[0]
+
+    @ExpectedDataTransferLength.setter
+    def ExpectedDataTransferLength(self, length):
+        U32.pack_into(self.data, 20, length & 0xFFFFFFFF)
+
+    @property
+    def CmdSN(self):
+        return U32.unpack_from(self.data, 24)[0]
+
+    @CmdSN.setter
+    def CmdSN(self, cmdsn):
+        if cmdsn > 0xFFFFFFFF or cmdsn < 0:
+            self.logger.warn("cmdsn(%d) is bigger than 4 bytes" % cmdsn)
+        U32.pack_into(self.data, 24, cmdsn & 0xFFFFFFFF)
+
+    @property
+    def ExpStatSN(self):
+        return U32.unpack_from(self.data, 28)[0]
+
+    @ExpStatSN.setter
+    def ExpStatSN(self, expstatsn):
+        if expstatsn > 0xFFFFFFFF or expstatsn < 0:
+            self.logger.warn("expstatsn(%d) is bigger than 4 bytes" % expstatsn)
+        U32.pack_into(self.data, 28, expstatsn & 0xFFFFFFFF)
+
+    @property
+    def CDB(self):
+        return bytes(self.data[32:48])
+
+#Byte/     0       |       1       |       2       |       3       |
+#    /             |               |               |               |
+#  |0 1 2 3 4 5 6 7|0 1 2 3 4 5 6 7|0 1 2 3 4 5 6 7|0 1 2 3 4 5 6 7|
+#  +---------------+---------------+---------------+---------------+
+# 0|.|.| 0x21      |1|. .|o|u|O|U|.| Response      | Status        |
+#  +---------------+---------------+---------------+---------------+
+# 4|TotalAHSLength | DataSegmentLength                             |
+#  +---------------+---------------+---------------+---------------+
+# 8| Reserved                                                      |
+#  +                                                               +
+#12|                                                               |
+#  +---------------+---------------+---------------+---------------+
+#16| Initiator Task Tag                                            |
+#  +---------------+---------------+---------------+---------------+
+#20| SNACK Tag                                                     |
+#  +---------------+---------------+---------------+---------------+
+#24| StatSN                                                        |
+#  +---------------+---------------+---------------+---------------+
+#28| ExpCmdSN                                                      |
+#  +---------------+---------------+---------------+---------------+
+#32| MaxCmdSN                                                      |
+#  +---------------+---------------+---------------+---------------+
+#36| ExpDataSN or Reserved                                         |
+#  +---------------+---------------+---------------+---------------+
+#40| Bidirectional Read Residual Count or Reserved                 |
+#  +---------------+---------------+---------------+---------------+
+#44| Residual Count or Reserved                                    |
+#  +---------------+---------------+---------------+---------------+
+#48| Header-Digest (Optional)                                      |
+#  +---------------+---------------+---------------+---------------+
+#  / Data Segment (Optional)                                       /
+# +/                                                               /
+#  +---------------+---------------+---------------+---------------+
+#  | Data-Digest (Optional)                                        |
+#  +---------------+---------------+---------------+---------------+
+SCSI_RESP_BITS = BHS_BITS + (("Final", "_b1", 7, 1), ("BidiOverflow", "_b1", 4, 1),
+                             ("BidiUnderflow", "_b1", 3, 1), ("Overflow", "_b1", 2, 1),
+                             ("Underflow", "_b1", 1, 1))
+
+class ScsiRespPDU(PDU):
+    __slots__ = ()
+
+    RESPONSE_COMPLETED = 0x00
+    RESPONSE_TARGET_FAILURE = 0x01
+
+    STATUS_GOOD = 0x00
+    STATUS_CHECK_CONDITION = 0x02
+    STATUS_BUSY = 0x08
+    STATUS_RESERVATION_CONFLICT = 0x18
+    STATUS_TASK_SET_FULL = 0x28
+
+    CODEC = HeaderCodec("ScsiRespHeader",
+                        (("_b0", "B"), ("_b1", "B"), ("Response", "B"), ("Status", "B"),
+                         ("_w1", "I"), (None, "8x"), ("InitiatorTaskTag", "I"), ("SNACKTag", "I"),
+                         ("StatSN", "I"), ("ExpCmdSN", "I"), ("MaxCmdSN", "I"), ("ExpDataSN", "I"),
+                         ("BidiResidualCount", "I"), ("ResidualCount", "I")),
+                        SCSI_RESP_BITS, (BHS.OPCODE_SCSI_CMD_RES,))
+
+    @property
+    def Overflow(self):
+        return bool(self.data[1] & 0x04)
+
+    @property
+    def Underflow(self):
+        return bool(self.data[1] & 0x02)
+
+    @property
+    def Response(self):
+        return self.data[2]
+
+    @property
+    def Status(self):
+        return self.data[3]
+
+    @property
+    def StatSN(self):
+        return U32.unpack_from(self.data, 24)[0]
+
+    @property
+    def ExpCmdSN(self):
+        return U32.unpack_from(self.data, 28)[0]
+
+    @property
+    def MaxCmdSN(self):
+        return U32.unpack_from(self.data, 32)[0]
+
+    @property
+    def ExpDataSN(self):
+        return U32.unpack_from(self.data, 36)[0]
+
+    @property
+    def ResidualCount(self):
+        return U32.unpack_from(self.data, 44)[0]
+
+    @property
+    def SenseData(self):
+        '''
+        Sense data without the SenseLength prefix of data segment
+        '''
+        if self.DataSegmentLength < 2:
+            return b""
+        offset = self.PayloadOffset
+        length = U16.unpack_from(self.data, offset)[0]
+        return bytes(self.data[offset + 2:offset + 2 + length])
+
+#Byte/     0       |       1       |       2       |       3       |
+#    /             |               |               |               |
+#  |0 1 2 3 4 5 6 7|0 1 2 3 4 5 6 7|0 1 2 3 4 5 6 7|0 1 2 3 4 5 6 7|
+#  +---------------+---------------+---------------+---------------+
+# 0|.|.| 0x25      |F|A|0 0 0|O|U|S| Reserved      |Status or Rsvd |
+#  +---------------+---------------+---------------+---------------+
+# 4|TotalAHSLength | DataSegmentLength                             |
+#  +---------------+---------------+---------------+---------------+
+# 8| LUN or Reserved                                               |
+#  +                                                               +
+#12|                                                               |
+#  +---------------+---------------+---------------+---------------+
+#16| Initiator Task Tag                                            |
+#  +---------------+---------------+---------------+---------------+
+#20| Target Transfer Tag or 0xffffffff                             |
+#  +---------------+---------------+---------------+---------------+
+#24| StatSN or Reserved                                            |
+#  +---------------+---------------+---------------+---------------+
+#28| ExpCmdSN                                                      |
+#  +---------------+---------------+---------------+---------------+
+#32| MaxCmdSN                                                      |
+#  +---------------+---------------+---------------+---------------+
+#36| DataSN                                                        |
+#  +---------------+---------------+---------------+---------------+
+#40| Buffer Offset                                                 |
+#  +---------------+---------------+---------------+---------------+
+#44| Residual Count                                                |
+#  +---------------+---------------+---------------+---------------+
+#48| Header-Digest (Optional)                                      |
+#  +---------------+---------------+---------------+---------------+
+#  / DataSegment                                                   /
+# +/                                                               /
+#  +---------------+---------------+---------------+---------------+
+#  | Data-Digest (Optional)                                        |
+#  +---------------+---------------+---------------+---------------+
+DATA_IN_BITS = BHS_BITS + (("Final", "_b1", 7, 1), ("Acknowledge", "_b1", 6, 1),
+                           ("Overflow", "_b1", 2, 1), ("Underflow", "_b1", 1, 1),
+                           ("StatusPresent", "_b1", 0, 1))
+
+class DataInPDU(PDU):
+    __slots__ = ()
+
+    CODEC = HeaderCodec("DataInHeader",
+                        (("_b0", "B"), ("_b1", "B"), (None, "x"), ("Status", "B"),
+                         ("_w1", "I"), ("LUN", "Q"), ("InitiatorTaskTag", "I"),
+                         ("TargetTransferTag", "I"), ("StatSN", "I"), ("ExpCmdSN", "I"),
+                         ("MaxCmdSN", "I"), ("DataSN", "I"), ("BufferOffset", "I"),
+                         ("ResidualCount", "I")),
+                        DATA_IN_BITS, (BHS.OPCODE_DATA_IN,))
+
+    @property
+    def Acknowledge(self):
+        return bool(self.data[1] & 0x40)
+
+    @property
+    def Overflow(self):
+        return bool(self.data[1] & 0x04)
+
+    @property
+    def Underflow(self):
+        return bool(self.data[1] & 0x02)
+
+    @property
+    def StatusPresent(self):
+        return bool(self.data[1] & 0x01)
+
+    @property
+    def Status(self):
+        return self.data[3]
+
+    @property
+    def TargetTransferTag(self):
+        return U32.unpack_from(self.data, 20)[0]
+
+    @property
+    def StatSN(self):
+        return U32.unpack_from(self.data, 24)[0]
+
+    @property
+    def ExpCmdSN(self):
+        return U32.unpack_from(self.data, 28)[0]
+
+    @property
+    def MaxCmdSN(self):
+        return U32.unpack_from(self.data, 32)[0]
+
+    @property
+    def DataSN(self):
+        return U32.unpack_from(self.data, 36)[0]
+
+    @property
+    def BufferOffset(self):
+        return U32.unpack_from(self.data, 40)[0]
+
+    @property
+    def ResidualCount(self):
+        return U32.unpack_from(self.data, 44)[0]
+
+    @property
+    def payload(self):
+        '''
+        memoryview of data segment, without padding
+        '''
+        offset = self.PayloadOffset
+        return memoryview(self.data)[offset:offset + self.DataSegmentLength]
+
+#Byte/     0       |       1       |       2       |       3       |
+#    /             |               |               |               |
+#  |0 1 2 3 4 5 6 7|0 1 2 3 4 5 6 7|0 1 2 3 4 5 6 7|0 1 2 3 4 5 6 7|
+#  +---------------+---------------+---------------+---------------+
+# 0|.|.| 0x05      |F| Reserved                                    |
+#  +---------------+---------------+---------------+---------------+
+# 4|TotalAHSLength | DataSegmentLength                             |
+#  +---------------+---------------+---------------+---------------+
+# 8| LUN or Reserved                                               |
+#  +                                                               +
+#12|                                                               |
+#  +---------------+---------------+---------------+---------------+
+#16| Initiator Task Tag                                            |
+#  +---------------+---------------+---------------+---------------+
+#20| Target Transfer Tag or 0xffffffff                             |
+#  +---------------+---------------+---------------+---------------+
+#24| Reserved                                                      |
+#  +---------------+---------------+---------------+---------------+
+#28| ExpStatSN                                                     |
+#  +---------------+---------------+---------------+---------------+
+#32| Reserved                                                      |
+#  +---------------+---------------+---------------+---------------+
+#36| DataSN                                                        |
+#  +---------------+---------------+---------------+---------------+
+#40| Buffer Offset                                                 |
+#  +---------------+---------------+---------------+---------------+
+#44| Reserved                                                      |
+#  +---------------+---------------+---------------+---------------+
+#48| Header-Digest (Optional)                                      |
+#  +---------------+---------------+---------------+---------------+
+#  / DataSegment                                                   /
+# +/                                                               /
+#  +---------------+---------------+---------------+---------------+
+#  | Data-Digest (Optional)                                        |
+#  +---------------+---------------+---------------+---------------+
+class DataOutPDU(PDU):
+    __slots__ = ()
+
+    CODEC = HeaderCodec("DataOutHeader",
+                        (("_b0", "B"), ("_b1", "B"), (None, "2x"), ("_w1", "I"), ("LUN", "Q"),
+                         ("InitiatorTaskTag", "I"), ("TargetTransferTag", "I"), (None, "4x"),
+                         ("ExpStatSN", "I"), (None, "4x"), ("DataSN", "I"),
+                         ("BufferOffset", "I"), (None, "4x")),
+                        BHS_BITS + (("Final", "_b1", 7, 1),), (BHS.OPCODE_DATA_OUT,))
+    TEMPLATE = bytes(CODEC.Pack(Opcode = BHS.OPCODE_DATA_OUT, TargetTransferTag = 0xFFFFFFFF))
+
+    @property
+    def TargetTransferTag(self):
+        return U32.unpack_from(self.data, 20)[0]
+
+    @property
+    def ExpStatSN(self):
+        return U32.unpack_from(self.data, 28)[0]
+
+    @ExpStatSN.setter
+    def ExpStatSN(self, expstatsn):
+        U32.pack_into(self.data, 28, expstatsn & 0xFFFFFFFF)
+
+    @property
+    def DataSN(self):
+        return U32.unpack_from(self.data, 36)[0]
+
+    @property
+    def BufferOffset(self):
+        return U32.unpack_from(self.data, 40)[0]
+
+#Byte/     0       |       1       |       2       |       3       |
+#    /             |               |               |               |
+#  |0 1 2 3 4 5 6 7|0 1 2 3 4 5 6 7|0 1 2 3 4 5 6 7|0 1 2 3 4 5 6 7|
+#  +---------------+---------------+---------------+---------------+
+# 0|.|.| 0x31      |1| Reserved                                    |
+#  +---------------+---------------+---------------+---------------+
+# 4|TotalAHSLength | DataSegmentLength                             |
+#  +---------------+---------------+---------------+---------------+
+# 8| LUN                                                           |
+#  +                                                               +
+#12|                                                               |
+#  +---------------+---------------+---------------+---------------+
+#16| Initiator Task Tag                                            |
+#  +---------------+---------------+---------------+---------------+
+#20| Target Transfer Tag                                           |
+#  +---------------+---------------+---------------+---------------+
+#24| StatSN                                                        |
+#  +---------------+---------------+---------------+---------------+
+#28| ExpCmdSN                                                      |
+#  +---------------+---------------+---------------+---------------+
+#32| MaxCmdSN                                                      |
+#  +---------------+---------------+---------------+---------------+
+#36| R2TSN                                                         |
+#  +---------------+---------------+---------------+---------------+
+#40| Buffer Offset                                                 |
+#  +---------------+---------------+---------------+---------------+
+#44| Desired Data Transfer Length                                  |
+#  +---------------------------------------------------------------+
+#48| Header-Digest (Optional)                                      |
+#  +---------------+---------------+---------------+---------------+
+class R2TPDU(PDU):
+    __slots__ = ()
+
+    CODEC = HeaderCodec("R2THeader",
+                        (("_b0", "B"), ("_b1", "B"), (None, "2x"), ("_w1", "I"), ("LUN", "Q"),
+                         ("InitiatorTaskTag", "I"), ("TargetTransferTag", "I"), ("StatSN", "I"),
+                         ("ExpCmdSN", "I"), ("MaxCmdSN", "I"), ("R2TSN", "I"),
+                         ("BufferOffset", "I"), ("DesiredDataTransferLength", "I")),
+                        BHS_BITS + (("Final", "_b1", 7, 1),), (BHS.OPCODE_R2T,))
+
+    @property
+    def TargetTransferTag(self):
+        return U32.unpack_from(self.data, 20)[0]
+
+    @property
+    def StatSN(self):
+        return U32.unpack_from(self.data, 24)[0]
+
+    @property
+    def ExpCmdSN(self):
+        return U32.unpack_from(self.data, 28)[0]
+
+    @property
+    def MaxCmdSN(self):
+        return U32.unpack_from(self.data, 32)[0]
+
+    @property
+    def R2TSN(self):
+        return U32.unpack_from(self.data, 36)[0]
+
+    @property
+    def BufferOffset(self):
+        return U32.unpack_from(self.data, 40)[0]
+
+    @property
+    def DesiredDataTransferLength(self):
+        return U32.unpack_from(self.data, 44)[0]
+
+PDU.Register(BHS.OPCODE_SCSI_CMD_REQ, ScsiCmdPDU)
+PDU.Register(BHS.OPCODE_SCSI_CMD_RES, ScsiRespPDU)
+PDU.Register(BHS.OPCODE_DATA_IN, DataInPDU)
+PDU.Register(BHS.OPCODE_DATA_OUT, DataOutPDU)
+PDU.Register(BHS.OPCODE_R2T, R2TPDU)
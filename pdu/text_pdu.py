@@ -48,7 +48,11 @@ else:
 #  +---------------+---------------+---------------+---------------+
 #  | Data-Digest (Optional)                                        |
 #  +---------------+---------------+---------------+---------------+
+TEXT_BITS = BHS_BITS + (("Final", "_b1", 7, 1), ("Continue", "_b1", 6, 1))
+
 class TextCmnPDU(PDU):
+    __slots__ = ()
+    
     # logger for Login pdu
     logger = logging.getLogger("Text PDU")
     logger.setLevel(logging.DEBUG)
@@ -61,7 +65,7 @@ class TextCmnPDU(PDU):
 
     @property
     def Final(self):
-        if ntoi(self.bhs[1]) & self.FINAL_MASK:
+        if self.data[1] & self.FINAL_MASK:
             return True
         else:
             return False
@@ -69,13 +73,13 @@ class TextCmnPDU(PDU):
     @Final.setter
     def Final(self, f):
         if f:
-            self.bhs[1] |= self.FINAL_MASK
+            self.data[1] |= self.FINAL_MASK
         else:
-            self.bhs[1] &= ~self.FINAL_MASK
+            self.data[1] &= ~self.FINAL_MASK
 
     @property
     def Continue(self):
-        if ntoi(self.bhs[1]) & self.CONTINUE_MASK:
+        if self.data[1] & self.CONTINUE_MASK:
             return True
         else:
             return False
@@ -83,48 +87,49 @@ class TextCmnPDU(PDU):
     @Continue.setter
     def Continue(self, c):
         if c:
-            self.bhs[1] |= self.CONTINUE_MASK
+            self.data[1] |= self.CONTINUE_MASK
         else:
-            self.bhs[1] &= ~self.CONTINUE_MASK
+            self.data[1] &= ~self.CONTINUE_MASK
     
     @property
     def TargetTransferTag(self):
-        return ntoi(self.bhs[20:24])
+        return U32.unpack_from(self.data, 20)[0]
 
     @TargetTransferTag.setter
     def TargetTransferTag(self, ttt):
         if ttt > 0xFFFFFFFF or ttt < 0:
             self.logger.warn("TargetTransferTag(%d) is bigger than 4 bytes" % ttt)
-        self.bhs[20:24] = iton(ttt, 4)
+        U32.pack_into(self.data, 20, ttt & 0xFFFFFFFF)
 
 class TextPDU(TextCmnPDU):
-    def __init__(self, data = None, header_digest = None, data_digest= None):
-        super().__init__(data, header_digest, data_digest)
-        if data == None:
-            data = bytearray(BHS.LENGTH)
-            self.Opcode = BHS.OPCODE_TEXT_REQ
-
+    __slots__ = ()
+    
+    CODEC = HeaderCodec("TextHeader",
+                        (("_b0", "B"), ("_b1", "B"), (None, "2x"), ("_w1", "I"), ("LUN", "Q"),
+                         ("InitiatorTaskTag", "I"), ("TargetTransferTag", "I"),
+                         ("CmdSN", "I"), ("ExpStatSN", "I"), (None, "16x")),
+                        TEXT_BITS, (BHS.OPCODE_TEXT_REQ,))
+    TEMPLATE = bytes(CODEC.Pack(Opcode = BHS.OPCODE_TEXT_REQ, TargetTransferTag = 0xFFFFFFFF))
+    
     @property
     def CmdSN(self):
-        return ntoi(self.bhs[24:28])
+        return U32.unpack_from(self.data, 24)[0]
     
     @CmdSN.setter
     def CmdSN(self, cmdsn):
         if cmdsn > 0xFFFFFFFF or cmdsn < 0:
             self.logger.warn("cmdsn(%d) is bigger than 4 bytes" % cmdsn)
-        n_cmdsn = iton(cmdsn, 4)
-        self.bhs[24:28] = n_cmdsn
+        U32.pack_into(self.data, 24, cmdsn & 0xFFFFFFFF)
     
     @property
     def ExpStatSN(self):
-        return ntoi(self.bhs[28:32])
+        return U32.unpack_from(self.data, 28)[0]
     
     @ExpStatSN.setter
     def ExpStatSN(self, expstatsn):
         if expstatsn > 0xFFFFFFFF or expstatsn < 0:
             self.logger.warn("expstatsn(%d) is bigger than 4 bytes" % expstatsn)
-        n_expstatsn = iton(expstatsn, 4)
-        self.bhs[28:32] = n_expstatsn
+        U32.pack_into(self.data, 28, expstatsn & 0xFFFFFFFF)
 
  
 #Byte/      0      |        1      |       2       |       3       |
@@ -160,15 +165,25 @@ class TextPDU(TextCmnPDU):
 #  | Data-Digest (Optional)                                        |
 #  +---------------+---------------+---------------+---------------+
 class TextRespPDU(TextCmnPDU):
+    __slots__ = ()
+    
+    CODEC = HeaderCodec("TextRespHeader",
+                        (("_b0", "B"), ("_b1", "B"), (None, "2x"), ("_w1", "I"), ("LUN", "Q"),
+                         ("InitiatorTaskTag", "I"), ("TargetTransferTag", "I"), ("StatSN", "I"),
+                         ("ExpCmdSN", "I"), ("MaxCmdSN", "I"), (None, "12x")),
+                        TEXT_BITS, (BHS.OPCODE_TEXT_RES,))
+    
     @property
     def StatSN(self):
-        return ntoi(self.bhs[24:28])
+        return U32.unpack_from(self.data, 24)[0]
     
     @property
     def ExpCmdSN(self):
-        return ntoi(self.bhs[28:32])
+        return U32.unpack_from(self.data, 28)[0]
     
     @property
     def MaxCmdSN(self):
-        return ntoi(self.bhs[32:36])
-    
+        return U32.unpack_from(self.data, 32)[0]
+
+PDU.Register(BHS.OPCODE_TEXT_REQ, TextPDU)
+PDU.Register(BHS.OPCODE_TEXT_RES, TextRespPDU)
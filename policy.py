@@ -0,0 +1,99 @@
+#!/usr/bin/python3
+# Copyright (c) 2015. Harun Emektar
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# policies choosing the connection a command of a multi connection session
+# is sent on, or the path of a multipath device, a policy is any object with
+# Select(conns, task)
+
+class RoundRobin():
+    '''
+    Connections take commands in turn
+    '''
+    def __init__(self):
+        self.__next = 0
+
+    def Select(self, conns, task):
+        '''
+        Returns connection for task
+        @param conns: logged in connections of session, never empty
+        @param task: ScsiTask or text of request
+        '''
+        conn = conns[self.__next % len(conns)]
+        self.__next += 1
+        return conn
+
+class LeastOutstanding():
+    '''
+    Connection with fewest commands waiting for response
+    '''
+    def Select(self, conns, task):
+        return min(conns, key = lambda conn: conn.outstanding)
+
+class BytesInFlight():
+    '''
+    Connection with least data being transferred, commands without data
+    break ties, so small and large commands are balanced by their size
+    '''
+    def Select(self, conns, task):
+        return min(conns, key = lambda conn: (conn.bytes_in_flight, conn.outstanding))
+
+class ServiceTime():
+    '''
+    Path expected to finish a new command first, recent latency times
+    commands queued on it with the new one. Paths without a latency sample
+    are tried first, shortest queue breaks ties. Needs latency, an average
+    in seconds or None, on top of outstanding.
+    '''
+    def Select(self, paths, task):
+        def Expected(path):
+            if path.latency == None:
+                return (0, path.outstanding)
+            return ((path.outstanding + 1) * path.latency, path.outstanding)
+        return min(paths, key = Expected)
+
+if __name__ == "__main__":
+    import unittest
+
+    class Conn():
+        def __init__(self, outstanding, bytes_in_flight):
+            self.outstanding = outstanding
+            self.bytes_in_flight = bytes_in_flight
+
+    class TestPolicy(unittest.TestCase):
+        def testRoundRobin(self):
+            conns = [Conn(0, 0), Conn(0, 0), Conn(0, 0)]
+            policy = RoundRobin()
+            self.assertEqual([policy.Select(conns, None) for i in range(4)], conns + conns[:1])
+
+        def testLeastOutstanding(self):
+            conns = [Conn(3, 0), Conn(1, 1 << 20), Conn(2, 0)]
+            self.assertIs(LeastOutstanding().Select(conns, None), conns[1])
+
+        def testBytesInFlight(self):
+            conns = [Conn(3, 0), Conn(1, 1 << 20), Conn(2, 0)]
+            self.assertIs(BytesInFlight().Select(conns, None), conns[2])
+
+        def testServiceTime(self):
+            paths = [Conn(1, 0), Conn(4, 0), Conn(0, 0)]
+            paths[0].latency = 0.010 # 20ms for a new command
+            paths[1].latency = 0.001 # 5ms
+            paths[2].latency = 0.006 # 6ms
+            self.assertIs(ServiceTime().Select(paths, None), paths[1])
+            paths[2].latency = None
+            self.assertIs(ServiceTime().Select(paths, None), paths[2])
+            paths[0].latency = None
+            self.assertIs(ServiceTime().Select(paths, None), paths[2])
+
+    unittest.main()
@@ -0,0 +1,408 @@
+#!/usr/bin/python3
+# Copyright (c) 2015. Harun Emektar
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import logging
+import threading
+import _thread
+import time
+import collections
+import concurrent.futures
+from session import InitSession
+
+class SessionPool():
+    '''
+    Logged in sessions kept for reuse, keyed by (portal, target name,
+    session type). Get hands out an idle session of its key or logs in a
+    new one, Put takes it back. Idle sessions are pinged with NOP-Out so
+    they stay warm, ones not answering are dropped. Least recently used
+    idle sessions are logged out to stay within max_idle and max_total.
+    @param init: initiator.Initiator, its name is used in login
+    @param max_total: sessions open at once, Get waits for one to be put
+    back when all are in use
+    @param max_idle: idle sessions kept
+    @param keepalive: seconds an idle session waits before it's pinged, 0
+    disables pings
+    @param idle_timeout: seconds an idle session is kept, forever if None
+    @param options: transport.TransportOptions of connections
+    '''
+    # logger for session pool
+    logger = logging.getLogger("Session Pool")
+    logger.setLevel(logging.DEBUG)
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.DEBUG)
+    logger.addHandler(ch)
+
+    LOGOUT_TIMEOUT = 10 # seconds an evicted session waits for logout response
+
+    def __init__(self, init, max_total = 64, max_idle = 16, keepalive = 30, idle_timeout = None,
+                 options = None):
+        if max_idle > max_total:
+            raise ValueError("max_idle(%d) is more than max_total(%d)" % (max_idle, max_total))
+        self.__init = init
+        self.__max_total = max_total
+        self.__max_idle = max_idle
+        self.__keepalive = keepalive
+        self.__idle_timeout = idle_timeout
+        self.__options = options
+        self.__cond = threading.Condition()
+        self.__idle = collections.OrderedDict() # session:(key, idle since), least recent first
+        self.__in_use = {} # session:key
+        self.__total = 0 # sessions open or being logged in
+        self.__closed = False
+        self.__wakeup = threading.Event()
+        if keepalive > 0 or idle_timeout:
+            _thread.start_new_thread(self.__KeepaliveThread, tuple())
+
+    @staticmethod
+    def Key(portal, tgt_name = None):
+        '''
+        Returns key of sessions to target on portal, discovery session if
+        tgt_name is None
+        '''
+        return (portal, tgt_name, "Discovery" if tgt_name == None else "Normal")
+
+    @property
+    def total(self):
+        return self.__total
+
+    @property
+    def idle(self):
+        return len(self.__idle)
+
+    def __TakeIdle(self, key):
+        # most recently used idle session of key, it's warmest
+        for session in reversed(self.__idle):
+            if self.__idle[session][0] == key:
+                del self.__idle[session]
+                return session
+        return None
+
+    def __Forget(self, session):
+        # caller holds lock
+        self.__total -= 1
+        self.__cond.notify()
+
+    def __Evict(self, session):
+        # session taken off pool is logged out and closed by a thread of
+        # its own, callers don't wait for it
+        _thread.start_new_thread(self.__Drop, ([session],))
+
+    def __Drop(self, sessions):
+        # log out sessions at once, their threads and connections are
+        # closed even if target doesn't answer
+        futures = [session.Logout() if session.state == InitSession.STATE_LOGGED_IN else None
+                   for session in sessions]
+        for session, future in zip(sessions, futures):
+            try:
+                if future != None:
+                    future.result(self.LOGOUT_TIMEOUT)
+            except (ConnectionError, concurrent.futures.TimeoutError):
+                pass
+            finally:
+                session.Close()
+
+    def Get(self, portal, tgt_name = None, timeout = None):
+        '''
+        Returns a logged in session to target on portal, raises LoginError
+        or ConnectionError if a new one can't be logged in and
+        TimeoutError if all max_total sessions stay in use or a new one
+        doesn't log in for timeout seconds
+        '''
+        key = self.Key(portal, tgt_name)
+        deadline = None if timeout == None else time.monotonic() + timeout
+        evicted = []
+        with self.__cond:
+            while True:
+                if self.__closed:
+                    raise ConnectionError("session pool is closed")
+                session = self.__TakeIdle(key)
+                if session != None:
+                    if session.state == InitSession.STATE_LOGGED_IN:
+                        self.__in_use[session] = key
+                        return session
+                    self.__Forget(session) # failed while idle
+                    continue
+                if self.__total < self.__max_total:
+                    self.__total += 1
+                    break
+                if len(self.__idle) != 0:
+                    # least recently used idle session of another key makes room
+                    session, _ = self.__idle.popitem(last = False)
+                    evicted += [session]
+                    break
+                remaining = None if deadline == None else deadline - time.monotonic()
+                if remaining != None and remaining <= 0:
+                    raise TimeoutError("all (%d) sessions of pool are in use" % self.__max_total)
+                self.__cond.wait(remaining)
+        for session in evicted:
+            self.__Evict(session)
+        session = None
+        try:
+            session = InitSession(self.__init, portal, tgt_name, self.__options)
+            future = session.Login()
+            if future == None:
+                raise ConnectionError("session to %s can't log in" % portal)
+            # login of a new session counts against timeout of Get too
+            future.result(None if deadline == None else max(0, deadline - time.monotonic()))
+        except:
+            if session != None:
+                session.Close()
+            with self.__cond:
+                self.__Forget(None)
+            raise
+        with self.__cond:
+            self.__in_use[session] = key
+        return session
+
+    def Put(self, session):
+        '''
+        Give session got from pool back, a failed one is dropped
+        '''
+        evicted = []
+        with self.__cond:
+            key = self.__in_use.pop(session, None)
+            if key == None:
+                self.logger.warn("session (%s) isn't from pool" % session.isid.raw_data)
+                return
+            if self.__closed or session.state != InitSession.STATE_LOGGED_IN:
+                self.__Forget(session)
+                evicted += [session]
+            else:
+                self.__idle[session] = (key, time.monotonic())
+                while len(self.__idle) > self.__max_idle:
+                    idle, _ = self.__idle.popitem(last = False)
+                    self.__Forget(idle)
+                    evicted += [idle]
+                self.__cond.notify()
+        for session in evicted:
+            self.__Evict(session)
+
+    def Discard(self, session):
+        '''
+        Log out session got from pool instead of giving it back
+        '''
+        with self.__cond:
+            if self.__in_use.pop(session, None) == None:
+                return
+            self.__Forget(session)
+        self.__Evict(session)
+
+    def __Expired(self, now):
+        # idle sessions kept longer than idle_timeout, caller holds lock
+        if self.__idle_timeout == None:
+            return []
+        expired = [session for session, (key, since) in self.__idle.items()
+                   if now - since >= self.__idle_timeout]
+        for session in expired:
+            del self.__idle[session]
+            self.__Forget(session)
+        return expired
+
+    def __KeepaliveThread(self):
+        period = min(t for t in (self.__keepalive, self.__idle_timeout) if t)
+        while not self.__wakeup.wait(period / 2):
+            now = time.monotonic()
+            with self.__cond:
+                expired = self.__Expired(now)
+                stale = []
+                if self.__keepalive > 0:
+                    stale = [session for session, (key, since) in self.__idle.items()
+                             if now - since >= self.__keepalive]
+            for session in expired:
+                self.__Evict(session)
+            # pings of all stale sessions are in flight at once
+            pings = [(session, session.Ping()) for session in stale]
+            for session, future in pings:
+                try:
+                    alive = future != None and future.result(self.__keepalive) == True
+                except (ConnectionError, concurrent.futures.TimeoutError):
+                    alive = False
+                with self.__cond:
+                    if session not in self.__idle:
+                        continue # handed out meanwhile
+                    if alive:
+                        self.__idle[session] = (self.__idle[session][0], time.monotonic())
+                    else:
+                        self.logger.warn("idle session (%s) doesn't answer ping, it's dropped" % session.isid.raw_data)
+                        del self.__idle[session]
+                        self.__Forget(session)
+                if not alive:
+                    self.__Evict(session)
+        self.logger.debug("session pool keepalive thread exits")
+
+    def Close(self):
+        '''
+        Log out and close idle sessions, ones in use are when they are put back
+        '''
+        with self.__cond:
+            self.__closed = True
+            idle = list(self.__idle)
+            self.__idle.clear()
+            for session in idle:
+                self.__Forget(session)
+            self.__cond.notify_all()
+        self.__wakeup.set()
+        self.__Drop(idle)
+
+if __name__ == "__main__":
+    import unittest
+    import pdu
+    from session import ScriptedTarget
+
+    class Init():
+        name = "iqn.2006-11.1"
+
+    TARGET = "iqn.2020-01.t:1"
+    PORTAL = "pair:pool"
+
+    def Wait(condition, timeout = 5):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                raise TimeoutError
+            time.sleep(0.005)
+
+    class TestSessionPool(unittest.TestCase):
+        def setUp(self):
+            self.target = ScriptedTarget(PORTAL.partition(":")[2])
+            self.pools = []
+
+        def tearDown(self):
+            for pool in self.pools:
+                pool.Close()
+            self.target.Close()
+
+        def Pool(self, **kwargs):
+            pool = SessionPool(Init(), **kwargs)
+            self.pools += [pool]
+            return pool
+
+        def LoggedOut(self, session):
+            Wait(lambda: session.state != InitSession.STATE_LOGGED_IN)
+
+        def testKey(self):
+            self.assertEqual(SessionPool.Key("10.0.0.1", "iqn.2020-01.t:1"),
+                             ("10.0.0.1", "iqn.2020-01.t:1", "Normal"))
+            self.assertEqual(SessionPool.Key("10.0.0.1"), ("10.0.0.1", None, "Discovery"))
+
+        def testLimits(self):
+            self.assertRaises(ValueError, SessionPool, None, 4, 8, 0)
+
+        def testReuse(self):
+            pool = self.Pool(keepalive = 0)
+            session = pool.Get(PORTAL, TARGET)
+            self.assertEqual(session.state, InitSession.STATE_LOGGED_IN)
+            pool.Put(session)
+            self.assertEqual((pool.total, pool.idle), (1, 1))
+            self.assertIs(pool.Get(PORTAL, TARGET), session)
+            self.assertEqual((pool.total, pool.idle), (1, 0))
+            # discovery session is of another key
+            discovery = pool.Get(PORTAL)
+            self.assertIsNot(discovery, session)
+            self.assertEqual(pool.total, 2)
+            self.assertEqual(len(self.target.conns), 2)
+            pool.Put(session)
+            pool.Put(discovery)
+
+        def testEvict(self):
+            # least recently used idle session of another key makes room
+            pool = self.Pool(max_total = 2, max_idle = 2, keepalive = 0)
+            first = pool.Get(PORTAL, TARGET)
+            second = pool.Get(PORTAL)
+            pool.Put(first)
+            pool.Put(second)
+            third = pool.Get("pipe:pool", TARGET)
+            self.LoggedOut(first)
+            self.assertEqual((pool.total, pool.idle), (2, 1))
+            self.assertEqual(second.state, InitSession.STATE_LOGGED_IN)
+            self.assertIs(pool.Get(PORTAL), second)
+            pool.Put(second)
+            pool.Put(third)
+
+        def testTimeout(self):
+            pool = self.Pool(max_total = 1, max_idle = 1, keepalive = 0)
+            session = pool.Get(PORTAL, TARGET)
+            start = time.monotonic()
+            self.assertRaises(TimeoutError, pool.Get, PORTAL, TARGET, 0.2)
+            self.assertGreaterEqual(time.monotonic() - start, 0.2)
+            self.assertEqual(pool.total, 1)
+            # session put back wakes up the waiting Get
+            timer = threading.Timer(0.1, pool.Put, (session,))
+            timer.start()
+            self.assertIs(pool.Get(PORTAL, TARGET, 5), session)
+            timer.join()
+            pool.Put(session)
+
+        def testRefused(self):
+            pool = self.Pool(keepalive = 0)
+            self.assertRaises(ConnectionError, pool.Get, "pair:nobody", TARGET, 5)
+            self.assertEqual(pool.total, 0)
+
+        def testMaxIdle(self):
+            pool = self.Pool(max_total = 4, max_idle = 1, keepalive = 0)
+            first = pool.Get(PORTAL, TARGET)
+            second = pool.Get(PORTAL, TARGET)
+            pool.Put(first)
+            pool.Put(second)
+            self.assertEqual((pool.total, pool.idle), (1, 1))
+            self.LoggedOut(first)
+            self.assertIs(pool.Get(PORTAL, TARGET), second)
+            pool.Put(second)
+
+        def testKeepalive(self):
+            pool = self.Pool(keepalive = 0.2)
+            session = pool.Get(PORTAL, TARGET)
+            pool.Put(session)
+            Wait(lambda: len(self.target.Commands(pdu.BHS.OPCODE_NOP_OUT)) >= 2)
+            self.assertEqual((pool.total, pool.idle), (1, 1))
+            # session not answering ping is dropped
+            self.target.silent = True
+            Wait(lambda: pool.idle == 0)
+            self.assertEqual(pool.total, 0)
+            Wait(lambda: len(self.target.Commands(pdu.BHS.OPCODE_LOGOUT_REQ)) == 1)
+
+        def testIdleTimeout(self):
+            pool = self.Pool(keepalive = 0, idle_timeout = 0.2)
+            session = pool.Get(PORTAL, TARGET)
+            pool.Put(session)
+            self.assertEqual(pool.idle, 1)
+            Wait(lambda: pool.idle == 0)
+            self.assertEqual(pool.total, 0)
+            self.LoggedOut(session)
+            self.assertEqual(len(self.target.Commands(pdu.BHS.OPCODE_LOGOUT_REQ)), 1)
+
+        def testDiscardClose(self):
+            pool = self.Pool(keepalive = 0)
+            discarded = pool.Get(PORTAL, TARGET)
+            idle = pool.Get(PORTAL, TARGET)
+            in_use = pool.Get(PORTAL, TARGET)
+            pool.Discard(discarded)
+            self.assertEqual((pool.total, pool.idle), (2, 0))
+            self.LoggedOut(discarded)
+            pool.Discard(discarded) # isn't from pool any more
+            self.assertEqual(pool.total, 2)
+            pool.Put(idle)
+            pool.Close()
+            self.assertEqual(idle.state, InitSession.STATE_FREE)
+            self.assertEqual((pool.total, pool.idle), (1, 0))
+            self.assertRaises(ConnectionError, pool.Get, PORTAL, TARGET)
+            # session in use is logged out when it's put back
+            self.assertEqual(in_use.state, InitSession.STATE_LOGGED_IN)
+            pool.Put(in_use)
+            self.assertEqual(pool.total, 0)
+            self.LoggedOut(in_use)
+            self.assertEqual(len(self.target.Commands(pdu.BHS.OPCODE_LOGOUT_REQ)), 3)
+
+    unittest.main()
@@ -14,235 +14,1001 @@
 #
 
 
+import logging
 import pdu
 import keys
 import queue
 import traceback
 import _thread
+import collections
+import copy
+import time
+import random
+import threading
+import concurrent.futures
 import events
+import socket
+import transport
+from utils import SerialLt, SerialLe
+from tasks import TaskTable
+from policy import RoundRobin
 
 
 class Session():
     pass
 
-class InitSession(Session):
+class LoginError(Exception):
+    '''
+    Login rejected by target
+    '''
+    def __init__(self, status_class, status_detail):
+        super().__init__("login failed with status class(%d) detail(%d)" % (status_class, status_detail))
+        self.status_class = status_class
+        self.status_detail = status_detail
+
+class ISIDAllocator():
+    '''
+    Hands out ISIDs unique in process to sessions of all threads and event
+    loops. ISIDs are of random type, A and B are the random number drawn
+    once, C and D are the qualifier counting sessions.
+    '''
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__random = random.getrandbits(22)
+        self.__qualifier = 0
+        
+    def Alloc(self):
+        with self.__lock:
+            self.__qualifier = (self.__qualifier + 1) & 0xFFFFFF
+            qualifier = self.__qualifier
+        return pdu.ISID(raw = None, seq = (pdu.ISID.T_RANDOM, self.__random >> 16, self.__random & 0xFFFF,
+                                           qualifier >> 16, qualifier & 0xFFFF))
+
+# allocator of initiator sessions in process
+ISIDS = ISIDAllocator()
+
+class ScsiTask():
+    '''
+    SCSI command issued on a session and its outcome
+    @param lun: logical unit number
+    @param cdb: command descriptor block
+    @param buf: writable buffer Data-In is placed into, or data to be
+    written when write is set, None for no data
+    @param write: data is sent from buf with Data-Out
+    '''
+    def __init__(self, lun, cdb, buf = None, write = False):
+        self.lun = lun
+        self.cdb = cdb
+        self.buf = None if buf == None else memoryview(buf).cast("B")
+        self.write = write
+        self.expdatasn = 0 # DataSN of next Data-In
+        self.received = 0 # bytes placed into buf
+        self.response = None
+        self.status = None
+        self.residual = 0 # ResidualCount, negative for overflow
+        self.sense = b""
+
+    def Reset(self):
+        '''
+        Forget outcome of a previous issue, command is issued again
+        '''
+        self.expdatasn = 0
+        self.received = 0
+        self.response = None
+        self.status = None
+        self.residual = 0
+        self.sense = b""
+
+    @property
+    def length(self):
+        return 0 if self.buf == None else len(self.buf)
+
+    @property
+    def good(self):
+        return (self.response == pdu.ScsiRespPDU.RESPONSE_COMPLETED and
+                self.status == pdu.ScsiRespPDU.STATUS_GOOD)
+
+class TextTask():
+    '''
+    Text request and its response, which may come in several pdus
+    @param text: key=value pairs of request
+    @param on_data: called with each piece of response data as it arrives,
+    response isn't kept then
+    '''
+    def __init__(self, text, on_data = None):
+        self.text = text
+        self.on_data = on_data
+        self.ttt = 0xFFFFFFFF # TargetTransferTag asking for rest of response
+        self.chunks = []
+        self.length = 0 # bytes of response received
+        
+    def Reset(self):
+        '''
+        Forget response of a previous issue, request is sent again
+        '''
+        self.ttt = 0xFFFFFFFF
+        self.chunks = []
+        self.length = 0
+        
+    def Add(self, data):
+        self.length += len(data)
+        if self.on_data != None:
+            self.on_data(data)
+        else:
+            self.chunks += [bytes(data)]
+            
+    @property
+    def response(self):
+        if self.on_data != None:
+            return self.length
+        return b"".join(self.chunks)
+
+class SessionProtocol():
+    '''
+    State of an initiator session and the pdus it exchanges, without I/O
+    or threads. InitSession and aio.AsyncSession drive one: they choose
+    when and on which connection a command goes, Send* methods build its
+    pdus and queue them with SendPdu of that connection, and pdus received
+    on connections are handed to ProcessPDU. What needs the driver is
+    reported through callbacks, called from the caller of ProcessPDU.
+    @param init_name: name of initiator
+    @param tgt_name: target for a normal session, discovery session if None
+    @param proposal: keys.SessionParams offered in login, keys.Proposal() if None
+    @param on_release: called with cmd when its task slot is freed, before
+    its future completes
+    @param on_login: called with (conn, cmd, exception) when login of conn
+    completes, exception is None when it succeeds
+    @param on_logout: called with (conn, response) of logout response
+    @param on_text: called with cmd whose text response continues, rest of
+    it is asked with SendText in command window
+    @param on_r2t: called with (cmd, ttt, offset, length) asked by an r2t,
+    data is sent with SendDataOut
+    @param on_ping: called with (conn, nop_in) for a ping of target, it's
+    answered with SendNopOut
+    '''
+    # logger for initiator session protocol
+    logger = logging.getLogger("Session Protocol")
+    logger.setLevel(logging.DEBUG)
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.DEBUG)
+    logger.addHandler(ch)
+    
     STATE_FREE = 0
     STATE_LOGGED_IN = 1
-    STATE_FAILED = 0
-    
-    TYPE_DISCOVERY = 0
-    TYPE_NORMAL = 1
+    STATE_FAILED = 2
     
     EVENT_SUCC_LOGIN = 0
     EVENT_SUCC_LOGOUT = 1
+    EVENT_CONN_LOST = 2
     
-    __ISID = pdu.ISID(raw = None, seq = (2,0,0,0,1))# T=random A,B,C,D
-    
-    class Msg():
-        ID_LOGIN = 0
-        ID_SEND_TEXT = 1
-        ID_LOGOUT = 3
-        ID_EXIT = 4
-        
-        def __init__(self, id, data = None):
-            self.id = id
-            self.data = data
-            
     class Cmd():
-        def __init__(self, sent_pdu, cid, session):
-            self.sent_pdu = sent_pdu
-            self.cid = cid
-            sent_pdu.CmdSN = session._InitSession__cmdsn
-            if not sent_pdu.Immediate:
-                session._InitSession__cmdsn += 1
-            sent_pdu.InitiatorTaskTag = session._InitSession__itt
-            session._InitSession__itt += 1
-            session._InitSession__cmds[sent_pdu.InitiatorTaskTag] = self
-    
-    def __init__(self, init, portal, tgt_name = None):
-        self.init = init # initiator
-        self.__cid = 1
+        def __init__(self, task, future):
+            self.task = task # ScsiTask, TextTask or keys.Negotiator of login
+            self.itt = None # given when submitted
+            self.cid = None
+            self.sent_pdu = None
+            self.resp_pdu = None
+            self.future = future # concurrent.futures or asyncio one of driver
+    
+    def __init__(self, init_name, tgt_name = None, proposal = None, max_tasks = 1024,
+                 on_release = None, on_login = None, on_logout = None, on_text = None,
+                 on_r2t = None, on_ping = None):
         self.__tsih = 0
-        self.__isid = pdu.ISID(self.__ISID.raw_data[0:])
-        self.__ISID.D += 1
+        self.__isid = ISIDS.Alloc()
         self.__cmdsn = 1
         self.__expcmdsn = 0
         self.__maxcmdsn = 1
-        self.__itt = 1
-        self.__portal = portal
-        self.__init_event_listener = init.evt_lisener
         if tgt_name == None:
             self.__session_type = keys.SessionType("Discovery")
         else:
             self.__session_type = keys.SessionType("Normal")
-        self.__init_name = keys.InitName(init.name)
-        self.__keys = [self.__init_name, self.__session_type]
+        self.__keys = [keys.InitName(init_name), self.__session_type]
+        if tgt_name != None:
+            self.__keys += [keys.TargetName(tgt_name)]
+        self.__params = keys.SessionParams() # negotiated
+        self.__proposal = keys.Proposal() if proposal == None else proposal
         self.__state = self.STATE_FREE
-        self.__genq = queue.Queue(0)
-        self.__pdu_listener = events.EventListener()
-        self.__connections = {self.__cid:InitConn(portal, self.__pdu_listener, self, self.__cid)}
-        self.__cid += 1
-        self.__cmds = {} # itt:cmd list
-        self.__sender_tid = _thread.start_new_thread(self.__PduGenThread, tuple())
-        self.__recv_tid = _thread.start_new_thread(self.__PduProcessThread, tuple())    
-
-    def __del__(self):
-        # close connection
-        del self.__connections
-        # kill threads
-        self.__genq.put_nowait(self.Msg(self.Msg.ID_EXIT))
-        self.__pdu_listener.Signal(self.Msg(self.Msg.ID_EXIT))
+        self.__connections = {} # cid:connection, kept by driver
+        self.__tasks = TaskTable(max_tasks) # itt:cmd
+        self.__relogin = None # leading:payload declaring keys agreed in login
+        self.__relogin_params = None
+        self.__on_release = on_release
+        self.__on_login = on_login
+        self.__on_logout = on_logout
+        self.__on_text = on_text
+        self.__on_r2t = on_r2t
+        self.__on_ping = on_ping
+        self.__handlers = {pdu.BHS.OPCODE_LOGIN_RES:self.__ProcessLoginResp,
+                           pdu.BHS.OPCODE_TEXT_RES:self.__ProcessTextResp,
+                           pdu.BHS.OPCODE_LOGOUT_RES:self.__ProcessLogoutResp,
+                           pdu.BHS.OPCODE_DATA_IN:self.__ProcessDataIn,
+                           pdu.BHS.OPCODE_SCSI_CMD_RES:self.__ProcessScsiResp,
+                           pdu.BHS.OPCODE_R2T:self.__ProcessR2T,
+                           pdu.BHS.OPCODE_NOP_IN:self.__ProcessNopIn} # opcode:handler
+        
+    @property
+    def state(self):
+        return self.__state
+    
+    @property
+    def isid(self):
+        return self.__isid
+    
+    @property
+    def tsih(self):
+        return self.__tsih
+    
+    @tsih.setter
+    def tsih(self, tsih):
+        self.__tsih = tsih
+    
+    @property
+    def params(self):
+        '''
+        keys.SessionParams negotiated in login
+        '''
+        return self.__params
+    
+    @property
+    def proposal(self):
+        return self.__proposal
+    
+    @property
+    def tasks(self):
+        return self.__tasks
+    
+    @property
+    def connections(self):
+        '''
+        cid:connection of session, connections are added and removed by driver
+        '''
+        return self.__connections
+    
+    @property
+    def discovery(self):
+        return self.__session_type.tvalue == "Discovery"
+    
+    def ProcessEvent(self, event):
+        if not isinstance(event, int):
+            raise TypeError
+        if self.__state == self.STATE_FREE:
+            if event == self.EVENT_SUCC_LOGIN:
+                self.__state = self.STATE_LOGGED_IN
+            elif event == self.EVENT_CONN_LOST:
+                self.__state = self.STATE_FAILED
+        elif self.__state == self.STATE_LOGGED_IN:
+            if event == self.EVENT_SUCC_LOGOUT:
+                self.__state = self.STATE_FREE
+            elif event == self.EVENT_CONN_LOST:
+                self.__state = self.STATE_FAILED
+        elif self.__state == self.STATE_FAILED:
+            pass
+        else:
+            pass
+        
+    def Negotiator(self, leading, relogin = False):
+        '''
+        Returns keys.Negotiator of a login, the leading one of session or
+        one of a connection added to it
+        @param relogin: login reinstating a connection, values agreed in
+        login of session are declared at once
+        '''
+        if relogin:
+            params = self.__params if leading else copy.copy(self.__params)
+            negotiator = keys.Negotiator(self.__relogin_params, params, leading, self.discovery)
+            negotiator.Offered() # by cached payload
+            return negotiator
+        # connection keys are negotiated apart from session ones
+        params = self.__params if leading else copy.copy(self.__params)
+        return keys.Negotiator(self.__proposal, params, leading, self.discovery)
+    
+    def WindowOpen(self):
+        '''
+        Returns whether a non-immediate command can be sent, CmdSN is within
+        MaxCmdSN
+        '''
+        return SerialLe(self.__cmdsn, self.__maxcmdsn)
+    
+    def __Assign(self, cmd, sent_pdu, conn):
+        # number command pdu when it's sent
+        cmd.sent_pdu = sent_pdu
+        cmd.cid = conn.cid
+        sent_pdu.CmdSN = self.__cmdsn
+        if not sent_pdu.Immediate:
+            self.__cmdsn = (self.__cmdsn + 1) & 0xFFFFFFFF
+        sent_pdu.InitiatorTaskTag = cmd.itt
+        
+    def Finish(self, cmd, result):
+        '''
+        Give task slot and pdu of cmd back, then complete its future
+        '''
+        self.__tasks.Release(cmd.itt)
+        if cmd.sent_pdu != None:
+            cmd.sent_pdu.Release()
+            cmd.sent_pdu = None
+        if self.__on_release != None:
+            self.__on_release(cmd)
+        if not cmd.future.done():
+            cmd.future.set_result(result)
+            
+    def Fail(self, cmd, exception):
+        self.__tasks.Release(cmd.itt)
+        if cmd.sent_pdu != None:
+            cmd.sent_pdu.Release()
+            cmd.sent_pdu = None
+        if self.__on_release != None:
+            self.__on_release(cmd)
+        if not cmd.future.done():
+            cmd.future.set_exception(exception)
+            
+    def FailAll(self, exception):
+        for cmd in self.__tasks.Commands():
+            self.Fail(cmd, exception)
+            
+    def FailConnection(self, cid, exception):
+        '''
+        Fail commands of connection cid, they keep allegiance to it
+        '''
+        for cmd in self.__tasks.Commands():
+            if cmd.cid == cid:
+                self.Fail(cmd, exception)
         
-    def __SendLogin(self, conn, cmd = None):
-        # generate pdu
-        if cmd == None:# first login pdu
+    def SendLogin(self, conn, cmd, answers = []):
+        '''
+        Send next login pdu of cmd on conn, cmd is finished when login
+        reaches full feature phase
+        @param answers: keys answering offers of target
+        '''
+        if cmd.sent_pdu == None and cmd.task.offered:
+            # reinstatement, keys agreed before are declared at once so
+            # target can go to full feature phase in its first response
             l_pdu = pdu.LoginPDU()
-            if conn.auth_method.value == [keys.AuthMethod.NONE]:
-                l_pdu.Transit = True
-            else:
-                l_pdu.Transit = False
-            l_pdu.CurrentStage = pdu.LoginPDU.SECURITY_NEG
-            l_pdu.NextStage = pdu.LoginPDU.LOGIN_OPERATIONAL_NEG
+            l_pdu.Encode(Transit = True, CurrentStage = pdu.LoginPDU.LOGIN_OPERATIONAL_NEG,
+                         NextStage = pdu.LoginPDU.FULL_FEATURE_PHASE)
+            l_pdu.AppendData(self.__relogin[cmd.task.leading])
+            self.__Assign(cmd, l_pdu, conn)
+            
+        elif cmd.sent_pdu == None:# first login pdu
+            l_pdu = pdu.LoginPDU()
+            l_pdu.Encode(Transit = conn.auth_method.value == [keys.AuthMethod.NONE],
+                         CurrentStage = pdu.LoginPDU.SECURITY_NEG,
+                         NextStage = pdu.LoginPDU.LOGIN_OPERATIONAL_NEG)
             l_pdu.AppendData(keys.GenPayload(self.__keys + conn.keys))
-            cmd = self.Cmd(l_pdu, conn.cid, self)
+            self.__Assign(cmd, l_pdu, conn)
             
         else: # this will continuation of logging in
             l_pdu = pdu.LoginPDU()
             if cmd.resp_pdu.Transit:
-                l_pdu.CurrentStage = cmd.resp_pdu.NextStage
-                l_pdu.NextStage = pdu.LoginPDU.FULL_FEATURE_PHASE                
+                cs = cmd.resp_pdu.NextStage
+                ns = pdu.LoginPDU.FULL_FEATURE_PHASE
             else:
                 # send empty login
-                l_pdu.CurrentStage = cmd.resp_pdu.CurrentStage
-                l_pdu.NextStage = cmd.resp_pdu.NextStage  
-            l_pdu.Transit = True
-            l_pdu.InitiatorTaskTag = cmd.resp_pdu.InitiatorTaskTag
-            l_pdu.CmdSN = self.__cmdsn
+                cs = cmd.resp_pdu.CurrentStage
+                ns = cmd.resp_pdu.NextStage
+            l_pdu.Encode(Transit = True, CurrentStage = cs, NextStage = ns,
+                         InitiatorTaskTag = cmd.itt, CmdSN = self.__cmdsn)
+            if cs == pdu.LoginPDU.LOGIN_OPERATIONAL_NEG:
+                negotiator = cmd.task
+                if not negotiator.offered:
+                    answers = answers + negotiator.Offer()
+                if len(answers) != 0:
+                    l_pdu.AppendData(keys.GenPayload(answers))
             
         if l_pdu.CurrentStage == pdu.LoginPDU.FULL_FEATURE_PHASE:
             # login complete
-            conn.ProcessEvent(conn.EVENT_SUCC_LOGIN_FINAL) # update connection state
+            self.__ApplyParams(conn, cmd.task.params)
+            if cmd.task.leading:
+                self.__CacheLogin()
+            if self.__on_login != None:
+                self.__on_login(conn, cmd, None)
             self.ProcessEvent(self.EVENT_SUCC_LOGIN) # update session state
-            self.__init_event_listener.Signal(events.Event(events.Event.ID_LOGGED_IN))# notify initiator
-            del self.__cmds[cmd.resp_pdu.InitiatorTaskTag]
+            l_pdu.Release()
+            self.Finish(cmd, True)
             return
-        l_pdu.ISID = self.__isid
-        l_pdu.CID = conn.cid
+        # connections added to a logged in session join it with its TSIH
+        tsih = self.__tsih if self.__state == self.STATE_LOGGED_IN else 0
+        l_pdu.Encode(ISID = self.__isid.raw_data, TSIH = tsih, CID = conn.cid)
         
-        # send pdu
-        conn.SendPdu(l_pdu)
+        # send pdu, continuation pdus aren't kept by cmd
+        conn.SendPdu(l_pdu, l_pdu is not cmd.sent_pdu)
         
-    def __ProcessLoginResp(self, resp_pdu):
+    def __ProcessLoginResp(self, resp_pdu, conn):
         # check login resp pdu fields are valid
         if resp_pdu.StatusClass != pdu.LoginRespPDU.STATUS_CLASS_SUCCESS:
             self.logger.error("login response with status class(%d) detail(%d)" % (resp_pdu.StatusClass, resp_pdu.StatusDetail))
+            cmd = self.__tasks.Get(resp_pdu.InitiatorTaskTag)
+            if cmd != None:
+                exception = LoginError(resp_pdu.StatusClass, resp_pdu.StatusDetail)
+                if self.__on_login != None:
+                    self.__on_login(self.__connections.get(cmd.cid), cmd, exception)
+                self.Fail(cmd, exception)
             return
         if resp_pdu.ISID != self.__isid:
             self.logger.error("login response received from wrong session")
             return
-#        if resp_pdu.TSIH != 0:
-#            self.logger.error("target didn't assign a valid tsih for this connection")
-#            return
         if self.__tsih != 0 and self.__tsih != resp_pdu.TSIH:
             self.logger.error("target response with wrong tsid")
             return
         self.__tsih = resp_pdu.TSIH
         # find related cmd for itt in pdu
-        try:
-            cmd = self.__cmds[resp_pdu.InitiatorTaskTag]
-            cmd.resp_pdu = resp_pdu
-        except:
+        cmd = self.__tasks.Get(resp_pdu.InitiatorTaskTag)
+        if cmd == None:
             self.logger.error("login response for wrong initiator task id")
             return
-            
+        cmd.resp_pdu = resp_pdu
         conn = self.__connections[cmd.cid]
             
-        conn.expstatsn = resp_pdu.StatSN
-            
         # parse data segment create key value pairs
         offset = resp_pdu.PayloadOffset
         end = offset + resp_pdu.DataSegmentLength
-        payload = resp_pdu[offset:end]
-        keys_dic = keys.ParsePayload(payload)
+        answers = cmd.task.Update(keys.ParsePayload(resp_pdu[offset:end]))
             
         # send login pdu
-        self.__SendLogin(conn, cmd)
-        
-    def __SendText(self, conn, text, cmd = None):
-        if cmd == None:# first pdu, create cmd
-            t_pdu = pdu.TextPDU()
-            t_pdu.Final = True # according to text length 
-            t_pdu.TargetTransferTag = 0xFFFFFFFF
-            t_pdu.AppendData(text)
-            cmd = self.Cmd(t_pdu, conn.cid, self)
+        self.SendLogin(conn, cmd, answers)
+        
+    def __ApplyParams(self, conn, params):
+        # digests start with full feature phase, pdus sent afterwards are
+        # sized by negotiated lengths
+        conn.header_digest = params.header_digest
+        conn.data_digest = params.data_digest
+        if params is not self.__params:
+            # connection added to session, pdus must fit all connections
+            self.__params.max_xmit_data_segment_length = min(self.__params.max_xmit_data_segment_length,
+                                                             params.max_xmit_data_segment_length)
+        if self.__params.max_xmit_data_segment_length > pdu.PDU.pool.data_size:
+            pdu.PDU.pool.Resize(self.__params.max_xmit_data_segment_length)
+        
+    def __CacheLogin(self):
+        # payloads of reinstatement logins are encoded once, they declare
+        # values agreed in login of session; the leading one is used when
+        # target doesn't know session anymore
+        proposal = copy.copy(self.__params)
+        relogin = {}
+        for leading in (True, False):
+            negotiator = keys.Negotiator(proposal, keys.SessionParams(), leading, self.discovery)
+            relogin[leading] = keys.GenPayload(self.__keys + negotiator.Offer()).encode("utf8")
+        self.__relogin_params = proposal
+        self.__relogin = relogin
+        
+    def SendText(self, conn, cmd):
+        task = cmd.task
+        t_pdu = pdu.TextPDU()
+        t_pdu.Final = True
+        if task.ttt == 0xFFFFFFFF:
+            t_pdu.AppendData(task.text)
+        else:
+            # empty request with same itt asks for next part of response
+            t_pdu.TargetTransferTag = task.ttt
+            cmd.sent_pdu.Release()
+        self.__Assign(cmd, t_pdu, conn)
         conn.SendPdu(t_pdu)
         
-    def __ProcessTextResp(self, text_resp):
-        if text_resp.Final and not text_resp.Continue:
-            # find command
-            try:
-                cmd = self.__cmds[text_resp.InitiatorTaskTag]
-                cmd.resp_pdu = text_resp
-            except:
-                self.logger.error("login response for wrong initiator task id")
-                return
-            offset = text_resp.PayloadOffset
-            end = text_resp.PayloadOffset + text_resp.DataSegmentLength
-            text = text_resp[offset:end]
-            self.__init_event_listener.Signal(events.Event(events.Event.ID_TEXT_RESP, text))
+    def __ProcessTextResp(self, text_resp, conn):
+        cmd = self.__tasks.Get(text_resp.InitiatorTaskTag)
+        if cmd == None or not isinstance(cmd.task, TextTask):
+            self.logger.error("text response for wrong initiator task id")
+            return
+        cmd.resp_pdu = text_resp
+        offset = text_resp.PayloadOffset
+        end = offset + text_resp.DataSegmentLength
+        if end != offset:
+            cmd.task.Add(text_resp[offset:end])
+        if text_resp.Final:
+            self.Finish(cmd, cmd.task.response)
         else:
-            self.logger.warn("TODO: handle continues text pdu sequences")
-            # TODO: handle continues sequences
+            # C bit or an unfinished negotiation, target waits for a request
+            # with its TargetTransferTag
+            cmd.task.ttt = text_resp.TargetTransferTag
+            self.__on_text(cmd)
             
-    def __SendLogout(self, conn, cmd = None):
-        if cmd == None:
-            lo_pdu = pdu.LogoutPDU()
-            lo_pdu.ReasonCode = lo_pdu.REASON_CLOSE_SESSION
-            cmd = self.Cmd(lo_pdu, conn.cid, self)
-        else:
-            pass
+    def SendLogout(self, conn, cmd):
+        lo_pdu = pdu.LogoutPDU()
+        lo_pdu.ReasonCode = lo_pdu.REASON_CLOSE_SESSION
+        self.__Assign(cmd, lo_pdu, conn)
         conn.SendPdu(lo_pdu)
         
-    def __ProcessLogoutResp(self, logout_resp):
+    def __ProcessLogoutResp(self, logout_resp, conn):
+        cmd = self.__tasks.Get(logout_resp.InitiatorTaskTag)
+        if cmd == None:
+            self.logger.error("logout response for wrong initiator task id")
+            return
+        cmd.resp_pdu = logout_resp
+        if self.__on_logout != None:
+            self.__on_logout(self.__connections.get(cmd.cid), logout_resp.Response)
+        if logout_resp.Response == pdu.LogoutRespPDU.RESPONSE_SUCC:
+            self.ProcessEvent(self.EVENT_SUCC_LOGOUT)
+        self.Finish(cmd, logout_resp.Response)
+        
+    def SendNopOut(self, conn, cmd, ttt = 0xFFFFFFFF):
+        '''
+        Send a ping for cmd, or reply to ping of target with ttt if cmd is None
+        '''
+        # nop-outs are immediate, they don't consume CmdSN
+        n_pdu = pdu.NopOutPDU()
+        n_pdu.Encode(Immediate = True, TargetTransferTag = ttt)
+        if cmd == None:
+            # reply to ping of target, nothing answers it
+            n_pdu.Encode(InitiatorTaskTag = 0xFFFFFFFF, CmdSN = self.__cmdsn)
+            conn.SendPdu(n_pdu, True)
+            return
+        self.__Assign(cmd, n_pdu, conn)
+        conn.SendPdu(n_pdu)
+        
+    def __ProcessNopIn(self, nop_in, conn):
+        if nop_in.InitiatorTaskTag == 0xFFFFFFFF:
+            # ping of target when it has a TargetTransferTag, window is updated by it
+            if nop_in.TargetTransferTag != 0xFFFFFFFF and self.__on_ping != None:
+                self.__on_ping(conn, nop_in)
+            return
+        cmd = self.__tasks.Get(nop_in.InitiatorTaskTag)
+        if cmd == None or not isinstance(cmd.sent_pdu, pdu.NopOutPDU):
+            self.logger.error("nop-in for wrong initiator task id")
+            return
+        self.Finish(cmd, True)
+        
+    def SendScsiCmd(self, conn, cmd):
+        task = cmd.task
+        params = self.__params
+        immediate = 0
+        if task.write and params.immediate_data:
+            immediate = min(task.length, params.first_burst_length,
+                            params.max_xmit_data_segment_length)
+        end = immediate
+        if task.write and not params.initial_r2t:
+            # unsolicited data up to FirstBurstLength, no R2T round trip
+            end = min(task.length, params.first_burst_length)
+        c_pdu = pdu.ScsiCmdPDU()
+        # F is cleared when unsolicited Data-Out follows, RFC 7143 11.3.1.1
+        c_pdu.Encode(Final = end <= immediate, Read = task.buf != None and not task.write,
+                     Write = task.write, LUN = pdu.EncodeLun(task.lun),
+                     ExpectedDataTransferLength = task.length, CDB = task.cdb)
+        if immediate != 0:
+            c_pdu.AppendData(task.buf[:immediate])
+        self.__Assign(cmd, c_pdu, conn)
+        conn.SendPdu(c_pdu)
+        if end > immediate:
+            self.SendDataOut(conn, cmd, 0xFFFFFFFF, immediate, end - immediate)
+        
+    def SendDataOut(self, conn, cmd, ttt, offset, length):
+        '''
+        Send one sequence of Data-Out pdus, each referencing a slice of
+        caller's buffer
+        '''
+        task = cmd.task
+        lun = pdu.EncodeLun(task.lun)
+        itt = cmd.itt
+        mxdsl = self.__params.max_xmit_data_segment_length
+        end = offset + length
+        datasn = 0
+        while offset < end:
+            n = min(mxdsl, end - offset)
+            d_pdu = pdu.DataOutPDU()
+            d_pdu.Encode(Final = offset + n == end, LUN = lun, InitiatorTaskTag = itt,
+                         TargetTransferTag = ttt, DataSN = datasn, BufferOffset = offset)
+            d_pdu.AppendData(task.buf[offset:offset + n])
+            conn.SendPdu(d_pdu, True)
+            offset += n
+            datasn += 1
+        
+    def __ProcessR2T(self, r2t, conn):
+        cmd = self.__tasks.Get(r2t.InitiatorTaskTag)
+        if cmd == None or not isinstance(cmd.task, ScsiTask):
+            self.logger.error("r2t for wrong initiator task id")
+            return
+        task = cmd.task
+        offset = r2t.BufferOffset
+        length = r2t.DesiredDataTransferLength
+        if not task.write or offset + length > task.length:
+            self.logger.error("r2t for (%d) bytes at offset(%d) is out of task buffer" % (length, offset))
+            return
+        if length > self.__params.max_burst_length:
+            self.logger.warn("r2t for (%d) bytes exceeds MaxBurstLength" % length)
+        self.__on_r2t(cmd, r2t.TargetTransferTag, offset, length)
+        
+    def __ProcessDataIn(self, data_in, conn):
+        cmd = self.__tasks.Get(data_in.InitiatorTaskTag)
+        if cmd == None or not isinstance(cmd.task, ScsiTask):
+            self.logger.error("data-in for wrong initiator task id")
+            return
+        task = cmd.task
+        # data is placed by BufferOffset, DataSN only reveals lost pdus
+        if data_in.DataSN != task.expdatasn:
+            self.logger.warn("data-in with DataSN(%d) while expecting (%d)" % (data_in.DataSN, task.expdatasn))
+        task.expdatasn = (data_in.DataSN + 1) & 0xFFFFFFFF
+        offset = data_in.BufferOffset
+        length = data_in.DataSegmentLength
+        if offset + length > task.length:
+            self.logger.error("data-in at offset(%d) overruns buffer of (%d) bytes" % (offset, task.length))
+        elif length != 0:
+            task.buf[offset:offset + length] = data_in.payload
+            task.received += length
+        if data_in.StatusPresent:
+            # status is in final Data-In, no SCSI response follows
+            task.response = pdu.ScsiRespPDU.RESPONSE_COMPLETED
+            task.status = data_in.Status
+            if data_in.Underflow:
+                task.residual = data_in.ResidualCount
+            elif data_in.Overflow:
+                task.residual = -data_in.ResidualCount
+            self.Finish(cmd, task)
+            
+    def __ProcessScsiResp(self, resp, conn):
+        cmd = self.__tasks.Get(resp.InitiatorTaskTag)
+        if cmd == None or not isinstance(cmd.task, ScsiTask):
+            self.logger.error("scsi response for wrong initiator task id")
+            return
+        task = cmd.task
+        task.response = resp.Response
+        task.status = resp.Status
+        if resp.Underflow:
+            task.residual = resp.ResidualCount
+        elif resp.Overflow:
+            task.residual = -resp.ResidualCount
+        task.sense = resp.SenseData
+        self.Finish(cmd, task)
+        
+    def ProcessPDU(self, recv_pdu, conn = None):
+        '''
+        Handle a received pdu, returns True when it opens command window
+        further, commands waiting for it can be sent then
+        @param conn: connection pdu is received on, pings of target are
+        answered on it
+        '''
         try:
-            cmd = self.__cmds[logout_resp.InitiatorTaskTag]
-            cmd.resp_pdu = logout_resp
-            if logout_resp.Response == pdu.LogoutRespPDU.RESPONSE_SUCC:
-                #self.ProcessEvent(event)
-                self.__init_event_listener.Signal(events.Event(events.Event.ID_LOGGED_OUT))
+            handler = self.__handlers[recv_pdu.Opcode]
         except KeyError:
-            self.logger.error("login response for wrong initiator task id")
-            return
+            self.logger.warn("not able to process pdu with opcode (%d)" % recv_pdu.Opcode)
+            return False
+        handler(recv_pdu, conn)
             
+        # MaxCmdSN == ExpCmdSN - 1 closes the window, anything less is invalid
+        maxcmdsn = recv_pdu.MaxCmdSN
+        expcmdsn = recv_pdu.ExpCmdSN
+        if SerialLe((expcmdsn - 1) & 0xFFFFFFFF, maxcmdsn):
+            if SerialLt(self.__expcmdsn, expcmdsn):
+                self.__expcmdsn = expcmdsn
+            if SerialLt(self.__maxcmdsn, maxcmdsn):
+                self.__maxcmdsn = maxcmdsn
+                return True
+        else:
+            self.logger.warn("expcmdsn and maxcmdsn values are ignored") 
+        return False
+
+class InitSession(Session):
+    # logger for initiator session
+    logger = logging.getLogger("Init Session")
+    logger.setLevel(logging.DEBUG)
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.DEBUG)
+    logger.addHandler(ch)
+    
+    STATE_FREE = 0
+    STATE_LOGGED_IN = 1
+    STATE_FAILED = 2
+    
+    TYPE_DISCOVERY = 0
+    TYPE_NORMAL = 1
+    
+    EVENT_SUCC_LOGIN = 0
+    EVENT_SUCC_LOGOUT = 1
+    EVENT_CONN_LOST = 2
+    
+    class Msg():
+        ID_LOGIN = 0
+        ID_SEND_TEXT = 1
+        ID_LOGOUT = 3
+        ID_EXIT = 4
+        ID_SCSI_CMD = 5
+        ID_R2T = 6
+        ID_WINDOW = 7 # MaxCmdSN advanced
+        ID_TEXT_CONT = 8 # text request for rest of response
+        ID_NOP_OUT = 9 # ping of initiator
+        ID_NOP_REPLY = 10 # reply to ping of target
+        ID_REINSTATE = 11 # transport of lost connection is opened again
+        ID_REINSTATED = 12 # reinstatement login completed or timed out
         
-    def __ProcessPDU(self, recv_pdu):
-        if recv_pdu.Opcode == pdu.BHS.OPCODE_LOGIN_RES:
-            login_resp = pdu.LoginRespPDU(recv_pdu.raw_data)
-            #print dump(data)
+        def __init__(self, id, data = None):
+            self.id = id
+            self.data = data
             
-            self.__ProcessLoginResp(login_resp)
-            recv_pdu = login_resp
+    class Cmd(SessionProtocol.Cmd):
+        def __init__(self, task = None):
+            super().__init__(task, concurrent.futures.Future())
+            self.nbytes = None # accounted on connection while issued
+            self.msg_id = None # msg it's submitted with, it's issued again by it
+            self.retries = 0 # times it's issued again on a reinstated connection
+    
+    class Reinstatement():
+        # lost connection being logged in again, it's only changed by pdu
+        # processor thread
+        def __init__(self, lost, cmds, delay, deadline):
+            self.lost = lost
+            self.cmds = cmds # held until connection is reinstated
+            self.delay = delay # before next attempt
+            self.deadline = deadline
+            self.attempt = 0
+            self.conn = None # connection logging in
+            self.login = None # cmd of login
+            self.exception = ConnectionError("connection (%d) is lost" % lost.cid)
+    
+    MAX_TASKS = 1024 # default cap of outstanding commands
+    REINSTATE_ATTEMPTS = 3 # logins tried to reinstate a lost connection
+    REINSTATE_INTERVAL = 1.0 # min seconds between reinstatement logins
+    
+    def __init__(self, init, portal, tgt_name = None, options = None, max_tasks = MAX_TASKS,
+                 policy = None, proposal = None):
+        '''
+        Initiator session, leading connection to portal is opened
+        @param policy: chooses connection of each command, RoundRobin if None,
+        see policy module
+        @param proposal: keys.SessionParams offered in login, keys.Proposal() if None
+        '''
+        self.init = init # initiator
+        self.__cid = 1
+        self.__pending = collections.deque() # msgs waiting for command window
+        self.__portal = portal
+        self.__genq = queue.Queue(0)
+        self.__pdu_listener = events.EventListener()
+        # pdus are built and responses handled by protocol, on session threads
+        self.__protocol = SessionProtocol(init.name, tgt_name, proposal, max_tasks,
+                                          on_release = self.__Unaccount, on_login = self.__LoggedIn,
+                                          on_logout = self.__LoggedOut, on_text = self.__TextContinues,
+                                          on_r2t = self.__R2T)
+        self.__isid = self.__protocol.isid
+        self.__params = self.__protocol.params
+        self.__tasks = self.__protocol.tasks
+        self.__connections = self.__protocol.connections
+        self.__connections[self.__cid] = InitConn(portal, self.__pdu_listener, self, self.__cid, options)
+        self.__cid += 1
+        self.__policy = RoundRobin() if policy == None else policy
+        self.__reinstating = {} # cid:Reinstatement of lost connections
+        self.__reinstate_attempts = self.REINSTATE_ATTEMPTS
+        self.__sender_tid = _thread.start_new_thread(self.__PduGenThread, tuple())
+        self.__recv_tid = _thread.start_new_thread(self.__PduProcessThread, tuple())    
+
+    def __del__(self):
+        self.Close()
+        
+    def __Unaccount(self, cmd):
+        # take completed cmd off load of its connection
+        if cmd.nbytes != None:
+            conn = self.__connections.get(cmd.cid)
+            if conn != None:
+                conn.Account(-1, -cmd.nbytes)
+            cmd.nbytes = None
             
-        elif recv_pdu.Opcode == pdu.BHS.OPCODE_TEXT_RES:
-            text_resp = pdu.TextRespPDU(recv_pdu.raw_data)
-            self.__ProcessTextResp(text_resp)
-            recv_pdu = text_resp
+    def __LoggedIn(self, conn, cmd, exception):
+        if exception == None:
+            conn.ProcessEvent(conn.EVENT_SUCC_LOGIN_FINAL) # update connection state
+        elif self.state == self.STATE_LOGGED_IN:
+            # connection rejected from joining session is dropped
+            self.__connections.pop(cmd.cid, None)
+            if conn != None:
+                conn.Close()
+                
+    def __LoggedOut(self, conn, response):
+        if conn == None:
+            pass
+        elif response == pdu.LogoutRespPDU.RESPONSE_SUCC:
+            conn.ProcessEvent(conn.EVENT_SUCC_LOGOUT_RESP) # T13
+        else:
+            conn.ProcessEvent(conn.EVENT_UNSUCC_LOGOUT_RESP) # T17
             
-        elif recv_pdu.Opcode == pdu.BHS.OPCODE_LOGOUT_RES:
-            lout_resp = pdu.LogoutRespPDU(recv_pdu.raw_data)
-            self.__ProcessLogoutResp(lout_resp)
-            recv_pdu = lout_resp
+    def __TextContinues(self, cmd):
+        self.__genq.put_nowait(self.Msg(self.Msg.ID_TEXT_CONT, cmd))
+        
+    def __R2T(self, cmd, ttt, offset, length):
+        # each r2t is served as it arrives, several may be in progress at once
+        self.__genq.put_nowait(self.Msg(self.Msg.ID_R2T, (cmd, cmd.itt, ttt, offset, length)))
+        
+    def __DropConnection(self, cid, exception):
+        # session fails when its last connection is dropped, before commands
+        # fail so their callers see it
+        conn = self.__connections.pop(cid, None)
+        if conn != None:
+            conn.Close()
+        if len(self.__connections) == 0:
+            self.ProcessEvent(self.EVENT_CONN_LOST)
+            self.__protocol.FailAll(exception)
         else:
-            self.logger.warn("not able to process pdu with opcode (%d)" % bhs.Opcode)
+            self.__protocol.FailConnection(cid, exception)
+        
+    def __Close(self):
+        # connections are closed and commands fail, session can't be used again
+        self.ProcessEvent(self.EVENT_CONN_LOST)
+        for conn in list(self.__connections.values()):
+            conn.Close()
+        self.__protocol.FailAll(ConnectionError("session (%s) is closed" % self.__isid.raw_data))
+        
+    def __ConnectionLost(self, conn):
+        if self.__connections.get(conn.cid) is not conn:
+            return # dropped already
+        exception = ConnectionError("connection (%d) is lost" % conn.cid)
+        r = self.__reinstating.get(conn.cid)
+        if r != None:
+            # its reinstatement login fails, another one is tried
+            if r.login != None:
+                self.__protocol.Fail(r.login, exception)
+            return
+        if conn.state != conn.STATE_FREE:
+            conn.ProcessEvent(conn.EVENT_XPT_DISCONN) # T15 T16 T17, T7 while logging in
+        if conn.state == conn.STATE_CLEANUP_WAIT and self.__protocol.state == self.STATE_LOGGED_IN and \
+           self.__reinstate_attempts > 0 and isinstance(conn.portal, str):
+            # commands of connection are issued again once it's reinstated,
+            # they keep their task slots until then
+            cmds = []
+            for cmd in self.__tasks.Commands():
+                if cmd.cid != conn.cid:
+                    continue
+                if cmd.retries >= self.__reinstate_attempts:
+                    self.__protocol.Fail(cmd, exception) # lost with connection every time
+                    continue
+                cmd.retries += 1
+                cmds += [cmd]
+                self.__Unaccount(cmd)
+                if cmd.sent_pdu != None:
+                    cmd.sent_pdu.Release()
+                    cmd.sent_pdu = None
+            # connection left in CLEANUP_WAIT by T15, T16 or T17 is logged in
+            # again after DefaultTime2Wait, until DefaultTime2Retain passes
+            delay = self.__params.default_time2wait
+            deadline = time.monotonic() + delay + self.__params.default_time2retain
+            r = self.Reinstatement(conn, cmds, delay, deadline)
+            self.__reinstating[conn.cid] = r
+            self.__NextReinstatement(r)
+            return
+        self.__DropConnection(conn.cid, exception)
+        
+    def __NextReinstatement(self, r):
+        # start another attempt of reinstatement or give up
+        if r.attempt >= self.__reinstate_attempts or self.__protocol.state != self.STATE_LOGGED_IN or \
+           (r.attempt != 0 and time.monotonic() + r.delay > r.deadline):
+            self.__Reinstated(r, False)
+            return
+        r.attempt += 1
+        _thread.start_new_thread(self.__ReinstateThread, (r, r.delay))
+        r.delay = max(r.delay, self.REINSTATE_INTERVAL)
+        
+    def __ReinstateThread(self, r, delay):
+        # transport is opened off session threads as connecting may take long,
+        # session takes it with ID_REINSTATE
+        time.sleep(delay)
+        lost = r.lost
+        try:
+            conn = InitConn(lost.portal, self.__pdu_listener, self, lost.cid, lost.options)
+        except OSError as e:
+            conn = e
+        if self.__protocol.state != self.STATE_LOGGED_IN and isinstance(conn, InitConn):
+            conn.Close() # session is closed meanwhile
+        self.__pdu_listener.Signal(self.Msg(self.Msg.ID_REINSTATE, (r, conn)))
+        
+    def __LoginWaitThread(self, r, future, timeout):
+        # session hears of a login not answered in time with ID_REINSTATED
+        concurrent.futures.wait([future], timeout)
+        self.__pdu_listener.Signal(self.Msg(self.Msg.ID_REINSTATED, (r, future)))
+        
+    def __Reinstate(self, r, conn):
+        # login on new transport with ISID, TSIH and CID of lost connection
+        if isinstance(conn, Exception):
+            self.__ReinstateFailed(r, conn)
+            return
+        if self.__protocol.state != self.STATE_LOGGED_IN:
+            conn.Close()
+            self.__Reinstated(r, False)
+            return
+        cid = r.lost.cid
+        replaced = self.__connections.get(cid)
+        self.__connections[cid] = conn
+        if replaced != None:
+            replaced.Close() # lost one or one of a failed attempt
+        r.conn = conn
+        leading = self.__protocol.tsih == 0 # target forgot session, it's reinstated
+        cmd = self.Cmd(self.__protocol.Negotiator(leading, True))
+        cmd.cid = cid
+        # pdu processor mustn't wait for a task slot, it frees them
+        future = self.__Submit(self.Msg.ID_LOGIN, cmd, False)
+        if future == None:
+            self.__ReinstateFailed(r, ConnectionError("no task slot to reinstate connection (%d)" % cid))
+            return
+        r.login = cmd
+        timeout = max(r.deadline - time.monotonic(), self.REINSTATE_INTERVAL)
+        _thread.start_new_thread(self.__LoginWaitThread, (r, future, timeout))
+        
+    def __LoginDone(self, r, future):
+        # reinstatement login is answered, failed or timed out
+        if not future.done():
+            self.__protocol.Fail(r.login, TimeoutError("login of connection (%d) isn't answered" % r.lost.cid))
+        r.login = None
+        try:
+            if future.result(0) == True:
+                self.__Reinstated(r, True)
+                return
+        except LoginError as e:
+            if e.status_class == pdu.LoginRespPDU.STATUS_CLASS_INIT_ERR and \
+               e.status_detail == pdu.LoginRespPDU.STATUS_DETAIL_INIT_SESSION_NOT_EXIST and \
+               self.__protocol.tsih != 0:
+                # session is gone on target, a new one takes its place
+                self.logger.warn("session (%s) doesn't exist on target, it's reinstated" % self.__isid.raw_data)
+                self.__protocol.tsih = 0
+                r.delay = 0
+                r.attempt -= 1
+            self.__ReinstateFailed(r, e)
+        except OSError as e:
+            self.__ReinstateFailed(r, e)
             
-        if recv_pdu.MaxCmdSN >= recv_pdu.ExpCmdSN:
-            if recv_pdu.MaxCmdSN > self.__maxcmdsn:
-                self.__maxcmdsn = recv_pdu.MaxCmdSN
-            if recv_pdu.ExpCmdSN > self.__expcmdsn:
-                self.__expcmdsn = recv_pdu.ExpCmdSN
+    def __ReinstateFailed(self, r, exception):
+        self.logger.warn("reinstatement of connection (%d) failed, %s" % (r.lost.cid, exception))
+        r.exception = exception
+        if r.conn != None:
+            r.conn.Close()
+            r.conn = None
+        self.__NextReinstatement(r)
+        
+    def __Reinstated(self, r, reinstated):
+        # held commands are issued again on reinstated connection or fail
+        cid = r.lost.cid
+        del self.__reinstating[cid]
+        if reinstated:
+            self.logger.info("connection (%d) of session (%s) is reinstated" % (cid, self.__isid.raw_data))
+            for cmd in r.cmds:
+                # a response for the old tag can't reach it anymore
+                cmd.itt = self.__tasks.Retag(cmd.itt)
+                if cmd.itt == None:
+                    continue # failed meanwhile
+                if cmd.task != None:
+                    cmd.task.Reset()
+                cmd.cid = None
+                cmd.resp_pdu = None
+                self.__genq.put_nowait(self.Msg(cmd.msg_id, cmd))
         else:
-            self.logger.warn("expcmdsn and maxcmdsn values are ignored") 
-
+            self.__DropConnection(cid, r.exception) # held commands fail with it
+        # commands held while connection was reinstated
+        self.__genq.put_nowait(self.Msg(self.Msg.ID_WINDOW))
+        
+    # msgs issuing non-immediate commands, they consume CmdSN
+    __WINDOWED = (Msg.ID_SEND_TEXT, Msg.ID_LOGOUT, Msg.ID_SCSI_CMD, Msg.ID_TEXT_CONT)
+    
+    def __Usable(self):
+        # connections commands can be sent on
+        return [conn for conn in list(self.__connections.values())
+                if conn.state == conn.STATE_LOGGED_IN]
+    
+    def __Held(self):
+        # commands wait while all connections are being reinstated
+        return len(self.__reinstating) != 0 and len(self.__Usable()) == 0
+    
+    def __Issue(self, msg):
+        cmd = msg.data
+        if cmd.future.done():
+            # failed or cancelled while waiting for window, slot of a
+            # cancelled one is still taken
+            self.__tasks.Release(cmd.itt)
+            return
+        if msg.id == msg.ID_TEXT_CONT:
+            if cmd.task.ttt == 0xFFFFFFFF:
+                return # request is sent again since, response starts over
+            # rest of text response is asked on connection of request
+            conn = self.__connections.get(cmd.cid)
+            if conn == None:
+                self.__protocol.Fail(cmd, ConnectionError("connection (%d) is lost" % cmd.cid))
+            else:
+                self.__protocol.SendText(conn, cmd)
+            return
+        conns = self.__Usable()
+        if len(conns) == 0:
+            self.__protocol.Fail(cmd, ConnectionError("session (%s) has no logged in connection" % self.__isid.raw_data))
+            return
+        conn = self.__policy.Select(conns, cmd.task)
+        cmd.cid = conn.cid
+        cmd.nbytes = cmd.task.length if isinstance(cmd.task, ScsiTask) else 0
+        conn.Account(1, cmd.nbytes)
+        if msg.id == msg.ID_SEND_TEXT:
+            self.__protocol.SendText(conn, cmd)
+        elif msg.id == msg.ID_LOGOUT:
+            conn.ProcessEvent(conn.EVENT_REQ_LOUT) # T9
+            self.__protocol.SendLogout(conn, cmd)
+        elif msg.id == msg.ID_SCSI_CMD:
+            self.__protocol.SendScsiCmd(conn, cmd)
         
     def __PduGenThread(self):
         try:
@@ -252,13 +1018,40 @@ class InitSession(Session):
                 msg = self.__genq.get(True)
                 # process msg here
                 if msg.id == msg.ID_LOGIN:
-                    # use first connection
-                    # TODO: implement multi connection
-                    self.__SendLogin(self.__connections[1])
-                elif msg.id == msg.ID_SEND_TEXT:
-                    self.__SendText(self.__connections[1], msg.data)
-                elif msg.id == msg.ID_LOGOUT:
-                    self.__SendLogout(self.__connections[1])
+                    # login is sent on connection being logged in
+                    conn = self.__connections.get(msg.data.cid)
+                    if conn != None:
+                        self.__protocol.SendLogin(conn, msg.data)
+                elif msg.id in self.__WINDOWED:
+                    # commands are sent in order while CmdSN is in window
+                    if len(self.__pending) == 0 and self.__protocol.WindowOpen() and not self.__Held():
+                        self.__Issue(msg)
+                    else:
+                        self.__pending.append(msg)
+                elif msg.id == msg.ID_WINDOW:
+                    while len(self.__pending) != 0 and self.__protocol.WindowOpen() and not self.__Held():
+                        self.__Issue(self.__pending.popleft())
+                elif msg.id == msg.ID_NOP_OUT:
+                    # pings are immediate, window doesn't hold them
+                    cmd = msg.data
+                    if cmd.cid == None:
+                        conns = self.__Usable()
+                        conn = conns[0] if len(conns) != 0 else None
+                    else:
+                        conn = self.__connections.get(cmd.cid)
+                    if conn == None or conn.state != conn.STATE_LOGGED_IN:
+                        self.__protocol.Fail(cmd, ConnectionError("session (%s) has no connection to ping" % self.__isid.raw_data))
+                    else:
+                        self.__protocol.SendNopOut(conn, cmd)
+                elif msg.id == msg.ID_NOP_REPLY:
+                    conn, ttt = msg.data
+                    self.__protocol.SendNopOut(conn, None, ttt)
+                elif msg.id == msg.ID_R2T:
+                    cmd, itt, ttt, offset, length = msg.data
+                    conn = self.__connections.get(cmd.cid)
+                    # data goes on connection of command, unless it's issued again
+                    if conn != None and conn.state == conn.STATE_LOGGED_IN and cmd.itt == itt:
+                        self.__protocol.SendDataOut(conn, cmd, ttt, offset, length)
                 elif msg.id == msg.ID_EXIT:
                     break
         except:
@@ -271,10 +1064,27 @@ class InitSession(Session):
 #            rpdb2.settrace()
             while True:
                 event = self.__pdu_listener.Wait()
-                if isinstance(event, self.Msg) and event.id == self.Msg.ID_EXIT:
-                    break
+                if isinstance(event, self.Msg):
+                    if event.id == self.Msg.ID_EXIT:
+                        self.__Close()
+                        break
+                    if event.id == self.Msg.ID_REINSTATE:
+                        self.__Reinstate(*event.data)
+                    elif event.id == self.Msg.ID_REINSTATED:
+                        self.__LoginDone(*event.data)
+                    continue
+                if event.id == event.ID_CONN_LOST:
+                    self.__ConnectionLost(event.data)
+                    continue
+                if event.id == event.ID_PING:
+                    conn, nop_in = event.data
+                    self.__genq.put_nowait(self.Msg(self.Msg.ID_NOP_REPLY, (conn, nop_in.TargetTransferTag)))
+                    if self.__protocol.ProcessPDU(nop_in):
+                        self.__genq.put_nowait(self.Msg(self.Msg.ID_WINDOW))
+                    continue
                 # process msg here
-                self.__ProcessPDU(event.data)
+                if self.__protocol.ProcessPDU(event.data):
+                    self.__genq.put_nowait(self.Msg(self.Msg.ID_WINDOW))
                 
         except:
             traceback.print_exc()
@@ -282,47 +1092,193 @@ class InitSession(Session):
         
     @property
     def state(self):
-        return self.__state
+        return self.__protocol.state
     
+    @property
+    def isid(self):
+        return self.__isid
+    
+    def __Submit(self, msg_id, cmd, block = True):
+        # task tag is taken in caller's thread, so a full table holds back
+        # callers, not the pdu generator serving r2ts of outstanding tasks
+        if block:
+            cmd.itt = self.__tasks.Alloc(cmd)
+        else:
+            cmd.itt = self.__tasks.TryAlloc(cmd)
+        if cmd.itt == None:
+            return None
+        cmd.msg_id = msg_id
+        if self.__protocol.state == self.STATE_FAILED:
+            # connection is lost after caller checked state
+            self.__protocol.Fail(cmd, ConnectionError("session (%s) has failed" % self.__isid.raw_data))
+            return cmd.future
+        self.__genq.put_nowait(self.Msg(msg_id, cmd))
+        return cmd.future
+    
+    @property
+    def tasks(self):
+        return self.__tasks
+        
     def Login(self):
         '''
-        Perform login on given connection if not given then use first connection in session
-        @param conn: Login to be performed
+        Perform login on first connection of session. Returns future which
+        completes with True or fails with LoginError, None if session isn't
+        free to login.
         '''
-        if self.__state == self.STATE_FREE:
-            self.__genq.put_nowait(self.Msg(self.Msg.ID_LOGIN))
-        elif self.__state == self.STATE_LOGGED_IN:
+        if self.__protocol.state == self.STATE_FREE:
+            cmd = self.Cmd(self.__protocol.Negotiator(True))
+            cmd.cid = 1 # leading connection
+            return self.__Submit(self.Msg.ID_LOGIN, cmd)
+        elif self.__protocol.state == self.STATE_LOGGED_IN:
             self.logger.warn("Session (%s) has already logged in" % self.__isid.raw_data)
         else:
             self.logger.warn("Session (%s) failed" % self.__isid.raw_data)
+        return None
             
-    def SendText(self, text):
-        # check state whether it's been logged in
-        if self.__state == self.STATE_LOGGED_IN:
-            self.__genq.put_nowait(self.Msg(self.Msg.ID_SEND_TEXT, text))
-        else:
+    def AddConnection(self, portal, options = None):
+        '''
+        Open another connection of session to portal and log it in with ISID
+        and TSIH of session, commands are spread over logged in connections
+        by policy. Returns future which completes with True or fails with
+        LoginError, None if session isn't logged in.
+        @param portal: see InitConn
+        @param options: transport.TransportOptions of new connection
+        '''
+        if self.__protocol.state != self.STATE_LOGGED_IN:
             self.logger.error("Session (%s) hasn't logged in yet" % self.__isid.raw_data)
+            return None
+        if len(self.__connections) >= self.__params.max_connections:
+            self.logger.error("Session (%s) has MaxConnections(%d) connections" % (self.__isid.raw_data, self.__params.max_connections))
+            return None
+        cid = self.__cid
+        self.__cid += 1
+        self.__connections[cid] = InitConn(portal, self.__pdu_listener, self, cid, options)
+        cmd = self.Cmd(self.__protocol.Negotiator(False))
+        cmd.cid = cid
+        return self.__Submit(self.Msg.ID_LOGIN, cmd)
+    
+    @property
+    def connections(self):
+        '''
+        cid:InitConn of session
+        '''
+        return self.__connections
+    
+    @property
+    def policy(self):
+        return self.__policy
+    
+    @policy.setter
+    def policy(self, policy):
+        self.__policy = policy
             
+    def SendText(self, text, on_data = None):
+        '''
+        Send text request, returns future of text response payload or None
+        if session hasn't logged in. Response continued over several pdus is
+        requested and reassembled.
+        @param on_data: called with each piece of response as it arrives,
+        from pdu processor thread, future completes with response length then
+        '''
+        if self.__protocol.state == self.STATE_LOGGED_IN:
+            return self.__Submit(self.Msg.ID_SEND_TEXT, self.Cmd(TextTask(text, on_data)))
+        self.logger.error("Session (%s) hasn't logged in yet" % self.__isid.raw_data)
+        return None
             
-    def Logout(self):
-        if self.__state == self.STATE_LOGGED_IN:
-            self.__genq.put_nowait(self.Msg(self.Msg.ID_LOGOUT))
+            
+    def Ping(self, cid = None):
+        '''
+        Send a NOP-Out, returns future which is done when target answers it,
+        None if session isn't logged in
+        @param cid: connection pinged, first logged in one if None
+        '''
+        if self.__protocol.state == self.STATE_LOGGED_IN:
+            cmd = self.Cmd()
+            cmd.cid = cid
+            return self.__Submit(self.Msg.ID_NOP_OUT, cmd)
+        self.logger.error("Session (%s) hasn't logged in yet" % self.__isid.raw_data)
+        return None
+    
+    def Read(self, lba, blocks, buf, lun = 0, read16 = False, block = True):
+        '''
+        Issue READ(10), or READ(16) when asked or when lba or blocks don't fit
+        READ(10). Data-In is placed directly into buf. Returns future of the
+        ScsiTask, None if session isn't logged in. Many commands can be
+        submitted, they are sent as CmdSN window allows. When max_tasks
+        commands are outstanding it waits for one to complete, or returns
+        None right away if block is False.
+        @param buf: writable buffer of blocks * block length bytes
+        '''
+        if read16 or lba > 0xFFFFFFFF or blocks > 0xFFFF:
+            cdb = pdu.Read16Cdb(lba, blocks)
+        else:
+            cdb = pdu.Read10Cdb(lba, blocks)
+        if self.__protocol.state != self.STATE_LOGGED_IN:
+            self.logger.error("Session (%s) hasn't logged in yet" % self.__isid.raw_data)
+            return None
+        return self.__Submit(self.Msg.ID_SCSI_CMD, self.Cmd(ScsiTask(lun, cdb, buf)), block)
+    
+    def Write(self, lba, blocks, buf, lun = 0, write16 = False, block = True):
+        '''
+        Issue WRITE(10), or WRITE(16) when asked or when lba or blocks don't
+        fit WRITE(10). Data is sent from buf without copying as immediate,
+        unsolicited and solicited data, buf mustn't be modified until
+        returned future completes. Waits for a task slot like Read.
+        @param buf: buffer of blocks * block length bytes
+        '''
+        if write16 or lba > 0xFFFFFFFF or blocks > 0xFFFF:
+            cdb = pdu.Write16Cdb(lba, blocks)
         else:
+            cdb = pdu.Write10Cdb(lba, blocks)
+        if self.__protocol.state != self.STATE_LOGGED_IN:
             self.logger.error("Session (%s) hasn't logged in yet" % self.__isid.raw_data)
+            return None
+        return self.__Submit(self.Msg.ID_SCSI_CMD, self.Cmd(ScsiTask(lun, cdb, buf, True)), block)
+        
+    @property
+    def params(self):
+        '''
+        keys.SessionParams negotiated in login
+        '''
+        return self.__params
+    
+    @property
+    def proposal(self):
+        return self.__protocol.proposal
+    
+    @property
+    def reinstate_attempts(self):
+        '''
+        Logins tried to reinstate a lost connection with its commands, 0
+        fails them with connection instead
+        '''
+        return self.__reinstate_attempts
+    
+    @reinstate_attempts.setter
+    def reinstate_attempts(self, attempts):
+        self.__reinstate_attempts = attempts
+    
+    def Logout(self):
+        '''
+        Close session, returns future of logout response code or None if
+        session hasn't logged in
+        '''
+        if self.__protocol.state == self.STATE_LOGGED_IN:
+            return self.__Submit(self.Msg.ID_LOGOUT, self.Cmd())
+        self.logger.error("Session (%s) hasn't logged in yet" % self.__isid.raw_data)
+        return None
+        
+    def Close(self):
+        '''
+        Stop threads of session and close its connections, commands not
+        completed yet fail with ConnectionError. Logout first to end session
+        on target gracefully. It can be called more than once.
+        '''
+        self.__genq.put_nowait(self.Msg(self.Msg.ID_EXIT))
+        self.__pdu_listener.Signal(self.Msg(self.Msg.ID_EXIT))
         
     def ProcessEvent(self, event):
-        if not isinstance(event, int):
-            raise TypeError
-        if self.__state == self.STATE_FREE:
-            if event == self.EVENT_SUCC_LOGIN:
-                self.__state = self.STATE_LOGGED_IN
-        elif self.__state == self.STATE_LOGGED_IN:
-            if event == self.EVENT_SUCC_LOGOUT:
-                self.__state = self.STATE_FREE
-        elif self.__state == self.STATE_FAILED:
-            pass
-        else:
-            pass
+        self.__protocol.ProcessEvent(event)
 
 class TgtSession(Session):
     STATE_FREE = 0
@@ -333,3 +1289,479 @@ class TgtSession(Session):
 
 #cyclic import from connection to session again    
 from connection import InitConn, Conn
+
+
+class ScriptedTarget():
+    '''
+    Target end of "pair:" and "pipe:" portals for tests of initiator
+    modules. It answers login, text, nop-out and logout, serves reads with
+    a pattern of their lba and takes writes with immediate, unsolicited
+    and solicited data. Pdus received are kept with index of their
+    connection in conns.
+    @param name: name it is bound to, portal is "pair:" or "pipe:" with it
+    @param window: commands accepted past ExpCmdSN
+    '''
+    SEGMENT = 8192 # MaxRecvDataSegmentLength of target, Data-In size
+    
+    def __init__(self, name, window = 32):
+        self.name = name
+        self.window = window
+        self.conns = []
+        self.received = [] # (connection index, header record, data)
+        self.written = {} # lba:data
+        self.held = None # responses kept back while it's a list
+        self.closed = 0 # connections closed by initiator
+        self.silent = False # pdus are taken but not answered while it's set
+        self.text = b"TargetName=iqn.2020-01.t:1\x00TargetAddress=127.0.0.1:3260,1\x00"
+        self.text_chunk = None # text response is sent in parts of it when set
+        self.__lock = threading.RLock()
+        self.__statsn = 0
+        self.__expcmdsn = 0
+        self.__params = {} # keys offered by initiator
+        self.__writes = {} # itt:[lba, buf, bytes received]
+        self.__ttt = 0
+        self.__texts = {} # ttt:offset of text response continued
+        self.__handlers = {pdu.BHS.OPCODE_LOGIN_REQ:self.__Login, pdu.BHS.OPCODE_TEXT_REQ:self.__Text,
+                           pdu.BHS.OPCODE_LOGOUT_REQ:self.__Logout, pdu.BHS.OPCODE_NOP_OUT:self.__Nop,
+                           pdu.BHS.OPCODE_SCSI_CMD_REQ:self.__ScsiCmd, pdu.BHS.OPCODE_DATA_OUT:self.__DataOut}
+        transport.Bind(name, self.__Accept)
+        
+    @staticmethod
+    def Pattern(lba, length):
+        return bytes((lba + i) & 0xFF for i in range(length))
+    
+    def Close(self):
+        transport.Unbind(self.name)
+        for soc in self.conns:
+            soc.close()
+    
+    def Kill(self, index):
+        '''
+        Break connection of index, responses held are lost with it
+        '''
+        with self.__lock:
+            self.held = None
+            self.conns[index].shutdown(socket.SHUT_RDWR)
+    
+    def Hold(self):
+        '''
+        Keep back responses of commands until Release
+        '''
+        self.held = []
+    
+    def Release(self):
+        with self.__lock:
+            held, self.held = self.held, None
+            for respond in held or []:
+                respond()
+    
+    def Announce(self, window):
+        '''
+        Change window and tell it with a nop-in nothing answers
+        '''
+        self.window = window
+        self.Send(self.conns[-1], pdu.NopInPDU.CODEC, status = False, Opcode = pdu.BHS.OPCODE_NOP_IN,
+                  Final = True, InitiatorTaskTag = 0xFFFFFFFF, TargetTransferTag = 0xFFFFFFFF)
+    
+    def Commands(self, opcode = pdu.BHS.OPCODE_SCSI_CMD_REQ):
+        '''
+        Returns (connection index, header record, data) of pdus with opcode
+        '''
+        with self.__lock:
+            return [r for r in self.received if r[1].Opcode == opcode]
+    
+    def Send(self, soc, codec, data = b"", status = True, **fields):
+        with self.__lock:
+            if status:
+                fields["StatSN"] = self.__statsn
+                self.__statsn += 1
+            elif "StatSN" in codec.fields:
+                fields["StatSN"] = self.__statsn
+            fields["ExpCmdSN"] = self.__expcmdsn
+            fields["MaxCmdSN"] = (self.__expcmdsn + self.window - 1) & 0xFFFFFFFF
+            fields["DataSegmentLength"] = len(data)
+            soc.sendall(bytes(codec.Pack(**fields)) + data + bytes(-len(data) % 4))
+    
+    def __Respond(self, respond):
+        with self.__lock:
+            if self.held != None:
+                self.held.append(respond)
+                return
+        respond()
+    
+    def __Accept(self, soc):
+        self.conns.append(soc)
+        threading.Thread(target = self.__Serve, args = (soc,), daemon = True).start()
+    
+    def __Recv(self, soc, n):
+        data = b""
+        while len(data) < n:
+            chunk = soc.recv(n - len(data))
+            if len(chunk) == 0:
+                raise EOFError
+            data += chunk
+        return data
+    
+    def __Serve(self, soc):
+        try:
+            while True:
+                hdr = self.__Recv(soc, pdu.BHS.LENGTH)
+                w = pdu.U32.unpack_from(hdr, 4)[0]
+                dsl = w & 0xFFFFFF
+                data = self.__Recv(soc, (w >> 24) * 4 + ((dsl + 3) & ~3))[:dsl]
+                record = pdu.HeaderCodec.ForOpcode(hdr[0] & 0x3F).Unpack(hdr)
+                with self.__lock:
+                    self.received.append((self.conns.index(soc), record, data))
+                    if not record.Immediate and "CmdSN" in record._fields:
+                        self.__expcmdsn = (record.CmdSN + 1) & 0xFFFFFFFF
+                    elif record.Opcode == pdu.BHS.OPCODE_LOGIN_REQ:
+                        self.__expcmdsn = record.CmdSN
+                if not self.silent:
+                    self.__handlers[record.Opcode](soc, record, data)
+        except (EOFError, OSError):
+            pass
+        self.closed += 1
+    
+    def __Login(self, soc, r, data):
+        answers = b""
+        for kv in bytes(data).split(b"\x00"):
+            k, sep, v = kv.decode().partition("=")
+            if sep == "" or k in ("InitiatorName", "SessionType", "TargetName"):
+                continue
+            self.__params[k] = v.split(",")[0]
+            if k == "MaxRecvDataSegmentLength":
+                v = str(self.SEGMENT)
+            answers += ("%s=%s\x00" % (k, v.split(",")[0])).encode()
+        self.Send(soc, pdu.LoginRespPDU.CODEC, answers, Opcode = pdu.BHS.OPCODE_LOGIN_RES,
+                  Transit = r.Transit, CurrentStage = r.CurrentStage, NextStage = r.NextStage,
+                  ISID = r.ISID, TSIH = r.TSIH or 1, InitiatorTaskTag = r.InitiatorTaskTag)
+    
+    def __Text(self, soc, r, data):
+        offset = self.__texts.pop(r.TargetTransferTag, 0)
+        chunk = self.text_chunk or len(self.text)
+        end = offset + chunk
+        ttt = 0xFFFFFFFF
+        if end < len(self.text):
+            # rest is sent for a request with ttt
+            self.__ttt += 1
+            ttt = self.__ttt
+            self.__texts[ttt] = end
+        self.Send(soc, pdu.TextRespPDU.CODEC, self.text[offset:end], Opcode = pdu.BHS.OPCODE_TEXT_RES,
+                  Final = ttt == 0xFFFFFFFF, Continue = ttt != 0xFFFFFFFF,
+                  InitiatorTaskTag = r.InitiatorTaskTag, TargetTransferTag = ttt)
+    
+    def __Logout(self, soc, r, data):
+        self.Send(soc, pdu.LogoutRespPDU.CODEC, Opcode = pdu.BHS.OPCODE_LOGOUT_RES, Final = True,
+                  InitiatorTaskTag = r.InitiatorTaskTag)
+    
+    def __Nop(self, soc, r, data):
+        if r.InitiatorTaskTag != 0xFFFFFFFF:
+            self.Send(soc, pdu.NopInPDU.CODEC, data, Opcode = pdu.BHS.OPCODE_NOP_IN, Final = True,
+                      InitiatorTaskTag = r.InitiatorTaskTag, TargetTransferTag = 0xFFFFFFFF)
+    
+    def __Status(self, soc, itt):
+        self.Send(soc, pdu.ScsiRespPDU.CODEC, Opcode = pdu.BHS.OPCODE_SCSI_CMD_RES, Final = True,
+                  InitiatorTaskTag = itt)
+    
+    def __ScsiCmd(self, soc, r, data):
+        cdb = r.CDB
+        lba = pdu.U32.unpack_from(cdb, 2)[0] if cdb[0] < 0x80 else pdu.U64.unpack_from(cdb, 2)[0]
+        itt = r.InitiatorTaskTag
+        total = r.ExpectedDataTransferLength
+        if r.Read:
+            def respond(soc = soc):
+                payload = self.Pattern(lba, total)
+                for offset in range(0, total, self.SEGMENT):
+                    last = offset + self.SEGMENT >= total
+                    self.Send(soc, pdu.DataInPDU.CODEC, payload[offset:offset + self.SEGMENT], last,
+                              Opcode = pdu.BHS.OPCODE_DATA_IN, Final = last, StatusPresent = last,
+                              InitiatorTaskTag = itt, TargetTransferTag = 0xFFFFFFFF,
+                              DataSN = offset // self.SEGMENT, BufferOffset = offset)
+            self.__Respond(respond)
+            return
+        if not r.Write:
+            self.__Respond(lambda: self.__Status(soc, itt))
+            return
+        buf = bytearray(total)
+        buf[:len(data)] = data
+        self.__writes[itt] = [lba, buf, len(data)]
+        end = len(data)
+        if self.__params.get("InitialR2T") == "No":
+            end = min(total, int(self.__params.get("FirstBurstLength", 65536)))
+        burst = int(self.__params.get("MaxBurstLength", 262144))
+        for r2tsn, offset in enumerate(range(end, total, burst)):
+            self.__ttt += 1
+            self.Send(soc, pdu.R2TPDU.CODEC, status = False, Opcode = pdu.BHS.OPCODE_R2T, Final = True,
+                      InitiatorTaskTag = itt, TargetTransferTag = self.__ttt, R2TSN = r2tsn,
+                      BufferOffset = offset, DesiredDataTransferLength = min(burst, total - offset))
+        self.__Written(soc, itt)
+    
+    def __DataOut(self, soc, r, data):
+        w = self.__writes[r.InitiatorTaskTag]
+        w[1][r.BufferOffset:r.BufferOffset + len(data)] = data
+        w[2] += len(data)
+        self.__Written(soc, r.InitiatorTaskTag)
+    
+    def __Written(self, soc, itt):
+        lba, buf, received = self.__writes[itt]
+        if received == len(buf):
+            del self.__writes[itt]
+            self.written[lba] = bytes(buf)
+            self.__Respond(lambda: self.__Status(soc, itt))
+
+
+if __name__ == "__main__":
+    import unittest
+    import policy
+    
+    class Init():
+        name = "iqn.2006-11.1"
+    
+    TARGET = "iqn.2020-01.t:1"
+    
+    def Wait(condition, timeout = 5):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                raise TimeoutError
+            time.sleep(0.005)
+    
+    class SessionTest(unittest.TestCase):
+        PORTAL = "pair:session"
+        
+        def setUp(self):
+            self.target = ScriptedTarget(self.PORTAL.partition(":")[2])
+            self.sessions = []
+            
+        def tearDown(self):
+            for session in self.sessions:
+                if session.state == session.STATE_LOGGED_IN:
+                    session.Logout().result(5)
+            self.target.Close()
+            
+        def Login(self, proposal = None, **kwargs):
+            session = InitSession(Init(), self.PORTAL, TARGET, proposal = proposal, **kwargs)
+            self.sessions += [session]
+            self.assertEqual(session.Login().result(5), True)
+            return session
+    
+    class TestScsiCmd(SessionTest):
+        def testFinal(self):
+            # F is clear only when unsolicited Data-Out follows the command
+            session = self.Login() # InitialR2T=No, ImmediateData=Yes
+            buf = bytes(range(256)) * 128
+            self.assertTrue(session.Write(0, 64, buf).result(5).good)
+            self.assertTrue(session.Write(100, 8, buf[:4096]).result(5).good)
+            self.assertTrue(session.Read(200, 8, bytearray(4096)).result(5).good)
+            cmds = self.target.Commands()
+            self.assertEqual([r.Final for c, r, data in cmds], [0, 1, 1])
+            self.assertEqual(len(cmds[0][2]), ScriptedTarget.SEGMENT) # immediate data
+            outs = self.target.Commands(pdu.BHS.OPCODE_DATA_OUT)
+            self.assertEqual([(r.TargetTransferTag, r.BufferOffset, r.Final) for c, r, data in outs],
+                             [(0xFFFFFFFF, 8192, 0), (0xFFFFFFFF, 16384, 0), (0xFFFFFFFF, 24576, 1)])
+            self.assertEqual(self.target.written[0], buf)
+            
+        def testFinalSolicited(self):
+            proposal = keys.Proposal()
+            proposal.initial_r2t = True
+            session = self.Login(proposal)
+            buf = bytes(range(256)) * 128
+            self.assertTrue(session.Write(0, 64, buf).result(5).good)
+            cmds = self.target.Commands()
+            self.assertEqual(cmds[0][1].Final, 1)
+            outs = self.target.Commands(pdu.BHS.OPCODE_DATA_OUT)
+            self.assertEqual(outs[0][1].TargetTransferTag, 1) # solicited by R2T
+            self.assertEqual(self.target.written[0], buf)
+    
+    class TestWindow(SessionTest):
+        def Pipeline(self, cmdsn):
+            # window of 2 stalls 6 reads, announcing a window of 6 sends the rest
+            self.target.window = 2
+            session = InitSession(Init(), self.PORTAL, TARGET)
+            self.sessions += [session]
+            protocol = session._InitSession__protocol
+            protocol._SessionProtocol__cmdsn = protocol._SessionProtocol__maxcmdsn = cmdsn
+            protocol._SessionProtocol__expcmdsn = cmdsn
+            self.assertEqual(session.Login().result(5), True)
+            self.target.Hold()
+            futures = [session.Read(lba, 1, bytearray(512)) for lba in range(6)]
+            Wait(lambda: len(self.target.Commands()) == 2)
+            time.sleep(0.05)
+            self.assertEqual(len(self.target.Commands()), 2)
+            self.target.Announce(6)
+            Wait(lambda: len(self.target.Commands()) == 6)
+            self.target.Release()
+            for future in futures:
+                self.assertTrue(future.result(5).good)
+            return [r.CmdSN for c, r, data in self.target.Commands()]
+        
+        def testStall(self):
+            self.assertEqual(self.Pipeline(1), [1, 2, 3, 4, 5, 6])
+            
+        def testWraparound(self):
+            self.assertEqual(self.Pipeline(0xFFFFFFFE), [0xFFFFFFFE, 0xFFFFFFFF, 0, 1, 2, 3])
+            self.assertEqual(self.sessions[0]._InitSession__protocol._SessionProtocol__cmdsn, 4)
+    
+    class TestPipeline(SessionTest):
+        def testReads(self):
+            # more reads than task slots, tags are reused as reads complete
+            session = self.Login(max_tasks = 8)
+            bufs = [bytearray(4096) for i in range(100)]
+            futures = [session.Read(lba * 8, 8, bufs[lba]) for lba in range(100)]
+            for future in futures:
+                self.assertTrue(future.result(5).good)
+            for lba, buf in enumerate(bufs):
+                self.assertEqual(buf, ScriptedTarget.Pattern(lba * 8, 4096))
+            itts = set(r.InitiatorTaskTag for c, r, data in self.target.Commands())
+            self.assertEqual(len(itts), 100)
+            self.assertEqual(set(itt & TaskTable.INDEX_MASK for itt in itts), set(range(8)))
+            self.assertEqual(len(session.tasks), 0)
+            
+        def testFull(self):
+            session = self.Login(max_tasks = 4)
+            self.target.Hold()
+            futures = [session.Read(lba, 1, bytearray(512)) for lba in range(4)]
+            self.assertEqual(session.Read(4, 1, bytearray(512), block = False), None)
+            Wait(lambda: len(self.target.Commands()) == 4)
+            self.target.Release()
+            events.WaitAll(futures, 5)
+            self.assertNotEqual(session.Read(4, 1, bytearray(512), block = False), None)
+    
+    class TestFuture(SessionTest):
+        def testComplete(self):
+            session = self.Login()
+            self.assertEqual(session.Login(), None) # logged in already
+            done = []
+            future = session.Read(0, 1, bytearray(512))
+            future.add_done_callback(done.append)
+            futures = [future] + [session.Read(lba, 1, bytearray(512)) for lba in range(1, 8)]
+            self.assertEqual(set(events.AsCompleted(futures, 5)), set(futures))
+            self.assertEqual(done, [future])
+            self.assertEqual(session.SendText(b"SendTargets=All\x00").result(5), self.target.text)
+            self.assertTrue(session.Ping().result(5))
+            self.assertEqual(session.Logout().result(5), 0)
+            self.assertEqual(session.state, session.STATE_FREE)
+            
+        def testCancel(self):
+            # cancelled command waiting for window isn't sent, its slot is freed
+            self.target.window = 1
+            session = self.Login()
+            self.target.Hold()
+            first = session.Read(0, 1, bytearray(512))
+            second = session.Read(1, 1, bytearray(512))
+            Wait(lambda: len(self.target.Commands()) == 1)
+            self.assertTrue(second.cancel())
+            self.target.Release()
+            self.assertTrue(first.result(5).good)
+            self.assertTrue(session.Read(2, 1, bytearray(512)).result(5).good)
+            self.assertEqual([r.CmdSN for c, r, data in self.target.Commands()], [1, 2])
+            self.assertEqual(len(session.tasks), 0)
+    
+    class TestConnections(SessionTest):
+        def Connect(self, policy = None):
+            session = self.Login(policy = policy)
+            for cid in (2, 3):
+                self.assertEqual(session.AddConnection(self.PORTAL).result(5), True)
+            logins = [r for c, r, data in self.target.Commands(pdu.BHS.OPCODE_LOGIN_REQ)]
+            self.assertEqual(sorted(set((r.CID, r.TSIH) for r in logins)), [(1, 0), (2, 1), (3, 1)])
+            self.assertEqual(len(set(bytes(r.ISID) for r in logins)), 1)
+            return session
+        
+        def testRoundRobin(self):
+            session = self.Connect()
+            bufs = [bytearray(512) for i in range(30)]
+            futures = [session.Read(lba, 1, bufs[lba]) for lba in range(30)]
+            events.WaitAll(futures, 5)
+            for lba, buf in enumerate(bufs):
+                self.assertEqual(buf, ScriptedTarget.Pattern(lba, 512))
+            spread = collections.Counter(c for c, r, data in self.target.Commands())
+            self.assertEqual(spread, {0:10, 1:10, 2:10})
+            
+        def testBytesInFlight(self):
+            session = self.Connect(policy.BytesInFlight())
+            self.target.Hold()
+            futures = [session.Read(0, 128, bytearray(65536))]
+            futures += [session.Read(lba, 1, bytearray(512)) for lba in range(3)]
+            Wait(lambda: len(self.target.Commands()) == 4)
+            cmds = sorted(self.target.Commands(), key = lambda cmd: cmd[1].CmdSN)
+            self.assertEqual([c for c, r, data in cmds], [0, 1, 2, 1])
+            self.target.Release()
+            events.WaitAll(futures, 5)
+            self.assertEqual(futures[0].result().buf, ScriptedTarget.Pattern(0, 65536))
+    
+    class TestPipeConnections(TestConnections):
+        PORTAL = "pipe:session"
+    
+    class TestClose(SessionTest):
+        def testClose(self):
+            session = self.Login()
+            self.target.Hold()
+            future = session.Read(0, 1, bytearray(512))
+            Wait(lambda: len(self.target.Commands()) == 1)
+            session.Close()
+            self.assertRaises(ConnectionError, future.result, 5)
+            self.assertEqual(session.state, session.STATE_FAILED)
+            Wait(lambda: self.target.closed == 1)
+            
+        def testLoginAll(self):
+            # refused and unanswered logins leave no session behind
+            import initiator
+            mute = []
+            transport.Bind("mute", mute.append)
+            init = initiator.Initiator(Init.name)
+            results = init.LoginAll([self.PORTAL, "pair:nowhere", "pair:mute"], TARGET, timeout = 0.5)
+            transport.Unbind("mute")
+            self.sessions += [results[0].session]
+            self.assertEqual(results[0].error, None)
+            self.assertIsInstance(results[1].error, ConnectionRefusedError)
+            self.assertIsInstance(results[2].error, TimeoutError)
+            self.assertEqual([r.session for r in results[1:]], [None, None])
+            mute[0].settimeout(5)
+            while len(mute[0].recv(4096)) != 0:
+                pass # login request, then end of stream once session is closed
+            mute[0].close()
+    
+    class TestReinstate(SessionTest):
+        def Kill(self, session):
+            # connection breaks with four reads in flight
+            self.target.Hold()
+            bufs = [bytearray(512) for i in range(4)]
+            futures = [session.Read(lba, 1, bufs[lba]) for lba in range(4)]
+            Wait(lambda: len(self.target.Commands()) == 4)
+            lost = session.connections[1]
+            self.target.Kill(0)
+            return lost, bufs, futures
+        
+        def testReissue(self):
+            proposal = keys.Proposal()
+            proposal.default_time2wait = 0
+            session = self.Login(proposal)
+            lost, bufs, futures = self.Kill(session)
+            for lba, future in enumerate(futures):
+                self.assertTrue(future.result(5).good)
+                self.assertEqual(bufs[lba], ScriptedTarget.Pattern(lba, 512))
+            logins = [r for c, r, data in self.target.Commands(pdu.BHS.OPCODE_LOGIN_REQ) if c == 1]
+            self.assertEqual([(r.CID, r.TSIH) for r in logins], [(1, 1)])
+            cmds = self.target.Commands()
+            self.assertEqual([c for c, r, data in cmds], [0, 0, 0, 0, 1, 1, 1, 1])
+            self.assertTrue(set(r.InitiatorTaskTag for c, r, data in cmds[:4]).isdisjoint(
+                            r.InitiatorTaskTag for c, r, data in cmds[4:])) # tagged again
+            self.assertIsNot(session.connections[1], lost)
+            self.assertEqual(lost._InitConn__soc.fileno(), -1) # lost one is closed
+            self.assertEqual(len(session.tasks), 0)
+            
+        def testRefused(self):
+            proposal = keys.Proposal()
+            proposal.default_time2wait = 0
+            session = self.Login(proposal)
+            session.reinstate_attempts = 1
+            transport.Unbind(self.target.name)
+            lost, bufs, futures = self.Kill(session)
+            for future in futures:
+                self.assertRaises(ConnectionRefusedError, future.result, 5)
+            self.assertEqual(session.state, session.STATE_FAILED)
+            self.assertEqual(session.connections, {})
+            self.assertEqual(lost._InitConn__soc.fileno(), -1)
+            self.assertEqual(len(session.tasks), 0)
+    
+    unittest.main()
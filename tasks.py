@@ -0,0 +1,161 @@
+#!/usr/bin/python3
+# Copyright (c) 2015. Harun Emektar
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import threading
+
+class TaskTable():
+    '''
+    Outstanding commands indexed by Initiator Task Tag. A tag is the slot
+    index in its lower bits and the generation of the slot in upper bits,
+    generation is bumped when a slot is released so a late response for a
+    reused slot is caught as stale. 0xFFFFFFFF is never handed out.
+    @param size: max outstanding commands, Alloc blocks while all are in use
+    '''
+    INDEX_BITS = 16
+    INDEX_MASK = (1 << INDEX_BITS) - 1
+    GEN_MASK = 0xFFFFFFFF >> INDEX_BITS
+    
+    def __init__(self, size = 1024):
+        if size < 1 or size > 1 << self.INDEX_BITS:
+            raise ValueError("task table size(%d) is out of range" % size)
+        self.__cmds = [None] * size
+        self.__gens = [0] * size
+        self.__free = list(range(size - 1, -1, -1)) # lowest index is popped first
+        self.__cond = threading.Condition()
+        
+    def __len__(self):
+        return len(self.__cmds) - len(self.__free)
+    
+    @property
+    def size(self):
+        return len(self.__cmds)
+        
+    def __Tag(self, index):
+        itt = (self.__gens[index] << self.INDEX_BITS) | index
+        if itt == 0xFFFFFFFF: # reserved tag
+            self.__gens[index] = 0
+            itt = index
+        return itt
+    
+    def __Take(self, cmd):
+        index = self.__free.pop()
+        self.__cmds[index] = cmd
+        return self.__Tag(index)
+    
+    def Alloc(self, cmd, timeout = None):
+        '''
+        Returns tag for cmd, waits for a free slot, None on timeout
+        '''
+        with self.__cond:
+            if not self.__cond.wait_for(lambda: len(self.__free) != 0, timeout):
+                return None
+            return self.__Take(cmd)
+        
+    def TryAlloc(self, cmd):
+        '''
+        Returns tag for cmd or None if all slots are in use
+        '''
+        with self.__cond:
+            if len(self.__free) == 0:
+                return None
+            return self.__Take(cmd)
+        
+    def Get(self, itt):
+        '''
+        Returns cmd of tag, None for unknown or stale tags
+        '''
+        index = itt & self.INDEX_MASK
+        if index >= len(self.__cmds) or self.__gens[index] != itt >> self.INDEX_BITS:
+            return None
+        return self.__cmds[index]
+    
+    def Release(self, itt):
+        with self.__cond:
+            index = itt & self.INDEX_MASK
+            if index >= len(self.__cmds) or self.__gens[index] != itt >> self.INDEX_BITS:
+                return
+            self.__cmds[index] = None
+            self.__gens[index] = (self.__gens[index] + 1) & self.GEN_MASK
+            self.__free.append(index)
+            self.__cond.notify()
+            
+    def Retag(self, itt):
+        '''
+        Returns a new tag for cmd of itt, it keeps its slot while responses
+        carrying the old tag aren't matched anymore. None for unknown or
+        stale tags.
+        '''
+        with self.__cond:
+            if self.Get(itt) == None:
+                return None
+            index = itt & self.INDEX_MASK
+            self.__gens[index] = (self.__gens[index] + 1) & self.GEN_MASK
+            return self.__Tag(index)
+            
+    def Commands(self):
+        '''
+        Returns list of outstanding commands
+        '''
+        return [cmd for cmd in self.__cmds if cmd != None]
+
+if __name__ == "__main__":
+    import unittest
+    class TestTaskTable(unittest.TestCase):
+        def testAllocRelease(self):
+            table = TaskTable(4)
+            itts = [table.Alloc(i) for i in range(4)]
+            self.assertEqual(itts, [0, 1, 2, 3])
+            self.assertEqual(len(table), 4)
+            self.assertEqual(table.TryAlloc("x"), None)
+            self.assertEqual(table.Alloc("x", 0.01), None)
+            self.assertEqual(table.Get(2), 2)
+            table.Release(2)
+            self.assertEqual(table.Get(2), None)
+            itt = table.Alloc("y")
+            self.assertEqual(itt, (1 << TaskTable.INDEX_BITS) | 2)
+            self.assertEqual(table.Get(itt), "y")
+            self.assertEqual(table.Get(2), None) # stale tag of previous generation
+            table.Release(2) # stale release is ignored
+            self.assertEqual(table.Get(itt), "y")
+            self.assertEqual(sorted(table.Commands(), key = str), [0, 1, 3, "y"])
+            
+        def testReservedTag(self):
+            table = TaskTable(1 << TaskTable.INDEX_BITS)
+            for i in range(table.size - 1):
+                table.TryAlloc(i)
+            table._TaskTable__gens[table.size - 1] = TaskTable.GEN_MASK
+            itt = table.TryAlloc("last")
+            self.assertNotEqual(itt, 0xFFFFFFFF)
+            self.assertEqual(table.Get(itt), "last")
+            
+        def testRetag(self):
+            table = TaskTable(2)
+            itt = table.Alloc("a")
+            new = table.Retag(itt)
+            self.assertEqual(new, (1 << TaskTable.INDEX_BITS) | itt)
+            self.assertEqual(table.Get(itt), None)
+            self.assertEqual(table.Get(new), "a")
+            self.assertEqual(table.Retag(itt), None)
+            self.assertEqual(len(table), 1)
+            table.Release(new)
+            self.assertEqual(len(table), 0)
+            
+        def testBackpressure(self):
+            table = TaskTable(1)
+            itt = table.Alloc("a")
+            threading.Timer(0.01, table.Release, (itt,)).start()
+            self.assertNotEqual(table.Alloc("b", 5), None)
+            
+    unittest.main()
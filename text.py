@@ -34,7 +34,11 @@ class StandardLabel(Format):
             raise TypeError
 
 class KeyName(StandardLabel):
-    pass
+    def __init__(self, ustr):
+        # iSCSIProtocolLevel of RFC 7144 is the one key not starting with
+        # a capital letter
+        if ustr != "iSCSIProtocolLevel":
+            super().__init__(ustr)
 
 class TextValue(Format):
     def __init__(self, ustr):
@@ -242,6 +246,15 @@ if __name__ == "__main__":
         def testValidParam(self):
             self.assertTrue(isinstance(StandardLabel("Abctüâüşöğç.-+@_"), StandardLabel))
 
+    class TestKeyName(unittest.TestCase):
+        def testInvalidParam(self):
+            self.assertRaises(TypeError, KeyName, "iSCSIFoo")
+            self.assertRaises(TypeError, KeyName, 4)
+
+        def testValidParam(self):
+            self.assertTrue(isinstance(KeyName("iSCSIProtocolLevel"), KeyName))
+            self.assertTrue(isinstance(KeyName("TaskReporting"), KeyName))
+
     class TestTextValue(unittest.TestCase):
         def testInvalidParam(self):
             self.assertRaises(TypeError, TextValue, "~/>?abcd")
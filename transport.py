@@ -0,0 +1,413 @@
+#!/usr/bin/python3
+# Copyright (c) 2015. Harun Emektar
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import socket
+import _thread
+import queue
+import time
+import threading
+import collections
+
+class TransportOptions():
+    '''
+    Socket options and connect behaviour of an iscsi connection
+    @param nodelay: disable Nagle, small pdus are sent without delay
+    @param sndbuf: SO_SNDBUF in bytes, None keeps system default
+    @param rcvbuf: SO_RCVBUF in bytes, None keeps system default
+    @param keepalive: enable TCP keepalive
+    @param keepidle: seconds of idle before keepalive probes
+    @param keepintvl: seconds between keepalive probes
+    @param keepcnt: unanswered probes before connection is dropped
+    @param quickack: TCP_QUICKACK, re-armed after every receive (linux)
+    @param connect_timeout: seconds for connection establishment, None waits forever
+    @param attempt_delay: seconds before next resolved address is tried in parallel
+    '''
+    def __init__(self, nodelay = True, sndbuf = None, rcvbuf = None,
+                 keepalive = False, keepidle = None, keepintvl = None, keepcnt = None,
+                 quickack = False, connect_timeout = None, attempt_delay = 0.25):
+        self.nodelay = nodelay
+        self.sndbuf = sndbuf
+        self.rcvbuf = rcvbuf
+        self.keepalive = keepalive
+        self.keepidle = keepidle
+        self.keepintvl = keepintvl
+        self.keepcnt = keepcnt
+        self.quickack = quickack
+        self.connect_timeout = connect_timeout
+        self.attempt_delay = attempt_delay
+
+    def ApplyPreConnect(self, soc):
+        '''
+        Set options which must be set before connect, buffer sizes
+        decide the window scale offered in SYN
+        '''
+        if self.sndbuf != None:
+            soc.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf)
+        if self.rcvbuf != None:
+            soc.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+
+    def Apply(self, soc):
+        '''
+        Set options of a connected socket
+        '''
+        if self.nodelay:
+            soc.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.keepalive:
+            soc.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            # option names differ between platforms, missing ones are skipped
+            for name, value in (("TCP_KEEPIDLE", self.keepidle), ("TCP_KEEPINTVL", self.keepintvl),
+                                ("TCP_KEEPCNT", self.keepcnt)):
+                opt = getattr(socket, name, None)
+                if value != None and opt != None:
+                    soc.setsockopt(socket.IPPROTO_TCP, opt, value)
+        if self.quickack:
+            QuickAck(soc)
+
+def QuickAck(soc):
+    '''
+    Ask for immediate acks, linux clears it after a while so it's set after
+    each receive
+    '''
+    opt = getattr(socket, "TCP_QUICKACK", None)
+    if opt != None:
+        soc.setsockopt(socket.IPPROTO_TCP, opt, 1)
+
+def SplitPortal(portal, default_port):
+    '''
+    Split portal into host and port, e.g. "10.0.0.1:3260", "[fe80::1]:3260"
+    or "storage.local"
+    '''
+    if portal.startswith("["):
+        end = portal.find("]")
+        host, rest = portal[1:end], portal[end + 1:]
+        if rest.startswith(":"):
+            return host, int(rest[1:])
+        return host, default_port
+    if portal.count(":") == 1:
+        host, port = portal.split(":")
+        return host, int(port)
+    return portal, default_port
+
+def Interleave(addrs):
+    '''
+    Order resolved addresses so that address families alternate, RFC 8305 4
+    '''
+    families = {}
+    for a in addrs:
+        families.setdefault(a[0], []).append(a)
+    retval = []
+    lists = list(families.values())
+    while len(lists) != 0:
+        for l in lists:
+            retval += [l.pop(0)]
+        lists = [l for l in lists if len(l) != 0]
+    return retval
+
+def Connect(host, port, options = None):
+    '''
+    Connect to host trying all resolved addresses, happy eyeballs style: next
+    address is tried when the previous one fails or doesn't answer in
+    attempt_delay seconds, the first established connection is used.
+    Returns connected blocking socket with options applied.
+    @param options: TransportOptions, defaults are used if None
+    '''
+    if options == None:
+        options = TransportOptions()
+    addrs = Interleave(socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM))
+    results = queue.Queue(0)
+
+    def Attempt(family, type, proto, addr):
+        soc = socket.socket(family, type, proto)
+        try:
+            options.ApplyPreConnect(soc)
+            soc.settimeout(options.connect_timeout)
+            soc.connect(addr)
+        except OSError as e:
+            soc.close()
+            results.put((None, e))
+            return
+        results.put((soc, None))
+
+    deadline = None
+    if options.connect_timeout != None:
+        deadline = time.monotonic() + options.connect_timeout
+    error = None
+    winner = None
+    started = 0
+    failed = 0
+    while winner == None:
+        if started < len(addrs):
+            family, type, proto, name, addr = addrs[started]
+            _thread.start_new_thread(Attempt, (family, type, proto, addr))
+            started += 1
+        elif failed == started:
+            break # all failed
+        wait = options.attempt_delay if started < len(addrs) else None
+        if deadline != None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            wait = remaining if wait == None else min(wait, remaining)
+        try:
+            soc, e = results.get(True, wait)
+        except queue.Empty:
+            continue
+        if soc == None:
+            failed += 1
+            error = e
+        else:
+            winner = soc
+
+    pending = started - failed - (winner != None)
+    if pending != 0:
+        # close connections of slower attempts once they finish
+        def Reap():
+            for i in range(pending):
+                soc, e = results.get(True)
+                if soc != None:
+                    soc.close()
+        _thread.start_new_thread(Reap, tuple())
+
+    if winner == None:
+        if error == None or pending != 0:
+            raise socket.timeout("connection to %s:%s timed out" % (host, port))
+        raise error
+    winner.settimeout(None)
+    options.Apply(winner)
+    return winner
+
+class MemoryPipe():
+    '''
+    One end of an in-process byte stream with the subset of socket interface
+    connections use: recv_into, sendmsg, sendall, shutdown and close. Sent
+    buffers are copied once, so callers may reuse them right away.
+    '''
+    def __init__(self):
+        self.__chunks = collections.deque()
+        self.__offset = 0 # read offset in first chunk
+        self.__cond = threading.Condition()
+        self.__eof = False
+        self.__peer = None
+
+    @classmethod
+    def Pair(cls):
+        '''
+        Returns two connected ends
+        '''
+        a, b = cls(), cls()
+        a.__peer, b.__peer = b, a
+        return a, b
+
+    def __Put(self, data):
+        with self.__cond:
+            if len(data) != 0:
+                self.__chunks.append(data)
+            self.__cond.notify()
+
+    def __Eof(self):
+        with self.__cond:
+            self.__eof = True
+            self.__cond.notify()
+
+    def sendmsg(self, bufs):
+        data = b"".join(bufs)
+        if self.__peer == None:
+            raise BrokenPipeError
+        self.__peer.__Put(data)
+        return len(data)
+
+    def sendall(self, data):
+        self.sendmsg([data])
+
+    def recv_into(self, buf, nbytes = 0):
+        view = memoryview(buf).cast("B")
+        if nbytes == 0:
+            nbytes = len(view)
+        with self.__cond:
+            while len(self.__chunks) == 0 and not self.__eof:
+                self.__cond.wait()
+            n = 0
+            while n < nbytes and len(self.__chunks) != 0:
+                chunk = self.__chunks[0]
+                count = min(nbytes - n, len(chunk) - self.__offset)
+                view[n:n + count] = chunk[self.__offset:self.__offset + count]
+                n += count
+                self.__offset += count
+                if self.__offset == len(chunk):
+                    self.__chunks.popleft()
+                    self.__offset = 0
+            return n
+
+    def recv(self, bufsize):
+        buf = bytearray(bufsize)
+        return bytes(buf[:self.recv_into(buf)])
+
+    def shutdown(self, how = socket.SHUT_RDWR):
+        if self.__peer != None:
+            self.__peer.__Eof()
+
+    def close(self):
+        self.shutdown()
+        self.__peer = None
+        self.__Eof()
+
+# in-process endpoints for "pair:" and "pipe:" portals, name:accept callback
+__endpoints = {}
+
+def Bind(name, accept):
+    '''
+    Register an in-process endpoint, e.g. a test target. Connections to
+    "pair:name" or "pipe:name" portals call accept with the far end.
+    @param accept: called with socket like object of the target side
+    '''
+    __endpoints[name] = accept
+
+def Unbind(name):
+    __endpoints.pop(name, None)
+
+def __Accept(name, pair):
+    accept = __endpoints.get(name)
+    near, far = pair
+    if accept == None:
+        near.close()
+        far.close()
+        raise ConnectionRefusedError("no endpoint bound to %s" % name)
+    accept(far)
+    return near
+
+def OpenTcp(address, default_port, options):
+    host, port = SplitPortal(address, default_port)
+    return Connect(host, port, options)
+
+def OpenUnix(address, default_port, options):
+    soc = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        options.ApplyPreConnect(soc)
+        soc.settimeout(options.connect_timeout)
+        soc.connect(address)
+    except OSError:
+        soc.close()
+        raise
+    soc.settimeout(None)
+    return soc
+
+def OpenPair(address, default_port, options):
+    return __Accept(address, socket.socketpair())
+
+def OpenPipe(address, default_port, options):
+    return __Accept(address, MemoryPipe.Pair())
+
+# scheme:opener, openers return connected socket like objects
+__transports = {"tcp":OpenTcp, "unix":OpenUnix, "pair":OpenPair, "pipe":OpenPipe}
+
+def Register(scheme, opener):
+    '''
+    Add a transport for "scheme:address" portals
+    @param opener: called with (address, default_port, options)
+    '''
+    __transports[scheme] = opener
+
+def Open(portal, default_port, options = None):
+    '''
+    Open connection to portal, "unix:/run/tgt.sock", "pair:name",
+    "pipe:name" or a tcp "host:port" with optional "tcp:" prefix
+    '''
+    if options == None:
+        options = TransportOptions()
+    scheme, sep, address = portal.partition(":")
+    if sep != "" and scheme in __transports:
+        return __transports[scheme](address, default_port, options)
+    return OpenTcp(portal, default_port, options)
+
+def IsTcp(soc):
+    return getattr(soc, "family", None) in (socket.AF_INET, socket.AF_INET6)
+
+if __name__ == "__main__":
+    import unittest
+    class TestSplitPortal(unittest.TestCase):
+        def testSplit(self):
+            self.assertEqual(SplitPortal("10.0.0.1:3261", 3260), ("10.0.0.1", 3261))
+            self.assertEqual(SplitPortal("storage.local", 3260), ("storage.local", 3260))
+            self.assertEqual(SplitPortal("[fe80::1]:3261", 3260), ("fe80::1", 3261))
+            self.assertEqual(SplitPortal("[fe80::1]", 3260), ("fe80::1", 3260))
+            self.assertEqual(SplitPortal("fe80::1", 3260), ("fe80::1", 3260))
+
+    class TestInterleave(unittest.TestCase):
+        def testInterleave(self):
+            addrs = [(6, 1), (6, 2), (6, 3), (4, 1)]
+            self.assertEqual(Interleave(addrs), [(6, 1), (4, 1), (6, 2), (6, 3)])
+
+    class TestConnect(unittest.TestCase):
+        def testConnect(self):
+            srv = socket.socket()
+            srv.bind(("127.0.0.1", 0))
+            srv.listen(1)
+            options = TransportOptions(rcvbuf = 1 << 20, keepalive = True, keepidle = 30,
+                                       quickack = True, connect_timeout = 5)
+            soc = Connect("127.0.0.1", srv.getsockname()[1], options)
+            self.assertEqual(soc.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY), 1)
+            self.assertEqual(soc.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE), 1)
+            self.assertEqual(soc.gettimeout(), None)
+            soc.close()
+            srv.close()
+
+        def testRefused(self):
+            srv = socket.socket()
+            srv.bind(("127.0.0.1", 0))
+            port = srv.getsockname()[1]
+            srv.close()
+            self.assertRaises(ConnectionRefusedError, Connect, "127.0.0.1", port,
+                              TransportOptions(connect_timeout = 5))
+
+    class TestMemoryPipe(unittest.TestCase):
+        def testStream(self):
+            a, b = MemoryPipe.Pair()
+            a.sendmsg([b"abc", bytearray(b"de")])
+            a.sendall(b"f")
+            buf = bytearray(4)
+            self.assertEqual(b.recv_into(buf), 4)
+            self.assertEqual(buf, b"abcd")
+            self.assertEqual(b.recv_into(buf), 2)
+            self.assertEqual(buf[:2], b"ef")
+            a.close()
+            self.assertEqual(b.recv_into(buf), 0)
+
+    class TestOpen(unittest.TestCase):
+        def testEndpoints(self):
+            ends = []
+            Bind("t", ends.append)
+            for portal in ("pair:t", "pipe:t"):
+                soc = Open(portal, 3260)
+                soc.sendall(b"ping")
+                buf = bytearray(4)
+                self.assertEqual(ends[-1].recv_into(buf), 4)
+                self.assertEqual(buf, b"ping")
+                soc.close()
+            Unbind("t")
+            self.assertRaises(ConnectionRefusedError, Open, "pipe:t", 3260)
+
+        def testUnix(self):
+            import tempfile, os
+            path = os.path.join(tempfile.mkdtemp(), "tgt.sock")
+            srv = socket.socket(socket.AF_UNIX)
+            srv.bind(path)
+            srv.listen(1)
+            soc = Open("unix:" + path, 3260)
+            self.assertEqual(soc.family, socket.AF_UNIX)
+            soc.close()
+            srv.close()
+            os.unlink(path)
+
+    unittest.main()
@@ -47,6 +47,12 @@ def iton(i, ln = 0):
     else:
         raise TypeError
     
+# serial number arithmetic on 32 bit sequence numbers, RFC 1982
+def SerialLt(a, b):
+    return a != b and ((b - a) & 0xFFFFFFFF) < 0x80000000
+
+def SerialLe(a, b):
+    return a == b or SerialLt(a, b)
 
 FILTER=''.join([(len(repr(chr(x)))==3) and chr(x) or '.' for x in range(256)])
 